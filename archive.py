@@ -0,0 +1,313 @@
+import argparse
+import atexit
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import utilities as utils
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+CHUNK_PATTERN = '{:06d}.log.gz'
+INDEX_FILE = 'index.jsonl'
+FRAME_MAX_RECORDS = 500
+FRAME_MAX_SECONDS = 5
+QUEUE_SIZE = 10000
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class Archiver:
+    """Append-only archive of every forwarded message, one per binding.
+
+    Layout of `<archive_dir>/<folder_name>/`:
+
+    - `chunks/NNNNNN.log.gz`: concatenated gzip members, each member a frame of JSON lines.
+      A chunk is closed once it exceeds the chunk size and the next one is started.
+    - `index.jsonl`: one line per frame with its chunk, byte offset, length, record count
+      and first/last timestamp, so exports of a time range only decompress the frames in it.
+    - `media/<sha256>.<ext>`: media files, stored once by content.
+
+    `record` only puts the message on a queue, a background thread batches the records
+    into frames and stores the media, so archiving never blocks forwarding.
+    """
+
+    def __init__(self, base_dir: str, chunk_bytes: int, enabled: bool = True):
+        self.base_dir = base_dir
+        self.chunk_bytes = chunk_bytes
+        self.enabled = enabled
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._thread: threading.Thread | None = None
+        self._stopping = False
+        self._start_lock = threading.Lock()
+
+    def record(self, folder_name: str, direction: str, author: str, text: str | None = None,
+               kind: str = 'text', message_id: str | None = None, files: list | None = None,
+               urls: list | None = None):
+        """Queue a forwarded message for archiving.
+
+        :param str folder_name: Folder name of the binding.
+        :param str direction: 'line_to_discord' or 'discord_to_line'.
+        :param str author: Display name of the sender.
+        :param str text: Text of the message.
+        :param str kind: Message type, e.g. text, image, sticker.
+        :param str message_id: ID of the message on its source platform.
+        :param list files: Local media files. They are hard linked (or copied) right away so
+            the caller may delete them after sending.
+        :param list urls: Media URLs to download in the background.
+        """
+        if not self.enabled:
+            return
+        self._start()
+        record = {'ts': time.time(), 'direction': direction, 'author': author, 'kind': kind,
+                  'text': text, 'message_id': message_id}
+        staged = [item for item in (self._stage(path) for path in files or []) if item]
+        try:
+            self._queue.put_nowait((folder_name, record, staged, urls or []))
+        except queue.Full:
+            self.dropped += 1
+            for path, _ in staged:
+                os.remove(path)
+            logger.warning("封存佇列已滿，略過訊息 (累計略過 %s 筆)", self.dropped,
+                           extra={'rate_key': 'archive_queue_full'})
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self, timeout: float = 10):
+        """Wait until queued records are written, used at shutdown.
+
+        Called again (e.g. by atexit after lifecycle) while the thread still writes, it
+        keeps waiting for the same thread instead of starting another one.
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        if not self._stopping:
+            self._stopping = True
+            self._queue.put((None, None, None, None))
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning("等待封存寫入逾時 (%s 秒)，尚有 %s 筆待寫入", timeout, self.pending)
+            return
+        self._thread = None
+        self._stopping = False
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='archive', daemon=True)
+                self._thread.start()
+
+    def _stage(self, path: str) -> tuple[str, str] | None:
+        staging_dir = os.path.join(self.base_dir, '.staging')
+        os.makedirs(staging_dir, exist_ok=True)
+        fd, staged_path = tempfile.mkstemp(dir=staging_dir)
+        os.close(fd)
+        os.remove(staged_path)
+        try:
+            os.link(path, staged_path)
+        except OSError:
+            try:
+                shutil.copyfile(path, staged_path)
+            except OSError as e:
+                logger.warning("無法封存媒體檔案 %s: %s", path, e)
+                return None
+        return staged_path, os.path.basename(path)
+
+    def _run(self):
+        frames: dict[str, list] = {}
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                folder_name, record, staged, urls = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._write_frames(frames)
+                deadline = None
+                continue
+            if folder_name is None:
+                self._write_frames(frames)
+                return
+            try:
+                record['media'] = ([self._store_file(folder_name, path, name)
+                                    for path, name in staged]
+                                   + [m for m in (self._store_url(folder_name, url) for url in urls)
+                                      if m])
+            except Exception as e:
+                logger.error("封存媒體時發生錯誤: %s", e)
+                record['media'] = []
+            frame = frames.setdefault(folder_name, [])
+            frame.append(record)
+            if deadline is None:
+                deadline = time.monotonic() + FRAME_MAX_SECONDS
+            if len(frame) >= FRAME_MAX_RECORDS:
+                self._write_frames({folder_name: frames.pop(folder_name)})
+
+    def _store_file(self, folder_name: str, path: str, name: str) -> dict:
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(block)
+                size += len(block)
+        return self._put_media(folder_name, path, name, digest.hexdigest(), size)
+
+    def _store_url(self, folder_name: str, url: str) -> dict | None:
+        name = os.path.basename(url.split('?', 1)[0]) or 'media'
+        staging_dir = os.path.join(self.base_dir, '.staging')
+        os.makedirs(staging_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=staging_dir)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as file, requests.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                for block in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    digest.update(block)
+                    size += len(block)
+                    file.write(block)
+        except Exception as e:
+            os.remove(temp_path)
+            logger.warning("無法下載封存媒體 %s: %s", url, e)
+            return None
+        return self._put_media(folder_name, temp_path, name, digest.hexdigest(), size)
+
+    def _put_media(self, folder_name: str, path: str, name: str, digest: str, size: int) -> dict:
+        extension = os.path.splitext(name)[1].lower()
+        media_dir = os.path.join(self.base_dir, folder_name, 'media')
+        os.makedirs(media_dir, exist_ok=True)
+        target = os.path.join(media_dir, f'{digest}{extension}')
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.replace(path, target)
+        return {'name': name, 'sha256': digest, 'size': size,
+                'path': os.path.join('media', f'{digest}{extension}')}
+
+    def _write_frames(self, frames: dict):
+        for folder_name, records in frames.items():
+            if not records:
+                continue
+            try:
+                self._append_frame(folder_name, records)
+            except Exception as e:
+                logger.error("寫入封存檔失敗: %s, 錯誤: %s", folder_name, e)
+        frames.clear()
+
+    def _append_frame(self, folder_name: str, records: list):
+        binding_dir = os.path.join(self.base_dir, folder_name)
+        chunk_dir = os.path.join(binding_dir, 'chunks')
+        os.makedirs(chunk_dir, exist_ok=True)
+        chunk = _last_chunk(chunk_dir)
+        chunk_path = os.path.join(chunk_dir, CHUNK_PATTERN.format(chunk))
+        if os.path.exists(chunk_path) and os.path.getsize(chunk_path) >= self.chunk_bytes:
+            chunk += 1
+            chunk_path = os.path.join(chunk_dir, CHUNK_PATTERN.format(chunk))
+        payload = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        frame = gzip.compress(payload.encode('utf-8'))
+        with open(chunk_path, 'ab') as file:
+            offset = file.tell()
+            file.write(frame)
+            file.flush()
+            os.fsync(file.fileno())
+        entry = {'chunk': chunk, 'offset': offset, 'length': len(frame), 'count': len(records),
+                 'first_ts': records[0]['ts'], 'last_ts': records[-1]['ts']}
+        with open(os.path.join(binding_dir, INDEX_FILE), 'a', encoding='utf8') as index:
+            index.write(json.dumps(entry) + '\n')
+        logger.debug("已封存 %s 筆訊息至 %s (chunk %s)", len(records), folder_name, chunk)
+
+
+def _last_chunk(chunk_dir: str) -> int:
+    numbers = [int(name.split('.', 1)[0]) for name in os.listdir(chunk_dir)
+               if name.endswith('.log.gz') and name.split('.', 1)[0].isdigit()]
+    return max(numbers, default=1)
+
+
+def export(base_dir: str, folder_name: str, since: float | None = None,
+           until: float | None = None):
+    """Stream the archived records of a binding in order.
+
+    Only frames whose time range overlaps [since, until] are read and decompressed.
+
+    :param str base_dir: The archive directory.
+    :param str folder_name: Folder name of the binding.
+    :param float since: Earliest timestamp, None for no limit.
+    :param float until: Latest timestamp, None for no limit.
+    :return: Generator of record dicts.
+    """
+    binding_dir = os.path.join(base_dir, folder_name)
+    index_path = os.path.join(binding_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return
+    with open(index_path, encoding='utf8') as index:
+        for line in index:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # A frame cut short by a crash
+                continue
+            if (since is not None and entry['last_ts'] < since) or \
+                    (until is not None and entry['first_ts'] > until):
+                continue
+            chunk_path = os.path.join(binding_dir, 'chunks', CHUNK_PATTERN.format(entry['chunk']))
+            with open(chunk_path, 'rb') as chunk:
+                chunk.seek(entry['offset'])
+                frame = gzip.decompress(chunk.read(entry['length']))
+            for record_line in frame.decode('utf-8').splitlines():
+                record = json.loads(record_line)
+                if (since is None or record['ts'] >= since) and \
+                        (until is None or record['ts'] <= until):
+                    yield record
+
+
+def _parse_time(value: str) -> float:
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export archived messages as JSON lines.")
+    parser.add_argument('folder_name', nargs='?', help="Folder name of the binding.")
+    parser.add_argument('--list', action='store_true', help="List archived bindings.")
+    parser.add_argument('--since', type=_parse_time, help="ISO date/time, e.g. 2024-01-31T08:00")
+    parser.add_argument('--until', type=_parse_time, help="ISO date/time.")
+    parser.add_argument('-o', '--output', help="Output file, stdout by default.")
+    args = parser.parse_args(argv)
+
+    base_dir = config['archive_dir']
+    if args.list or not args.folder_name:
+        if os.path.isdir(base_dir):
+            for name in sorted(os.listdir(base_dir)):
+                if os.path.exists(os.path.join(base_dir, name, INDEX_FILE)):
+                    print(name)
+        return
+    output = open(args.output, 'w', encoding='utf8') if args.output else sys.stdout
+    try:
+        for record in export(base_dir, args.folder_name, args.since, args.until):
+            output.write(json.dumps(record, ensure_ascii=False) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+archiver = Archiver(config['archive_dir'], config['archive_chunk_mb'] * 1024 * 1024,
+                    config['archive_enabled'])
+atexit.register(archiver.flush)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    """Get a free TCP port on localhost."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process in MiB."""
+    try:
+        with open('/proc/self/status', encoding='utf8') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile, 0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class DeliveryRecorder:
+    """Match sent markers with their arrival at a fake endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: dict[str, tuple[str, float]] = {}
+        self.latencies: dict[str, list[float]] = {}
+        self.delivered_count = 0
+        self.last_delivery = 0.0
+
+    def sent(self, marker: str, kind: str):
+        with self._lock:
+            self._pending[marker] = (kind, time.perf_counter())
+
+    def delivered(self, marker: str):
+        now = time.perf_counter()
+        with self._lock:
+            entry = self._pending.pop(marker, None)
+            if entry is None:
+                return
+            kind, started = entry
+            self.latencies.setdefault(kind, []).append(now - started)
+            self.delivered_count += 1
+            self.last_delivery = now
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+
+class ServerThread(threading.Thread):
+    """Run an aiohttp application on its own event loop in a daemon thread.
+
+    The bridge calls LINE and Discord with blocking clients, so the stand-ins must not
+    share its event loop.
+    """
+
+    def __init__(self, app: web.Application, port: int | None = None):
+        super().__init__(daemon=True)
+        self.app = app
+        self.port = port or free_port()
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self._runner = web.AppRunner(self.app, access_log=None)
+        self.loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port, backlog=1024)
+        self.loop.run_until_complete(site.start())
+        self._ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self._runner.cleanup())
+
+    def start(self):
+        super().start()
+        self._ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(timeout=5)
@@ -0,0 +1,71 @@
+"""Drive discord_bot.on_message with simulated Discord messages."""
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+import discord
+
+from benchmarks.common import DeliveryRecorder
+
+ATTACHMENTS = {
+    'image': ('photo.png', 200 * 1024),
+    'video': ('clip.mp4', 2 * 1024 * 1024),
+    'audio': ('voice.m4a', 256 * 1024),
+}
+
+
+def build_message(kind: str, seq: int, channel_id: int, marker: str, cdn_base: str):
+    """Build an object shaped like the parts of discord.Message that on_message reads.
+
+    :param str kind: text, image, video or audio.
+    :param int seq: Sequence number, used for unique IDs.
+    :param int channel_id: Bound Discord channel ID.
+    :param str marker: Author display name, found again in the pushed LINE text.
+    :param str cdn_base: Base URL the attachment URLs point to.
+    """
+    author = SimpleNamespace(id=10 ** 17 + seq, bot=False, name=marker, display_name=marker,
+                             avatar=None, display_avatar=None)
+    channel = SimpleNamespace(id=channel_id, name='bench', parent_id=None,
+                              type=discord.ChannelType.text)
+    attachments = []
+    if kind in ATTACHMENTS:
+        file_name, size = ATTACHMENTS[kind]
+        url = f'{cdn_base}/attachments/{channel_id}/{seq}/{file_name}'
+        attachments.append(SimpleNamespace(id=seq, filename=file_name, title=file_name,
+                                           url=url, proxy_url=url, size=size,
+                                           content_type=None))
+    return SimpleNamespace(id=2 * 10 ** 17 + seq, author=author, channel=channel,
+                           guild=SimpleNamespace(id=1), content='' if attachments else f'benchmark {seq}',
+                           attachments=attachments, mentions=[], role_mentions=[],
+                           channel_mentions=[], reference=None)
+
+
+async def run(on_message, recorder: DeliveryRecorder, kinds: list, channel_ids: list,
+              count: int, rate: float, cdn_base: str = 'https://cdn.discordapp.com',
+              start_seq: int = 0):
+    """Call on_message at a target rate.
+
+    :param on_message: The discord_bot.on_message coroutine function.
+    :param DeliveryRecorder recorder: Recorder the sent markers are registered with.
+    :param list kinds: Message kinds to cycle through, repeated to weight the mix.
+    :param list channel_ids: Bound Discord channel IDs to spread the messages over.
+    :param int count: Number of messages to send.
+    :param float rate: Target messages per second, 0 for as fast as possible.
+    :param str cdn_base: Base URL the attachment URLs point to.
+    :param int start_seq: First sequence number, keeps IDs unique across runs.
+    """
+    kind_cycle = itertools.cycle(kinds)
+    channel_cycle = itertools.cycle(channel_ids)
+    interval = 1 / rate if rate else 0
+    started = time.perf_counter()
+    tasks = []
+    for index, seq in enumerate(range(start_seq, start_seq + count)):
+        kind = next(kind_cycle)
+        marker = f'D{kind}{seq:08d}'
+        recorder.sent(marker, kind)
+        message = build_message(kind, seq, next(channel_cycle), marker, cdn_base)
+        tasks.append(asyncio.create_task(on_message(message)))
+        delay = started + (index + 1) * interval - time.perf_counter()
+        await asyncio.sleep(max(0.0, delay))
+    await asyncio.gather(*tasks, return_exceptions=True)
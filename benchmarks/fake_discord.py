@@ -0,0 +1,66 @@
+"""Local stand-in for Discord webhook execution."""
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+from benchmarks.common import DeliveryRecorder
+
+
+def create_app(recorder: DeliveryRecorder, latency: float = 0.0,
+               rate_limit_ratio: float = 0.0, retry_after: float = 0.05) -> web.Application:
+    """Create the fake Discord webhook application.
+
+    Deliveries are recorded by the author part of the webhook username, which the bridge
+    sets to "<LINE display name> - (Line訊息)".
+
+    :param DeliveryRecorder recorder: Recorder notified of every executed webhook.
+    :param float latency: Seconds to wait before answering each request.
+    :param float rate_limit_ratio: Fraction of requests answered with 429.
+    :param float retry_after: Retry-After value of the 429 responses, in seconds.
+    """
+    stats = {'executed': 0, 'rate_limited': 0, 'bytes': 0}
+
+    async def execute(request):
+        if latency:
+            await asyncio.sleep(latency)
+        if rate_limit_ratio and random.random() < rate_limit_ratio:
+            stats['rate_limited'] += 1
+            return web.json_response(
+                {'message': 'You are being rate limited.', 'retry_after': retry_after,
+                 'global': False},
+                status=429,
+                headers={'Retry-After': str(retry_after), 'X-RateLimit-Remaining': '0',
+                         'X-RateLimit-Reset-After': str(retry_after),
+                         'X-RateLimit-Bucket': 'bench'})
+
+        payload = {}
+        if request.content_type.startswith('multipart/'):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.name == 'payload_json':
+                    payload = json.loads(await part.text())
+                else:
+                    stats['bytes'] += len(await part.read())
+        else:
+            payload = await request.json()
+
+        stats['executed'] += 1
+        username = payload.get('username') or ''
+        recorder.delivered(username.split(' - ', 1)[0])
+        if request.query.get('wait') in ('true', '1'):
+            message = {'id': str(10 ** 18 + stats['executed']),
+                       'channel_id': request.match_info['webhook_id'],
+                       'content': payload.get('content', ''),
+                       'type': 0, 'attachments': [], 'embeds': [],
+                       'author': {'id': request.match_info['webhook_id'], 'username': username,
+                                  'discriminator': '0000', 'bot': True}}
+            # Without a charset, as Discord answers; discord.py only decodes exactly that type
+            return web.Response(body=json.dumps(message).encode(), content_type='application/json')
+        return web.Response(status=204)
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app['stats'] = stats
+    app.router.add_post('/api/v10/webhooks/{webhook_id}/{webhook_token}', execute)
+    return app
@@ -0,0 +1,120 @@
+"""Local stand-in for the LINE Messaging API and content API."""
+import os
+
+from aiohttp import web
+
+from benchmarks.common import DeliveryRecorder
+
+# Sizes of the content served by /v2/bot/message/{id}/content, keyed by id prefix.
+DEFAULT_CONTENT_SIZES = {
+    'image': 200 * 1024,
+    'video': 2 * 1024 * 1024,
+    'audio': 256 * 1024,
+    'file': 512 * 1024,
+}
+
+
+def create_app(recorder: DeliveryRecorder, content_sizes: dict | None = None,
+               quota_limit: int | None = None, group_members: int = 1) -> web.Application:
+    """Create the fake LINE API application.
+
+    Member profiles use the user ID as display name, so the benchmark can put its marker
+    in the user ID and find it again in the Discord webhook username. Pushed messages are
+    recorded by the first line of their first text message, which is the author name the
+    bridge prepends to every Discord message.
+
+    :param DeliveryRecorder recorder: Recorder notified of every pushed message.
+    :param dict content_sizes: Size in bytes of the content for each message ID prefix.
+    :param int quota_limit: Monthly push quota to report, None for unlimited.
+    :param int group_members: Member count reported for every group.
+    """
+    sizes = {**DEFAULT_CONTENT_SIZES, **(content_sizes or {})}
+    blobs = {kind: os.urandom(min(size, 64 * 1024)) for kind, size in sizes.items()}
+    stats = {'push': 0, 'reply': 0, 'content': 0, 'push_by_token': {}}
+
+    async def bot_info(request):
+        return web.json_response({'userId': 'Ubenchbot', 'basicId': '@benchbot',
+                                  'displayName': 'BenchBot', 'chatMode': 'bot',
+                                  'markAsReadMode': 'auto'})
+
+    async def member_profile(request):
+        user_id = request.match_info['user_id']
+        return web.json_response({'displayName': user_id, 'userId': user_id,
+                                  'pictureUrl': 'https://example.invalid/avatar.png'})
+
+    async def group_summary(request):
+        group_id = request.match_info['group_id']
+        return web.json_response({'groupId': group_id, 'groupName': f'bench-{group_id}',
+                                  'pictureUrl': 'https://example.invalid/group.png'})
+
+    async def push(request):
+        body = await request.json()
+        stats['push'] += 1
+        token = request.headers.get('Authorization', '')
+        stats['push_by_token'][token] = stats['push_by_token'].get(token, 0) + 1
+        _record(body)
+        return web.json_response({'sentMessages': [
+            {'id': str(stats['push'] * 10 + index), 'quoteToken': 'benchquote'}
+            for index, _ in enumerate(body.get('messages', []))]})
+
+    async def reply(request):
+        body = await request.json()
+        stats['reply'] += 1
+        _record(body)
+        return web.json_response({'sentMessages': [
+            {'id': f"r{stats['reply'] * 10 + index}", 'quoteToken': 'benchquote'}
+            for index, _ in enumerate(body.get('messages', []))]})
+
+    def _record(body: dict):
+        texts = [message['text'] for message in body.get('messages', [])
+                 if message.get('type') == 'text']
+        if texts and texts[0].startswith('（'):
+            # A digest, one "author：text" line per message
+            for text in texts:
+                for line in text.split('\n'):
+                    recorder.delivered(line.split('：', 1)[0])
+        elif texts:
+            recorder.delivered(texts[0].split('\n', 1)[0])
+
+    async def content(request):
+        message_id = request.match_info['message_id']
+        kind = message_id.split('-', 1)[0]
+        size = sizes.get(kind, sizes['file'])
+        blob = blobs.get(kind, blobs['file'])
+        stats['content'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'application/octet-stream',
+                                               'Content-Length': str(size)})
+        await response.prepare(request)
+        remaining = size
+        while remaining > 0:
+            chunk = blob[:remaining]
+            await response.write(chunk)
+            remaining -= len(chunk)
+        await response.write_eof()
+        return response
+
+    async def quota(request):
+        if quota_limit is None:
+            return web.json_response({'type': 'none'})
+        return web.json_response({'type': 'limited', 'value': quota_limit})
+
+    async def quota_consumption(request):
+        # Every access token is a LINE account with a quota of its own
+        pushes = stats['push_by_token'].get(request.headers.get('Authorization', ''), 0)
+        return web.json_response({'totalUsage': pushes * group_members})
+
+    async def member_count(request):
+        return web.json_response({'count': group_members})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app['stats'] = stats
+    app.router.add_get('/v2/bot/info', bot_info)
+    app.router.add_get('/v2/bot/group/{group_id}/member/{user_id}', member_profile)
+    app.router.add_get('/v2/bot/group/{group_id}/summary', group_summary)
+    app.router.add_get('/v2/bot/group/{group_id}/members/count', member_count)
+    app.router.add_post('/v2/bot/message/push', push)
+    app.router.add_post('/v2/bot/message/reply', reply)
+    app.router.add_get('/v2/bot/message/{message_id}/content', content)
+    app.router.add_get('/v2/bot/message/quota', quota)
+    app.router.add_get('/v2/bot/message/quota/consumption', quota_consumption)
+    return app
@@ -0,0 +1,117 @@
+"""Generate signed LINE webhook requests against the bridge's /callback endpoint."""
+import asyncio
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import time
+
+import aiohttp
+
+from benchmarks.common import DeliveryRecorder
+
+STICKER_PACKAGE_ID = '1'
+# Stickers are drawn from a small popular set, like in real chats
+STICKER_COUNT = 20
+
+
+def sign(channel_secret: str, body: str) -> str:
+    """Compute the X-Line-Signature header for a body."""
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def build_event(kind: str, seq: int, group_id: str, marker: str) -> dict:
+    """Build one LINE message event.
+
+    :param str kind: text, image, video, audio, file or sticker.
+    :param int seq: Sequence number, used for unique IDs.
+    :param str group_id: Source LINE group ID.
+    :param str marker: Sender user ID, which the fake LINE API also returns as display name.
+    """
+    message_id = f'{kind}-{seq}'
+    if kind == 'text':
+        message = {'type': 'text', 'id': message_id, 'quoteToken': 'q', 'text': f'benchmark {seq}'}
+    elif kind == 'sticker':
+        message = {'type': 'sticker', 'id': message_id, 'quoteToken': 'q',
+                   'packageId': STICKER_PACKAGE_ID, 'stickerId': str(seq % STICKER_COUNT),
+                   'stickerResourceType': 'STATIC'}
+    elif kind == 'file':
+        message = {'type': 'file', 'id': message_id, 'fileName': f'{seq}.bin', 'fileSize': 1}
+    elif kind == 'video':
+        message = {'type': 'video', 'id': message_id, 'quoteToken': 'q', 'duration': 1000,
+                   'contentProvider': {'type': 'line'}}
+    elif kind == 'audio':
+        message = {'type': 'audio', 'id': message_id, 'duration': 1000,
+                   'contentProvider': {'type': 'line'}}
+    else:
+        message = {'type': kind, 'id': message_id, 'quoteToken': 'q',
+                   'contentProvider': {'type': 'line'}}
+    return {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'webhookEventId': f'01BENCH{seq:019d}',
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': f'reply{seq}',
+        'source': {'type': 'group', 'groupId': group_id, 'userId': marker},
+        'message': message,
+    }
+
+
+def build_body(events: list, destination: str = 'Ubenchbot') -> str:
+    return json.dumps({'destination': destination, 'events': events}, separators=(',', ':'))
+
+
+async def run(callback_url: str, channel_secret: str, recorder: DeliveryRecorder,
+              kinds: list, group_ids: list, count: int, rate: float,
+              events_per_request: int = 1, start_seq: int = 0) -> dict:
+    """Post signed webhook requests at a target rate.
+
+    :param str callback_url: URL of the bridge's /callback endpoint.
+    :param str channel_secret: Channel secret used to sign the bodies.
+    :param DeliveryRecorder recorder: Recorder the sent markers are registered with.
+    :param list kinds: Message kinds to cycle through, repeated to weight the mix.
+    :param list group_ids: LINE group IDs to spread the events over.
+    :param int count: Number of events to send.
+    :param float rate: Target events per second, 0 for as fast as possible.
+    :param int events_per_request: Events batched into one webhook request.
+    :param int start_seq: First sequence number, keeps IDs unique across runs.
+    :return dict: HTTP status counts of the webhook requests.
+    """
+    statuses: dict[int, int] = {}
+    kind_cycle = itertools.cycle(kinds)
+    group_cycle = itertools.cycle(group_ids)
+    interval = events_per_request / rate if rate else 0
+    started = time.perf_counter()
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=256)) as session:
+        async def post(events: list):
+            body = build_body(events)
+            headers = {'X-Line-Signature': sign(channel_secret, body),
+                       'Content-Type': 'application/json'}
+            try:
+                async with session.post(callback_url, data=body.encode('utf-8'),
+                                        headers=headers) as response:
+                    await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+            except aiohttp.ClientError:
+                statuses[0] = statuses.get(0, 0) + 1
+
+        tasks = []
+        end_seq = start_seq + count
+        for batch_start in range(start_seq, end_seq, events_per_request):
+            events = []
+            for seq in range(batch_start, min(end_seq, batch_start + events_per_request)):
+                kind = next(kind_cycle)
+                marker = f'U{kind}{seq:08d}'
+                recorder.sent(marker, kind)
+                events.append(build_event(kind, seq, next(group_cycle), marker))
+            tasks.append(asyncio.create_task(post(events)))
+            if interval:
+                delay = started + len(tasks) * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await asyncio.gather(*tasks)
+    return statuses
@@ -0,0 +1,82 @@
+"""Micro-benchmark of webhook body parsing, with and without the pre-parse routing filter.
+
+Run in project root directory:
+    python -m benchmarks.parse_filter --events 20000
+"""
+import argparse
+import json
+import time
+
+from linebot.v3.webhooks import Event
+
+import webhook_filter
+from benchmarks.load_generator import build_body, build_event
+
+BOUND_GROUPS = 10
+COMMANDS = frozenset({'!ID'})
+ACCOUNT = 'default'
+
+
+def build_bodies(events: int, bound_ratio: float, per_request: int) -> tuple[list, dict]:
+    """Webhook bodies where `bound_ratio` of the events come from bound groups."""
+    bound = {f'Cbound{index:028d}': ACCOUNT for index in range(BOUND_GROUPS)}
+    bound_list = sorted(bound)
+    all_events = []
+    for seq in range(events):
+        # Spread the bound events evenly, so every body mixes both kinds
+        if int((seq + 1) * bound_ratio) > int(seq * bound_ratio):
+            group_id = bound_list[seq % BOUND_GROUPS]
+        else:
+            group_id = f'Cother{seq % 500:028d}'
+        all_events.append(build_event('text', seq, group_id, 'Ubench'))
+    bodies = [build_body(all_events[index:index + per_request])
+              for index in range(0, events, per_request)]
+    return bodies, bound
+
+
+def parse_all(bodies: list, bound: dict) -> int:
+    """What the callback did before: decode and build SDK models for every event."""
+    parsed = 0
+    for body in bodies:
+        for event_data in json.loads(body)['events']:
+            Event.from_dict(event_data)
+            parsed += 1
+    return parsed
+
+
+def parse_filtered(bodies: list, bound: dict) -> int:
+    """Decode, then build SDK models only for events that are routed somewhere."""
+    parsed = 0
+    for body in bodies:
+        for event_data in webhook_filter.loads(body)['events']:
+            if webhook_filter.wanted_event(event_data, bound, ACCOUNT, COMMANDS):
+                Event.from_dict(event_data)
+                parsed += 1
+    return parsed
+
+
+def measure(func, bodies: list, bound: dict, events: int) -> tuple[float, int]:
+    started = time.perf_counter()
+    parsed = func(bodies, bound)
+    return events / (time.perf_counter() - started), parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=20000, help="Events per run.")
+    parser.add_argument('--per-request', type=int, default=5, help="Events per webhook body.")
+    parser.add_argument('--ratios', default='0.1,0.5,0.9',
+                        help="Comma separated shares of events coming from bound groups.")
+    args = parser.parse_args()
+
+    print(f"decoder: {'orjson' if webhook_filter.orjson is not None else 'json'}")
+    print(f"{'bound':>6} {'parse all ev/s':>15} {'filtered ev/s':>14} {'parsed':>7} {'speedup':>8}")
+    for ratio in (float(value) for value in args.ratios.split(',')):
+        bodies, bound = build_bodies(args.events, ratio, args.per_request)
+        before, _ = measure(parse_all, bodies, bound, args.events)
+        after, parsed = measure(parse_filtered, bodies, bound, args.events)
+        print(f"{ratio:>6.0%} {before:>15,.0f} {after:>14,.0f} {parsed:>7} {after / before:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
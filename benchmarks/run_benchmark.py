@@ -0,0 +1,304 @@
+"""Offline throughput benchmark of the LINE ⇄ Discord bridge.
+
+Run from the project root:
+
+    python -m benchmarks.run_benchmark --count 500 --rate 100
+
+The bridge runs in this process against local stand-ins of the LINE API and Discord
+webhooks, from a temporary working directory with its own config.yml and
+sync_channels.json.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import discord_driver, fake_discord, fake_line, load_generator
+from benchmarks.common import (REPO_ROOT, DeliveryRecorder, ServerThread, free_port, percentile,
+                               rss_mb)
+
+CHANNEL_SECRET = 'benchmark-channel-secret'
+LINE_MIXES = {'text': ['text'], 'image': ['image'], 'video': ['video'], 'sticker': ['sticker'],
+              'mixed': ['text'] * 6 + ['image'] * 2 + ['video', 'sticker']}
+DISCORD_MIXES = {'text': ['text'], 'image': ['image'], 'video': ['video'],
+                 'mixed': ['text'] * 7 + ['image'] * 2 + ['video']}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--direction', choices=('line', 'discord', 'both'), default='both')
+    parser.add_argument('--mixes', default='text,image,video,sticker,mixed',
+                        help='Comma separated mixes to run (text, image, video, sticker, mixed).')
+    parser.add_argument('--count', type=int, default=300, help='Messages per scenario.')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Target messages per second, 0 for as fast as possible.')
+    parser.add_argument('--groups', type=int, default=10, help='Number of bound groups.')
+    parser.add_argument('--events-per-request', type=int, default=1)
+    parser.add_argument('--discord-latency', type=float, default=0.02,
+                        help='Seconds the fake Discord webhook waits before answering.')
+    parser.add_argument('--discord-429-ratio', type=float, default=0.0,
+                        help='Fraction of webhook requests answered with 429.')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='Seconds to wait for outstanding deliveries after sending.')
+    parser.add_argument('--line-quota', type=int,
+                        help='Monthly push quota the fake LINE API reports, unlimited by default.')
+    parser.add_argument('--group-members', type=int, default=1,
+                        help='Member count of every LINE group, the cost of one push.')
+    parser.add_argument('--line-accounts', type=int, default=1,
+                        help='LINE accounts to spread the bound groups over.')
+    parser.add_argument('--video-mb', type=float,
+                        help='Size of LINE videos in MiB. Also serves the media relay, so videos '
+                             'over the Discord upload limit are sent as links.')
+    parser.add_argument('--archive', action='store_true',
+                        help='Enable archive mode, to measure its cost on forwarding.')
+    parser.add_argument('--json', dest='json_path', help='Also write the results to this file.')
+    return parser.parse_args(argv)
+
+
+def account_names(args) -> list:
+    """Names of the LINE accounts, the first is the default one."""
+    return ['default'] + [f'bench{index}' for index in range(1, args.line_accounts)]
+
+
+def account_secret(name: str) -> str:
+    return CHANNEL_SECRET if name == 'default' else f'{CHANNEL_SECRET}-{name}'
+
+
+def prepare_workdir(args, line_base: str, port: int) -> str:
+    """Create the working directory with config, bindings and a sticker package."""
+    workdir = tempfile.mkdtemp(prefix='line-discord-bench-')
+    with open(os.path.join(workdir, 'config.yml'), 'w', encoding='utf8') as file:
+        json.dump({
+            'line_channel_access_token': 'benchmark-access-token',
+            'line_channel_secret': CHANNEL_SECRET,
+            'discord_bot_token': 'benchmark-bot-token',
+            'webhook_url': f'http://127.0.0.1:{port}/',
+            'webhook_port': port,
+            'bot_hosted_by': 'benchmark',
+            'line_bot_invite_link': '',
+            'discord_bot_invite_link': '',
+            'log_level': 'WARNING',
+            'line_api_endpoint': line_base,
+            'line_data_api_endpoint': line_base,
+            'archive_enabled': args.archive,
+            'line_digest_interval_seconds': 2,
+            'public_base_url': f'http://127.0.0.1:{port}' if args.video_mb else '',
+            'line_accounts': [{'name': name, 'channel_access_token': f'benchmark-access-token-{name}',
+                               'channel_secret': account_secret(name)}
+                              for name in account_names(args)[1:]],
+        }, file)
+
+    bindings = []
+    for index in range(args.groups):
+        bindings.append({
+            'sub_num': index + 1,
+            'folder_name': f'bench_{index}',
+            'line_group_id': f'Cbench{index:04d}',
+            'line_group_name': f'bench {index}',
+            'discord_channel_id': 900000 + index,
+            'discord_channel_name': f'bench-{index}',
+            'discord_channel_webhook': f'https://discord.com/api/webhooks/{10 ** 17 + index}/'
+                                       f'{"b" * 68}',
+            'line_account': account_names(args)[index % args.line_accounts],
+        })
+    with open(os.path.join(workdir, 'sync_channels.json'), 'w', encoding='utf8') as file:
+        json.dump(bindings, file)
+
+    sticker_dir = os.path.join(workdir, 'downloads', 'stickers',
+                               f'{load_generator.STICKER_PACKAGE_ID}_bench')
+    os.makedirs(sticker_dir)
+    sticker_bytes = os.urandom(8 * 1024)
+    for sticker_id in range(load_generator.STICKER_COUNT):
+        with open(os.path.join(sticker_dir, f'{sticker_id}.png'), 'wb') as file:
+            file.write(sticker_bytes)
+    return workdir
+
+
+async def wait_for_drain(recorder: DeliveryRecorder, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while recorder.pending and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+def summarize(name: str, recorder: DeliveryRecorder, sent: int, started: float,
+              extra: dict) -> dict:
+    latencies = [value for values in recorder.latencies.values() for value in values]
+    elapsed = (recorder.last_delivery or time.perf_counter()) - started
+    return {
+        'scenario': name,
+        'sent': sent,
+        'delivered': recorder.delivered_count,
+        'msgs_per_s': round(recorder.delivered_count / elapsed, 1) if elapsed > 0 else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'rss_mb': round(rss_mb(), 1),
+        **extra,
+    }
+
+
+def print_results(results: list):
+    header = f"{'scenario':<24}{'sent':>6}{'deliv':>7}{'msgs/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'RSS MiB':>9}"
+    print(header)
+    print('-' * len(header))
+    for row in results:
+        print(f"{row['scenario']:<24}{row['sent']:>6}{row['delivered']:>7}{row['msgs_per_s']:>9}"
+              f"{row['p50_ms']:>9}{row['p99_ms']:>9}{row['rss_mb']:>9}")
+
+
+async def main(args) -> list:
+    recorder_box = {'recorder': DeliveryRecorder()}
+
+    class _Forward:
+        """Let the fake servers report to the recorder of the running scenario."""
+
+        def __getattr__(self, name):
+            return getattr(recorder_box['recorder'], name)
+
+    forward = _Forward()
+    content_sizes = {'video': int(args.video_mb * 1024 * 1024)} if args.video_mb else None
+    line_server = ServerThread(fake_line.create_app(forward, content_sizes=content_sizes,
+                                                   quota_limit=args.line_quota,
+                                                   group_members=args.group_members))
+    discord_server = ServerThread(fake_discord.create_app(
+        forward, latency=args.discord_latency, rate_limit_ratio=args.discord_429_ratio))
+    line_server.start()
+    discord_server.start()
+
+    port = free_port()
+    workdir = prepare_workdir(args, line_server.base_url, port)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    import discord.http
+    import uvicorn
+    discord.http.Route.BASE = f'{discord_server.base_url}/api/v10'
+
+    import utilities  # noqa: F401, imported before cache like main.py to avoid a cycle
+    from cache import sync_channels_cache
+    sync_channels_cache.load_all_sync_channels()
+    import line_bot
+    import discord_bot
+
+    async def process_commands(message):
+        return None
+
+    discord_bot.client.process_commands = process_commands
+
+    server = uvicorn.Server(uvicorn.Config(line_bot.app, host='127.0.0.1', port=port,
+                                           log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    from health import health
+    import diagnostics
+    health.start()
+    diagnostics.detector.start()
+
+    mixes = [mix.strip() for mix in args.mixes.split(',') if mix.strip()]
+    group_ids = [f'Cbench{index:04d}' for index in range(args.groups)]
+    channel_ids = [900000 + index for index in range(args.groups)]
+    results = []
+    try:
+        if args.direction in ('line', 'both'):
+            for mix in mixes:
+                if mix not in LINE_MIXES:
+                    continue
+                recorder = recorder_box['recorder'] = DeliveryRecorder()
+                started = time.perf_counter()
+                outcome = {}
+
+                def generate(index: int, name: str):
+                    # Every account posts the events of its own groups to its own callback
+                    path = '/callback' if name == 'default' else f'/callback/{name}'
+                    count = args.count // args.line_accounts
+                    outcome[name] = asyncio.run(load_generator.run(
+                        f'http://127.0.0.1:{port}{path}', account_secret(name), recorder,
+                        LINE_MIXES[mix], group_ids[index::args.line_accounts], count,
+                        args.rate / args.line_accounts, args.events_per_request,
+                        start_seq=len(results) * args.count + index * count))
+
+                generators = [threading.Thread(target=generate, args=(index, name), daemon=True)
+                              for index, name in enumerate(account_names(args))]
+                for generator in generators:
+                    generator.start()
+                while any(generator.is_alive() for generator in generators):
+                    await asyncio.sleep(0.05)
+                await wait_for_drain(recorder, args.drain_timeout)
+                statuses = {}
+                for account_statuses in outcome.values():
+                    for status, count in account_statuses.items():
+                        statuses[status] = statuses.get(status, 0) + count
+                results.append(summarize(f'line→discord {mix}', recorder, args.count, started,
+                                         {'http_statuses': statuses}))
+
+        if args.direction in ('discord', 'both'):
+            for mix in mixes:
+                if mix not in DISCORD_MIXES:
+                    continue
+                recorder = recorder_box['recorder'] = DeliveryRecorder()
+                started = time.perf_counter()
+                await discord_driver.run(discord_bot.on_message, recorder, DISCORD_MIXES[mix],
+                                         channel_ids, args.count, args.rate,
+                                         start_seq=len(results) * args.count)
+                await wait_for_drain(recorder, args.drain_timeout)
+                results.append(summarize(f'discord→line {mix}', recorder, args.count, started,
+                                         {}))
+    finally:
+        server.should_exit = True
+        await server_task
+        line_server.stop()
+        discord_server.stop()
+
+    loop_health = health.lag_monitor.snapshot()
+    loop_health['blocking_sites'] = diagnostics.detector.report()['sites'][:5]
+    archived = 0
+    if args.archive:
+        import archive
+        archive.archiver.flush()
+        archived = sum(1 for binding in sync_channels_cache.cache.values()
+                       for _ in archive.export(archive.config['archive_dir'], binding['folder_name']))
+    quota_stats = {}
+    for account in line_bot.accounts:
+        for decision, count in account.quota.stats.items():
+            quota_stats[decision] = quota_stats.get(decision, 0) + count
+    results.append({'loop': loop_health,
+                    'archived': archived,
+                    'line_quota': quota_stats,
+                    'line_delivery': line_bot.delivery_stats,
+                    'sticker_cache': [line_bot.sticker_cache.hits, line_bot.sticker_cache.misses],
+                    'message_ids': len(line_bot.message_ids),
+                    'fake_discord': discord_server.app['stats'],
+                    'fake_line': line_server.app['stats'],
+                    'line_stages': line_bot.pipeline.timings()})
+    return results
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.json_path:
+        arguments.json_path = os.path.abspath(arguments.json_path)
+    outcome = asyncio.run(main(arguments))
+    print_results(outcome[:-1])
+    print(f"fake Discord: {outcome[-1]['fake_discord']}, fake LINE: {outcome[-1]['fake_line']}")
+    blocking_sites = outcome[-1]['loop'].pop('blocking_sites')
+    print(f"event loop: {outcome[-1]['loop']}")
+    for site in blocking_sites:
+        print(f"  blocked {site['count']}x, {site['total_ms']} ms: {site['site']}")
+    print(f"LINE deliveries: {outcome[-1]['line_delivery']}, "
+          f"sticker cache hits/misses: {outcome[-1]['sticker_cache']}, "
+          f"message IDs indexed: {outcome[-1]['message_ids']}")
+    if arguments.line_quota is not None:
+        print(f"LINE quota decisions: {outcome[-1]['line_quota']}")
+    if arguments.archive:
+        print(f"archived records: {outcome[-1]['archived']}")
+    for kind, stages in outcome[-1]['line_stages'].items():
+        print(f"LINE {kind} stages (avg/max ms): "
+              + ', '.join(f"{name} {timing['avg_ms']}/{timing['max_ms']}"
+                          for name, timing in stages.items()))
+    if arguments.json_path:
+        with open(arguments.json_path, 'w', encoding='utf8') as output:
+            json.dump(outcome, output, ensure_ascii=False, indent=2)
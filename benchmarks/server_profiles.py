@@ -0,0 +1,243 @@
+"""Compare /callback throughput and latency of the web server runtime profiles.
+
+Run in project root directory:
+    python -m benchmarks.server_profiles --requests 5000 --concurrency 64
+
+Every profile (server_profile of config.yml) is served by its own process, as the event
+loop can only be picked once per process, against the same stand-ins of the LINE API and
+Discord webhooks. This process sends signed webhook requests over keep-alive connections
+and measures how fast they are answered.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks import fake_discord, fake_line, load_generator
+from benchmarks.common import REPO_ROOT, DeliveryRecorder, ServerThread, free_port, percentile
+
+CHANNEL_SECRET = 'benchmark-channel-secret'
+BOUND_GROUPS = 10
+WARMUP_REQUESTS = 200
+# Prefix of the line a server process prints once it accepts requests
+READY = 'ready: '
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', default='standard,performance',
+                        help="Comma separated server profiles to compare.")
+    parser.add_argument('--requests', type=int, default=5000, help="Requests per profile.")
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help="Requests in flight at once, each on its own connection.")
+    parser.add_argument('--events-per-request', type=int, default=1)
+    parser.add_argument('--bound-ratio', type=float, default=0.0,
+                        help="Share of events from bound groups, which are forwarded to the fake "
+                             "Discord. The others are only filtered, so the server itself is measured.")
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--keep-alive', type=int, default=15, help="server_keep_alive_seconds.")
+    parser.add_argument('--limit-concurrency', type=int, default=0,
+                        help="server_limit_concurrency, 0 for no limit.")
+    parser.add_argument('--json', help="Also write the results to this file.")
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--discord-base', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def prepare_workdir(args, profile: str, line_base: str, port: int) -> str:
+    """Create the working directory of a server process, with config and bindings."""
+    workdir = tempfile.mkdtemp(prefix=f'line-discord-{profile}-')
+    with open(os.path.join(workdir, 'config.yml'), 'w', encoding='utf8') as file:
+        json.dump({
+            'line_channel_access_token': 'benchmark-access-token',
+            'line_channel_secret': CHANNEL_SECRET,
+            'discord_bot_token': 'benchmark-bot-token',
+            'webhook_port': port,
+            'bot_hosted_by': 'benchmark',
+            'line_bot_invite_link': '',
+            'discord_bot_invite_link': '',
+            'log_level': 'WARNING',
+            'line_api_endpoint': line_base,
+            'line_data_api_endpoint': line_base,
+            'server_profile': profile,
+            'server_backlog': args.backlog,
+            'server_keep_alive_seconds': args.keep_alive,
+            'server_limit_concurrency': args.limit_concurrency,
+        }, file)
+    bindings = [{
+        'sub_num': index + 1,
+        'folder_name': f'bench_{index}',
+        'line_group_id': f'Cbound{index:04d}',
+        'line_group_name': f'bench {index}',
+        'discord_channel_id': 900000 + index,
+        'discord_channel_name': f'bench-{index}',
+        'discord_channel_webhook': f'https://discord.com/api/webhooks/{10 ** 17 + index}/{"b" * 68}',
+    } for index in range(BOUND_GROUPS)]
+    with open(os.path.join(workdir, 'sync_channels.json'), 'w', encoding='utf8') as file:
+        json.dump(bindings, file)
+    return workdir
+
+
+def build_bodies(args, count: int, start: int) -> list[tuple[str, str]]:
+    """Signed webhook bodies, with `bound_ratio` of the events from bound groups."""
+    bodies = []
+    for index in range(start, start + count):
+        events = []
+        for offset in range(args.events_per_request):
+            seq = index * args.events_per_request + offset
+            if int((seq + 1) * args.bound_ratio) > int(seq * args.bound_ratio):
+                group_id = f'Cbound{seq % BOUND_GROUPS:04d}'
+            else:
+                group_id = f'Cother{seq % 500:028d}'
+            events.append(load_generator.build_event('text', seq, group_id, f'U{seq}'))
+        body = load_generator.build_body(events)
+        bodies.append((body, load_generator.sign(CHANNEL_SECRET, body)))
+    return bodies
+
+
+async def send_all(url: str, bodies: list, concurrency: int) -> tuple[list, dict, float]:
+    """Post the bodies with `concurrency` clients, each keeping its connection open.
+
+    :return: Latencies in seconds, count per HTTP status and the elapsed seconds.
+    """
+    latencies = []
+    statuses = {}
+    queue = iter(bodies)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async def client(session: aiohttp.ClientSession):
+        for body, signature in queue:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, data=body.encode('utf-8'), headers={
+                        'Content-Type': 'application/json', 'X-Line-Signature': signature}) as response:
+                    await response.read()
+                    status = response.status
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, statuses, elapsed
+
+
+def rss_of(pid: int) -> float:
+    """Resident set size of another process in MiB, 0 if unknown."""
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf8') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+async def measure(args, profile: str, line_base: str, discord_base: str) -> dict:
+    port = free_port()
+    workdir = prepare_workdir(args, profile, line_base, port)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT,
+                                                                     os.environ.get('PYTHONPATH')])))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.server_profiles', '--serve', profile,
+         '--port', str(port), '--discord-base', discord_base],
+        cwd=workdir, env=env, stdout=subprocess.PIPE, text=True)
+    try:
+        runtime = ''
+        while not runtime.startswith(READY):
+            runtime = await asyncio.to_thread(process.stdout.readline)
+            if not runtime:
+                raise RuntimeError(f"server of profile {profile} exited with {process.wait()}")
+        runtime = runtime[len(READY):]
+        url = f'http://127.0.0.1:{port}/callback'
+        await send_all(url, build_bodies(args, WARMUP_REQUESTS, 0), args.concurrency)
+        bodies = build_bodies(args, args.requests, WARMUP_REQUESTS)
+        latencies, statuses, elapsed = await send_all(url, bodies, args.concurrency)
+        rss = rss_of(process.pid)
+    finally:
+        process.terminate()
+        await asyncio.to_thread(process.wait)
+    return {'profile': profile, 'runtime': runtime.strip(), 'requests': len(bodies),
+            'requests_per_second': round(len(bodies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'statuses': {str(status): count for status, count in statuses.items()},
+            'rss_mib': round(rss, 1)}
+
+
+async def serve(args):
+    """Run the webhook server with a profile, in the working directory of `measure`."""
+    import discord.http
+    import uvicorn
+
+    discord.http.Route.BASE = f'{args.discord_base}/api/v10'
+    import utilities  # noqa: F401, imported before cache like main.py to avoid a cycle
+    import server_runtime
+    from cache import sync_channels_cache
+    sync_channels_cache.load_all_sync_channels()
+    import line_bot
+
+    server = uvicorn.Server(server_runtime.server_config(line_bot.app, '127.0.0.1', args.port,
+                                                         log_level='warning'))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    print(f"{READY}{type(asyncio.get_running_loop()).__module__.split('.')[0]} loop, "
+          f"{server_runtime.http_implementation()} parser", flush=True)
+    await serving
+
+
+def main():
+    args = parse_args()
+    if args.serve:
+        sys.path.insert(0, REPO_ROOT)
+        os.environ.setdefault('PYTHONUNBUFFERED', '1')
+        import utilities  # noqa: F401
+        import server_runtime
+        server_runtime.install_event_loop(args.serve)
+        asyncio.run(serve(args))
+        return
+
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        # A faster client leaves more room to the server, it is the same for every profile
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    line_server = ServerThread(fake_line.create_app(DeliveryRecorder()))
+    discord_server = ServerThread(fake_discord.create_app(DeliveryRecorder()))
+    line_server.start()
+    discord_server.start()
+    results = []
+    for profile in (value.strip() for value in args.profiles.split(',')):
+        results.append(asyncio.run(measure(args, profile, line_server.base_url,
+                                           discord_server.base_url)))
+    line_server.stop()
+    discord_server.stop()
+
+    print(f"{'profile':<12} {'runtime':<28} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'RSS MiB':>8}  statuses")
+    print('-' * 90)
+    for result in results:
+        print(f"{result['profile']:<12} {result['runtime']:<28} {result['requests_per_second']:>8} "
+              f"{result['p50_ms']:>8} {result['p99_ms']:>8} {result['rss_mib']:>8}  "
+              f"{result['statuses']}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 import threading
-from typing import Dict, Any, Optional
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Any, NamedTuple, Optional, Tuple
 
 import utilities as utils
 
+# Name of the LINE account configured by line_channel_access_token/line_channel_secret
+DEFAULT_LINE_ACCOUNT = 'default'
+
 
 class SyncChannelsCache:
     _instance = None
@@ -17,28 +22,74 @@ class SyncChannelsCache:
                     # Maps LINE group IDs & Discord channel IDs to sub_nums
                     cls._instance.line_group_ids: Dict[str, int] = {}
                     cls._instance.discord_channel_ids: Dict[int, int] = {}
+                    # Maps LINE group IDs to the name of the LINE account bound to them
+                    cls._instance.line_accounts: Dict[str, str] = {}
         return cls._instance
 
     def load_all_sync_channels(self):
         """Load all sync channels into cache."""
-        sync_channels = utils.read_sync_channels()
-        for entry in sync_channels:
-            sub_num = entry['sub_num']
-            self.cache[sub_num] = entry
-            self.line_group_ids[entry['line_group_id']] = sub_num
-            self.discord_channel_ids[entry['discord_channel_id']] = sub_num
+        self.apply(utils.read_sync_channels())
         print(f"Successfully loaded {len(self.cache)} sync channels into cache.")
 
+    def apply(self, entries: list) -> tuple[int, int, int]:
+        """Bring the cache in line with a full list of sync channels, changing only the difference.
+
+        Entries are compared by sub_num. Lookups running meanwhile see every binding either
+        before or after its change: an entry is put into `cache` before the indexes point to
+        it, and taken out of the indexes before it leaves `cache`.
+
+        :param list entries: Sync channels as stored in sync_channels.json.
+        :return tuple: Numbers of added, removed and changed sync channels.
+        """
+        new = {entry['sub_num']: entry for entry in entries}
+        added = removed = changed = 0
+        with self._lock:
+            for sub_num in [sub_num for sub_num in self.cache if sub_num not in new]:
+                self._unindex(self.cache[sub_num])
+                del self.cache[sub_num]
+                removed += 1
+            for sub_num, entry in new.items():
+                current = self.cache.get(sub_num)
+                if current == entry:
+                    if self.line_group_ids.get(entry['line_group_id']) is None or \
+                            self.discord_channel_ids.get(entry['discord_channel_id']) is None:
+                        # Was shadowed by a removed sync channel of the same group or channel
+                        self._index(entry)
+                    continue
+                if current is None:
+                    added += 1
+                else:
+                    changed += 1
+                    if current['line_group_id'] != entry['line_group_id'] or \
+                            current['discord_channel_id'] != entry['discord_channel_id']:
+                        self._unindex(current)
+                self.cache[sub_num] = entry
+                self._index(entry)
+        return added, removed, changed
+
+    def _index(self, entry: Dict[str, Any]):
+        self.line_accounts[entry['line_group_id']] = entry.get('line_account', DEFAULT_LINE_ACCOUNT)
+        self.line_group_ids[entry['line_group_id']] = entry['sub_num']
+        self.discord_channel_ids[entry['discord_channel_id']] = entry['sub_num']
+
+    def _unindex(self, entry: Dict[str, Any]):
+        # Only drop index entries still pointing at this sync channel
+        if self.line_group_ids.get(entry['line_group_id']) == entry['sub_num']:
+            del self.line_group_ids[entry['line_group_id']]
+            self.line_accounts.pop(entry['line_group_id'], None)
+        if self.discord_channel_ids.get(entry['discord_channel_id']) == entry['sub_num']:
+            del self.discord_channel_ids[entry['discord_channel_id']]
+
     def get_dc_webhook_by_line_group_id(self, line_group_id: str) -> Optional[str]:
         """Get Discord webhook by LINE group ID.
 
         :param str line_group_id: The LINE group ID to look up.
         :return: Discord webhook or None if not found.
         """
-        sub_num = self.line_group_ids.get(line_group_id)
-        if sub_num is None:
+        entry = self.cache.get(self.line_group_ids.get(line_group_id))
+        if entry is None:
             return None
-        return self.cache[sub_num]['discord_channel_webhook']
+        return entry['discord_channel_webhook']
 
     def get_info_by_dc_channel_id(self, dc_channel_id: int) -> Optional[Dict[str, Any]]:
         """Get sync channel information by Discord channel ID.
@@ -46,10 +97,7 @@ class SyncChannelsCache:
         :param int dc_channel_id: The Discord channel ID to look up.
         :return: Dict with sync channel information or None if not found.
         """
-        sub_num = self.discord_channel_ids.get(dc_channel_id)
-        if sub_num is None:
-            return None
-        return self.cache[sub_num]
+        return self.cache.get(self.discord_channel_ids.get(dc_channel_id))
 
     def get_info_by_line_group_id(self, line_group_id: str) -> Optional[Dict[str, Any]]:
         """Get sync channel information by LINE group ID.
@@ -57,42 +105,413 @@ class SyncChannelsCache:
         :param str line_group_id: The LINE group ID to look up.
         :return: Dict with sync channel information or None if not found.
         """
-        sub_num = self.line_group_ids.get(line_group_id)
-        if sub_num is None:
-            return None
-        return self.cache[sub_num]
+        return self.cache.get(self.line_group_ids.get(line_group_id))
 
     def add_sync_channel(self, sub_num: int, folder_name: str, line_group_id: str,
                          line_group_name: str, discord_channel_id: int, discord_channel_name: str,
-                         discord_channel_webhook: str):
+                         discord_channel_webhook: str, line_account: str = DEFAULT_LINE_ACCOUNT):
         """Add a new sync channel to the cache."""
-        self.cache[sub_num] = {
+        entry = {
             'sub_num': sub_num,
             'folder_name': folder_name,
             'line_group_id': line_group_id,
             'line_group_name': line_group_name,
             'discord_channel_id': discord_channel_id,
             'discord_channel_name': discord_channel_name,
-            'discord_channel_webhook': discord_channel_webhook
+            'discord_channel_webhook': discord_channel_webhook,
+            'line_account': line_account
         }
-        self.line_group_ids[line_group_id] = sub_num
-        self.discord_channel_ids[discord_channel_id] = sub_num
+        with self._lock:
+            self.cache[sub_num] = entry
+            self._index(entry)
 
     def remove_sync_channel(self, line_group_id: str = None, discord_channel_id: int = None):
         """Remove a sync channel from the cache."""
-        if line_group_id:
-            sub_num = self.line_group_ids.pop(line_group_id, None)
-        elif discord_channel_id:
-            sub_num = self.discord_channel_ids.pop(discord_channel_id, None)
-        else:
+        with self._lock:
+            if line_group_id:
+                sub_num = self.line_group_ids.pop(line_group_id, None)
+            elif discord_channel_id:
+                sub_num = self.discord_channel_ids.pop(discord_channel_id, None)
+            else:
+                return
+
+            if sub_num is not None:
+                cache_entry = self.cache.get(sub_num)
+                if cache_entry:
+                    self.line_group_ids.pop(cache_entry['line_group_id'], None)
+                    self.line_accounts.pop(cache_entry['line_group_id'], None)
+                    self.discord_channel_ids.pop(cache_entry['discord_channel_id'], None)
+                    self.cache.pop(sub_num, None)
+
+
+class RecentEventIds:
+    """Bounded, time-windowed set of recently processed webhook event IDs."""
+
+    def __init__(self, window_seconds: float, max_size: int):
+        self.window_seconds = window_seconds
+        self.max_size = max_size
+        self.suppressed = 0
+        self._seen: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, event_id: Optional[str]) -> bool:
+        """Record an event ID.
+
+        :param str event_id: The webhookEventId of a LINE event, None is never a duplicate.
+        :return bool: True if the ID was already seen within the window.
+        """
+        if not event_id:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest_id, seen_at = next(iter(self._seen.items()))
+                if now - seen_at < self.window_seconds and len(self._seen) < self.max_size:
+                    break
+                self._seen.pop(oldest_id)
+            if event_id in self._seen:
+                self.suppressed += 1
+                return True
+            self._seen[event_id] = now
+            return False
+
+    def discard(self, event_id: Optional[str]):
+        """Forget an event ID, so a redelivery of the event is processed."""
+        with self._lock:
+            self._seen.pop(event_id, None)
+
+    def snapshot(self) -> list:
+        """The IDs still within the window, as [event ID, age in seconds], oldest first."""
+        now = time.monotonic()
+        with self._lock:
+            return [[event_id, round(now - seen_at, 3)] for event_id, seen_at in self._seen.items()
+                    if now - seen_at < self.window_seconds]
+
+    def restore(self, items: list):
+        """Add IDs from `snapshot`, e.g. of the previous run of the bot."""
+        now = time.monotonic()
+        with self._lock:
+            for event_id, age in items:
+                if age < self.window_seconds and event_id not in self._seen:
+                    self._seen[event_id] = now - age
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class MessageIds(NamedTuple):
+    """The IDs of one message forwarded between Discord and LINE."""
+    discord_message_id: int
+    discord_channel_id: int
+    line_message_id: str
+    line_group_id: str
+    # Quote token of the LINE message, to quote it in later messages to the group
+    quote_token: Optional[str]
+    # True if the message was sent in LINE and forwarded by the Discord webhook
+    from_line: bool
+    recorded_at: float
+
+
+class MessageIdIndex:
+    """Bounded, time-windowed mapping between the Discord and LINE IDs of forwarded messages.
+
+    A LINE message is recorded with the ID of the webhook message it became in Discord, a
+    Discord message with the ID of the message the bot sent to LINE. Either ID finds the
+    entry in O(1), so edits, deletes, unsends and quote replies are resolved without API
+    lookups. Entries are dropped oldest first once older than the window or beyond max_size.
+    """
+
+    def __init__(self, window_seconds: float, max_size: int):
+        self.window_seconds = window_seconds
+        self.max_size = max_size
+        # Guild of every Discord channel seen, for jump links
+        self.guild_ids: Dict[int, int] = {}
+        self._by_discord: OrderedDict[int, MessageIds] = OrderedDict()
+        self._by_line: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, discord_message_id: int, discord_channel_id: int, line_message_id: str,
+            line_group_id: str, quote_token: Optional[str] = None, from_line: bool = False):
+        """Record the IDs of a forwarded message.
+
+        :param int discord_message_id: ID of the Discord message, or of the webhook message.
+        :param int discord_channel_id: ID of the channel or thread of the Discord message.
+        :param str line_message_id: ID of the LINE message, or of the message the bot sent.
+        :param str line_group_id: The LINE group of the message.
+        :param str quote_token: Quote token of the LINE message, if it has one.
+        :param bool from_line: True if the message was sent in LINE.
+        """
+        entry = MessageIds(discord_message_id, discord_channel_id, line_message_id,
+                           line_group_id, quote_token, from_line, time.monotonic())
+        with self._lock:
+            self._evict(entry.recorded_at)
+            self._remove(self._by_discord.get(discord_message_id))
+            self._remove(self._get_by_line(line_message_id))
+            self._by_discord[discord_message_id] = entry
+            self._by_line[line_message_id] = discord_message_id
+
+    def by_discord(self, discord_message_id: int) -> Optional[MessageIds]:
+        """The entry of a Discord message ID, None if unknown or expired."""
+        with self._lock:
+            return self._fresh(self._by_discord.get(discord_message_id))
+
+    def by_line(self, line_message_id: str) -> Optional[MessageIds]:
+        """The entry of a LINE message ID, None if unknown or expired."""
+        with self._lock:
+            return self._fresh(self._get_by_line(line_message_id))
+
+    def pop_discord(self, discord_message_id: int) -> Optional[MessageIds]:
+        """Forget a Discord message, e.g. once deleted. Returns its entry."""
+        with self._lock:
+            entry = self._fresh(self._by_discord.get(discord_message_id))
+            self._remove(self._by_discord.get(discord_message_id))
+            return entry
+
+    def pop_line(self, line_message_id: str) -> Optional[MessageIds]:
+        """Forget a LINE message, e.g. once unsent. Returns its entry."""
+        with self._lock:
+            entry = self._fresh(self._get_by_line(line_message_id))
+            self._remove(self._get_by_line(line_message_id))
+            return entry
+
+    def jump_url(self, entry: Optional[MessageIds]) -> Optional[str]:
+        """Link to the Discord message of an entry, None if its guild is unknown."""
+        if entry is None:
+            return None
+        guild_id = self.guild_ids.get(entry.discord_channel_id)
+        if guild_id is None:
+            return None
+        return (f"https://discord.com/channels/{guild_id}/{entry.discord_channel_id}/"
+                f"{entry.discord_message_id}")
+
+    def snapshot(self) -> list:
+        """The entries still within the window, oldest first, with their age in seconds."""
+        now = time.monotonic()
+        with self._lock:
+            return [[*entry[:-1], round(now - entry.recorded_at, 3)]
+                    for entry in self._by_discord.values()
+                    if now - entry.recorded_at < self.window_seconds]
+
+    def restore(self, items: list):
+        """Add entries from `snapshot`, e.g. of the previous run of the bot."""
+        now = time.monotonic()
+        with self._lock:
+            for *fields, age in items:
+                if age >= self.window_seconds or fields[0] in self._by_discord:
+                    continue
+                entry = MessageIds(*fields, now - age)
+                self._by_discord[entry.discord_message_id] = entry
+                self._by_line[entry.line_message_id] = entry.discord_message_id
+            self._evict(now)
+
+    def _get_by_line(self, line_message_id: str) -> Optional[MessageIds]:
+        discord_message_id = self._by_line.get(line_message_id)
+        return None if discord_message_id is None else self._by_discord.get(discord_message_id)
+
+    def _fresh(self, entry: Optional[MessageIds]) -> Optional[MessageIds]:
+        if entry is None or time.monotonic() - entry.recorded_at >= self.window_seconds:
+            return None
+        return entry
+
+    def _remove(self, entry: Optional[MessageIds]):
+        if entry is None:
             return
+        self._by_discord.pop(entry.discord_message_id, None)
+        if self._by_line.get(entry.line_message_id) == entry.discord_message_id:
+            del self._by_line[entry.line_message_id]
+
+    def _evict(self, now: float):
+        while self._by_discord:
+            entry = next(iter(self._by_discord.values()))
+            if now - entry.recorded_at < self.window_seconds and len(self._by_discord) < self.max_size:
+                break
+            self._remove(entry)
+
+    def __len__(self):
+        return len(self._by_discord)
+
+
+class MemberProfiles:
+    """LINE profiles of group members, reused until they are older than ttl_seconds.
+
+    Profiles are stored with the epoch time they were fetched at, so entries restored
+    after a restart expire like the others.
+    """
+
+    def __init__(self, ttl_seconds: float, max_size: int = 20000):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._profiles: OrderedDict[tuple, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, group_id: str, user_id: str) -> Optional[Any]:
+        """The profile of a member, None if unknown or expired."""
+        with self._lock:
+            entry = self._profiles.get((group_id, user_id))
+            if entry is None or time.time() - entry[1] >= self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._profiles.move_to_end((group_id, user_id))
+            self.hits += 1
+            return entry[0]
+
+    def put(self, group_id: str, user_id: str, profile, fetched_at: Optional[float] = None):
+        """Store the profile of a member, fetched now unless `fetched_at` is given."""
+        with self._lock:
+            self._profiles[(group_id, user_id)] = (profile, fetched_at or time.time())
+            self._profiles.move_to_end((group_id, user_id))
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+
+    def items(self) -> list:
+        """The profiles still valid, as (group ID, user ID, profile, fetched at), oldest first."""
+        now = time.time()
+        with self._lock:
+            return [(group_id, user_id, profile, fetched_at)
+                    for (group_id, user_id), (profile, fetched_at) in self._profiles.items()
+                    if now - fetched_at < self.ttl_seconds]
+
+    def restore(self, items: list):
+        """Add profiles from `items`, e.g. of the previous run; newer ones are kept."""
+        now = time.time()
+        with self._lock:
+            for group_id, user_id, profile, fetched_at in items:
+                if now - fetched_at < self.ttl_seconds and (group_id, user_id) not in self._profiles:
+                    self._profiles[(group_id, user_id)] = (profile, fetched_at)
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+
+    def __len__(self):
+        return len(self._profiles)
+
+
+class ReplyTokens:
+    """Unused LINE reply tokens per LINE account and group, until they expire.
+
+    Every LINE event carries a reply token that can be used once, shortly after the event,
+    and only by the account that received the event. Replying costs no push quota, so
+    outgoing messages to a group use a token of a recent event when there is one.
+    """
+
+    def __init__(self, valid_seconds: float, max_per_group: int = 5):
+        self.valid_seconds = valid_seconds
+        self.max_per_group = max_per_group
+        self._tokens: Dict[Tuple[str, str], deque] = {}
+        self._lock = threading.Lock()
+
+    def add(self, account_name: str, group_id: str, reply_token: str, received_at: float):
+        """Remember the reply token of an event.
+
+        :param str account_name: The LINE account that received the event.
+        :param str group_id: The LINE group the event came from.
+        :param str reply_token: The reply token of the event.
+        :param float received_at: Epoch seconds of the event.
+        """
+        with self._lock:
+            tokens = self._tokens.setdefault((account_name, group_id),
+                                             deque(maxlen=self.max_per_group))
+            tokens.append((reply_token, received_at + self.valid_seconds))
+
+    def take(self, account_name: str, group_id: str) -> Optional[str]:
+        """Take the oldest still valid token of an account in a group, None if there is none."""
+        now = time.time()
+        with self._lock:
+            tokens = self._tokens.get((account_name, group_id))
+            while tokens:
+                reply_token, expires_at = tokens.popleft()
+                if expires_at > now:
+                    return reply_token
+            self._tokens.pop((account_name, group_id), None)
+            return None
+
+    def claim(self, account_name: str, group_id: str, reply_token: str) -> bool:
+        """Take a specific token, e.g. to answer the event it came with.
+
+        :return bool: False if the token was already used for another message.
+        """
+        with self._lock:
+            tokens = self._tokens.get((account_name, group_id), ())
+            for entry in tokens:
+                if entry[0] == reply_token:
+                    tokens.remove(entry)
+                    return True
+            return False
+
+    def has(self, account_name: str, group_id: str) -> bool:
+        """Whether an account has a token for a group that is still valid."""
+        now = time.time()
+        with self._lock:
+            return any(expires_at > now
+                       for _, expires_at in self._tokens.get((account_name, group_id), ()))
+
+
+class AuthorRender:
+    """How a Discord author is shown in LINE."""
+
+    def __init__(self, display_name: str, avatar_key: Optional[str]):
+        self.display_name = display_name
+        self.avatar_key = avatar_key
+        self.avatar_url: Optional[str] = None
+        self._headers: Dict[str, str] = {}
 
-        if sub_num is not None:
-            cache_entry = self.cache.get(sub_num)
-            if cache_entry:
-                self.line_group_ids.pop(cache_entry['line_group_id'], None)
-                self.discord_channel_ids.pop(cache_entry['discord_channel_id'], None)
-                self.cache.pop(sub_num, None)
+    def header(self, channel_name: str) -> str:
+        """Get the header line prefixed to text messages sent in a channel."""
+        header = self._headers.get(channel_name)
+        if header is None:
+            header = self._headers[channel_name] = f"{self.display_name}\n在 {channel_name}：\n"
+        return header
+
+
+class AuthorRenderCache:
+    """Bounded cache of AuthorRender per (guild, user).
+
+    An entry is rebuilt when the display name or avatar of the member changes. The cache
+    also remembers the last speaker of every LINE group, so the avatar is only sent when
+    the speaker or their avatar changes.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._renders: OrderedDict[tuple, AuthorRender] = OrderedDict()
+        self._last_speakers: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, guild_id: Optional[int], user_id: int, display_name: str,
+            avatar_key: Optional[str]) -> AuthorRender:
+        """Get the render of an author, rebuilding it if the member changed.
+
+        :param int guild_id: The Discord guild ID.
+        :param int user_id: The Discord user ID.
+        :param str display_name: The current display name of the member.
+        :param str avatar_key: Key of the current avatar asset, None if unknown.
+        :return AuthorRender: The render of the author.
+        """
+        key = (guild_id, user_id)
+        with self._lock:
+            render = self._renders.get(key)
+            if render is None or render.display_name != display_name \
+                    or render.avatar_key != avatar_key:
+                render = self._renders[key] = AuthorRender(display_name, avatar_key)
+                while len(self._renders) > self.max_size:
+                    self._renders.popitem(last=False)
+            self._renders.move_to_end(key)
+            return render
+
+    def speaker_changed(self, line_group_id: str, user_id: int, render: AuthorRender) -> bool:
+        """Record the speaker of a LINE group.
+
+        :param str line_group_id: The LINE group the message is sent to.
+        :param int user_id: The Discord user ID of the speaker.
+        :param AuthorRender render: The render of the speaker.
+        :return bool: True if the speaker or their avatar differs from the last message.
+        """
+        speaker = (user_id, render.avatar_key)
+        with self._lock:
+            changed = self._last_speakers.get(line_group_id) != speaker
+            self._last_speakers[line_group_id] = speaker
+        return changed
 
 
 # Create a global instance for easy importing
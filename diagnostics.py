@@ -0,0 +1,173 @@
+import asyncio
+import hmac
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from fastapi import APIRouter, Header, HTTPException
+
+import utilities as utils
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+HEARTBEAT_INTERVAL = 0.05
+SAMPLE_INTERVAL = 0.01
+MAX_STACK_DEPTH = 60
+RECENT_BLOCKS = 100
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ASYNC_CODE = inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+# Python frames of the loop running a callback, for callbacks that aren't coroutines. uvloop
+# runs its callbacks from C, asyncio.run's frame is then the last one of the loop.
+LOOP_FRAMES = {('events.py', '_run'), ('base_events.py', 'run_until_complete'),
+               ('runners.py', 'run')}
+
+router = APIRouter()
+
+
+class BlockingDetector:
+    """Find what blocks the event loop, cheap enough to stay on in production.
+
+    The loop bumps a heartbeat every HEARTBEAT_INTERVAL. A watchdog thread checks it and,
+    once the loop has not beaten for `threshold` seconds, samples the stack of the loop
+    thread every SAMPLE_INTERVAL until it beats again. Each block is recorded with its
+    duration, the function it was stuck in, the bot function that called it and the
+    handler (outermost bot frame) it ran under.
+
+    This is the watchdog form of asyncio's slow callback detection: asyncio debug mode
+    reports slow callbacks too, but costs too much to keep on and can't tell where inside
+    the callback the time went.
+    """
+
+    def __init__(self, threshold: float, output_path: str = ''):
+        self.threshold = threshold
+        self.output_path = output_path
+        self.blocks: deque = deque(maxlen=RECENT_BLOCKS)
+        self.total_blocks = 0
+        self.total_blocked = 0.0
+        self._last_beat = time.monotonic()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._stats_by_site: Counter = Counter()
+        self._time_by_site: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start watching the running loop. Call from the loop."""
+        if self._loop is not None or self.threshold <= 0:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat()
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        logger.info("已啟用事件迴圈阻塞偵測 (門檻 %.0f ms)", self.threshold * 1000)
+
+    def report(self) -> dict:
+        """Summary of recorded blocks, worst call sites first."""
+        with self._lock:
+            sites = [{'site': site, 'count': count,
+                      'total_ms': round(self._time_by_site[site] * 1000, 1)}
+                     for site, count in self._stats_by_site.items()]
+            recent = list(self.blocks)
+        sites.sort(key=lambda site: site['total_ms'], reverse=True)
+        return {'threshold_ms': round(self.threshold * 1000), 'blocks': self.total_blocks,
+                'blocked_ms': round(self.total_blocked * 1000, 1), 'sites': sites[:50],
+                'recent': recent}
+
+    def _beat(self):
+        self._last_beat = time.monotonic()
+        self._loop.call_later(HEARTBEAT_INTERVAL, self._beat)
+
+    def _watch(self):
+        while not self._loop.is_closed():
+            time.sleep(SAMPLE_INTERVAL)
+            beat = self._last_beat
+            if time.monotonic() - beat < HEARTBEAT_INTERVAL + self.threshold:
+                continue
+            samples = Counter()
+            while self._last_beat == beat and not self._loop.is_closed():
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    samples[_stack(frame)] += 1
+                time.sleep(SAMPLE_INTERVAL)
+            self._record(time.monotonic() - beat - HEARTBEAT_INTERVAL, samples)
+
+    def _record(self, duration: float, samples: Counter):
+        if not samples:
+            return
+        stack, _ = samples.most_common(1)[0]
+        own = [entry for entry in stack[_callback_start(stack):] if entry[0]]
+        block = {
+            'at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'duration_ms': round(duration * 1000, 1),
+            'blocked_in': _format(stack[-1]),
+            'call_site': _format(own[-1]) if own else None,
+            'handler': _format(own[0]) if own else None,
+            'samples': sum(samples.values()),
+            'stack': [_format(entry) for entry in stack[-15:]],
+        }
+        site = block['call_site'] or block['blocked_in']
+        with self._lock:
+            self.blocks.append(block)
+            self.total_blocks += 1
+            self.total_blocked += duration
+            self._stats_by_site[site] += 1
+            self._time_by_site[site] += duration
+        logger.warning("事件迴圈被 %s 阻塞 %.0f ms (處理程序: %s)", site, duration * 1000,
+                       block['handler'], extra={'rate_key': f'loop_block_{site}'})
+        if self.output_path:
+            try:
+                with open(self.output_path, 'a', encoding='utf8') as file:
+                    file.write(json.dumps(block, ensure_ascii=False) + '\n')
+            except OSError as e:
+                logger.warning("無法寫入診斷檔案 %s: %s", self.output_path, e)
+
+
+def _stack(frame) -> tuple:
+    """Stack of a frame, outermost first, as (own code?, file, function, line, coroutine?)
+    tuples."""
+    entries = []
+    while frame is not None and len(entries) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        filename = code.co_filename
+        own = filename.startswith(REPO_DIR) and 'site-packages' not in filename
+        entries.append((own, os.path.basename(filename), code.co_name, frame.f_lineno,
+                        bool(code.co_flags & ASYNC_CODE)))
+        frame = frame.f_back
+    return tuple(reversed(entries))
+
+
+def _callback_start(stack: tuple) -> int:
+    """Index of the first frame of the callback the loop is running.
+
+    Frames below it are startup code (main.py, asyncio.run), not handlers. The outermost
+    coroutine frame is the task being stepped, with the asyncio loop and uvloop alike.
+    """
+    for index, entry in enumerate(stack):
+        if entry[4]:
+            return index
+    return max((index + 1 for index, entry in enumerate(stack) if entry[1:3] in LOOP_FRAMES),
+               default=0)
+
+
+def _format(entry: tuple) -> str:
+    _, filename, function, line, _ = entry
+    return f'{filename}:{line} {function}'
+
+
+@router.get('/admin/diagnostics')
+async def diagnostics_report(authorization: str = Header(default='')):
+    """Report of event loop blocks, needs `Authorization: Bearer <admin_token>`."""
+    token = config['admin_token']
+    if not token or not hmac.compare_digest(authorization, f'Bearer {token}'):
+        raise HTTPException(status_code=404, detail="Not found.")
+    return detector.report()
+
+
+detector = BlockingDetector(config['loop_block_threshold_ms'] / 1000, config['diagnostics_file'])
@@ -1,3 +1,5 @@
+import asyncio
+import math
 import time
 import re
 
@@ -7,29 +9,95 @@ from discord.ext import commands
 import logging
 
 import line_bot
+import line_quota
+from line_accounts import accounts
+import log_config
+import media
+from archive import archiver
+from health import health
+from keyed_executor import GAUGE_LANES, KeyedExecutor
+from lifecycle import lifecycle
 import utilities as utils
-from cache import sync_channels_cache
+from cache import DEFAULT_LINE_ACCOUNT, AuthorRender, AuthorRenderCache, MessageIds, \
+    sync_channels_cache
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 config = utils.read_config()
 
 intents = discord.Intents.all() 
 client = commands.Bot(command_prefix="!", intents=discord.Intents.all())
+delivery_lanes = KeyedExecutor(config['discord_workers'], 'discord-message')
+author_renders = AuthorRenderCache()
 
-supported_image_format = ('.jpg', '.png', '.jpeg', '.webp')
-supported_video_format = ('.mp4','.webm','.ts')
+
+def may_send_digest(line_group_id: str) -> bool:
+    """Whether the digest of a LINE group can be sent now, for free with a reply token or
+    within the day budget of the quota."""
+    account = accounts.for_group(line_group_id)
+    return line_bot.reply_tokens.has(account.name, line_group_id) \
+        or accounts.can_send_digest(line_group_id)
+
+
+digests = line_quota.DigestBuffer(line_bot.send_texts, may_send_digest,
+                                  config['line_digest_interval_seconds'])
+
+
+def check_discord_gateway():
+    """Readiness check: the gateway connection is up."""
+    ready = client.is_ready() and not client.is_closed()
+    latency = client.latency if ready and math.isfinite(client.latency) else None
+    return ready, {'latency_ms': round(latency * 1000) if latency is not None else None}
+
+
+health.add_check('discord_gateway', check_discord_gateway)
+health.add_gauge('discord_messages', lambda: delivery_lanes.pending)
+health.add_gauge('discord_message_lanes', lambda: delivery_lanes.lane_depths(GAUGE_LANES))
+health.add_gauge('line_digest_lines', lambda: digests.pending())
+
+
+async def drain_messages():
+    """Wait for the queued Discord messages; held digests are saved by save_pending_messages."""
+    await delivery_lanes.join()
+
+
+def save_pending_messages() -> list:
+    """Take the Discord messages not sent to LINE yet, as digest lines for after a restart.
+
+    Pending edits and deletion notices are dropped.
+    """
+    items = [{'line_group_id': args[1], 'line': digest_line(args[0])}
+             for _, func, args in delivery_lanes.cancel_pending() if func is forward_message]
+    return digests.take() + items
+
+
+def restore_pending_messages(items: list):
+    """Queue the digest lines saved by `save_pending_messages`."""
+    for item in items:
+        digests.add(item['line_group_id'], item['line'])
+
+
+lifecycle.add_drain('discord_messages', drain_messages)
+lifecycle.add_state('line_digests', save_pending_messages, restore_pending_messages)
+lifecycle.add_close('media', media.processor.close)
+
+supported_image_format = ('.jpg', '.png', '.jpeg', '.webp', '.gif', '.bmp')
+supported_video_format = ('.mp4', '.webm', '.ts', '.mov', '.mkv')
 supported_audio_format = ('.m4a', '.wav', '.mp3', '.aac', '.flac', '.ogg', '.opus')
 
 async def on_ready():
     """Initialize discord bot."""
     logger.info("DC Bot is ready.")
+    # Guilds of the bound channels, for links to forwarded messages in LINE quote replies
+    for discord_channel_id in list(sync_channels_cache.discord_channel_ids):
+        channel = client.get_channel(discord_channel_id)
+        if channel is not None:
+            line_bot.message_ids.guild_ids[channel.id] = channel.guild.id
     try:
         synced = await client.tree.sync()
-        logger.info(f"Synced {synced} commands.")
+        logger.info("Synced %s commands.", synced)
     except Exception as e:
-        logger.error(f"Failed to sync commands: {e}")
+        logger.error("Failed to sync commands: %s", e)
 
 @app_commands.describe()
 async def about(interaction: discord.Interaction):
@@ -99,21 +167,22 @@ async def help(interaction: discord.Interaction):
 
 @app_commands.describe(binding_code="輸入你的綁定碼")
 async def link(interaction: discord.Interaction, binding_code: int):
-    logger.debug(f"收到 /link 指令，綁定碼: {binding_code}")
+    logger.debug("收到 /link 指令，綁定碼: %s", binding_code)
     binding_info = utils.get_binding_code_info(str(binding_code))
     if binding_info is None:
         reply_message = "綁定失敗, 該綁定碼輸入錯誤或格式不正確, 請再試一次."
-        logger.warning(f"綁定失敗，無效綁定碼: {binding_code}")
+        logger.warning("綁定失敗，無效綁定碼: %s", binding_code)
         await interaction.response.send_message(reply_message, ephemeral=True)
     elif binding_info['expiration'] < time.time():
         utils.remove_binding_code(binding_code)
         reply_message = "綁定失敗, 此綁定碼已逾5分鐘內無使用而過期, 請再試一次."
-        logger.warning(f"綁定失敗，綁定碼 {binding_code} 已過期")
+        logger.warning("綁定失敗，綁定碼 %s 已過期", binding_code)
         await interaction.response.send_message(reply_message, ephemeral=True)
     else:
         webhook = await interaction.channel.create_webhook(name="Line訊息同步")
         utils.add_new_sync_channel(binding_info['line_group_id'], binding_info['line_group_name'],
-                                   interaction.channel.id, interaction.channel.name, webhook.url)
+                                   interaction.channel.id, interaction.channel.name, webhook.url,
+                                   binding_info.get('line_account', DEFAULT_LINE_ACCOUNT))
         utils.remove_binding_code(binding_code)
         push_message = f"綁定成功！\n" \
                        f"     ----------------------\n" \
@@ -129,16 +198,17 @@ async def link(interaction: discord.Interaction, binding_code: int):
                         f"Line群組      ：{binding_info['line_group_name']}\n" \
                         f"========================================\n" \
                         f"目前支援連動備份：文字訊息、圖片、影片、音訊與其他附件"
-        logger.info(f"綁定成功: Discord 頻道 {interaction.channel.name} -> LINE 群組 {binding_info['line_group_name']}")
-        line_bot.push_message(binding_info['line_group_id'], push_message)
+        logger.info("綁定成功: Discord 頻道 %s -> LINE 群組 %s", interaction.channel.name, binding_info['line_group_name'])
+        # Answered first, the push may wait for the rate limit longer than Discord waits
         await interaction.response.send_message(reply_message)
+        await asyncio.to_thread(line_bot.push_message, binding_info['line_group_id'], push_message)
 
 @app_commands.describe()
 async def unlink(interaction: discord.Interaction):
     subscribed_info = sync_channels_cache.get_info_by_dc_channel_id(interaction.channel.id)
     if not subscribed_info:
         reply_message = "此頻道並未綁定任何Line群組！"
-        logger.warning(f"解除綁定失敗，頻道 {interaction.channel.id} 未綁定")
+        logger.warning("解除綁定失敗，頻道 %s 未綁定", interaction.channel.id)
         await interaction.response.send_message(reply_message, ephemeral=True)
     else:
         reply_message = f"**【LINE ⇄ Discord - 解除連動備份！】**\n\n" \
@@ -173,9 +243,12 @@ class UnlinkConfirmation(discord.ui.View):
                         f"========================================\n" \
                         f"執行者：{interaction.user.display_name}\n"
         self.stop()
-        logger.info(f"解除綁定成功: Discord 頻道 {self.subscribed_info['discord_channel_name']} -> LINE 群組 {self.subscribed_info['line_group_name']}")
-        line_bot.push_message(self.subscribed_info['line_group_id'], push_message)
+        logger.info("解除綁定成功: Discord 頻道 %s -> LINE 群組 %s", self.subscribed_info['discord_channel_name'], self.subscribed_info['line_group_name'])
         await interaction.response.send_message(reply_message)
+        # The group is unbound now, so its account is taken from the removed binding
+        account = accounts.get(self.subscribed_info.get('line_account', DEFAULT_LINE_ACCOUNT))
+        await asyncio.to_thread(line_bot.push_message, self.subscribed_info['line_group_id'],
+                                push_message, account)
 
     @discord.ui.button(label="取消操作", style=discord.ButtonStyle.primary)
     async def unlink_cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -187,64 +260,258 @@ class UnlinkConfirmation(discord.ui.View):
 @client.event
 async def on_message(message):
     """Handle message event."""
-    logger.info(f"接收到訊息: {message.content}, 來自: {message.author.name}, 頻道: {message.channel.id} 提及:{message.mentions}{message.channel_mentions}{message.role_mentions}")
+    logger.info("接收到訊息: %s, 來自: %s, 頻道: %s 提及:%s%s%s", log_config.content(message.content),
+                message.author.name, message.channel.id, message.mentions,
+                message.channel_mentions, message.role_mentions)
     if message.author.bot:
         logger.debug("訊息來自機器人自身或其他非人類使用者，已忽略回音")
         await client.process_commands(message)
         return
-    if message.channel.type == discord.ChannelType.public_thread or message.channel.type == discord.ChannelType.news_thread:
-        subscribed_info = sync_channels_cache.get_info_by_dc_channel_id(message.channel.parent_id)
-    else:
-        subscribed_info = sync_channels_cache.get_info_by_dc_channel_id(message.channel.id)
-
+    subscribed_info = channel_subscription(message.channel)
     if not subscribed_info:
-        logger.warning(f"未找到頻道 {message.channel.id} 的訂閱資訊")
+        logger.warning("未找到頻道 %s 的訂閱資訊", message.channel.id)
+        await client.process_commands(message)
+        return
+    if lifecycle.draining:
+        # Discord doesn't redeliver messages, so they are kept as digest lines instead
+        digests.add(subscribed_info['line_group_id'], digest_line(message))
+        logger.info("關機中，訊息併入摘要: 群組 %s", subscribed_info['line_group_id'])
         await client.process_commands(message)
         return
-    line_group_id = subscribed_info['line_group_id']
-    author = message.author.display_name
-    logger.debug(f"準備傳送訊息到 LINE 群組 {line_group_id}, 作者: {author}")
+    line_bot.message_ids.guild_ids[message.channel.id] = message.guild.id
+    delivery_lanes.submit(subscribed_info['discord_channel_id'], forward_message, message,
+                          subscribed_info['line_group_id'], subscribed_info['folder_name'])
+    await client.process_commands(message)
+
+
+def channel_subscription(channel) -> dict | None:
+    """The binding of a Discord channel, or of the parent channel of a thread."""
+    if channel.type == discord.ChannelType.public_thread or channel.type == discord.ChannelType.news_thread:
+        return sync_channels_cache.get_info_by_dc_channel_id(channel.parent_id)
+    return sync_channels_cache.get_info_by_dc_channel_id(channel.id)
+
+
+@client.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    """Send the new text of an edited Discord message to LINE, quoting the first one."""
+    message = payload.message
+    if message.author.bot or message.edited_at is None:
+        return
+    if payload.cached_message is not None and payload.cached_message.content == message.content:
+        # Embeds of links were added, the text didn't change
+        return
+    entry = line_bot.message_ids.by_discord(payload.message_id)
+    subscribed_info = channel_subscription(message.channel) if entry else None
+    if not subscribed_info or lifecycle.draining:
+        return
+    delivery_lanes.submit(subscribed_info['discord_channel_id'], forward_edit, message, entry,
+                          subscribed_info['folder_name'])
+
+
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    """Tell the LINE group that a forwarded Discord message was deleted."""
+    entry = line_bot.message_ids.pop_discord(payload.message_id)
+    if entry is None or entry.from_line or lifecycle.draining:
+        # Deleting the Discord copy of a LINE message leaves the original in LINE
+        return
+    subscribed_info = sync_channels_cache.get_info_by_line_group_id(entry.line_group_id)
+    if subscribed_info:
+        delivery_lanes.submit(subscribed_info['discord_channel_id'], forward_delete, entry,
+                              subscribed_info['folder_name'])
+
+
+def digest_line(message, author: str = None) -> str:
+    """A Discord message as one line of a digest, with links to its attachments.
+
+    :param message: The Discord message.
+    :param str author: Display name of the author, the one of the message if None.
+    """
+    summary = render_mentions(message) or ''
+    for attachment in message.attachments:
+        summary += f" [{attachment.title or attachment.filename}] {attachment.url}"
+    return f"{author or message.author.display_name}：{summary.strip()}"
+
+
+async def push_decision(line_group_id: str, folder_name: str) -> str:
+    """Whether a message to a LINE group is sent now (line_quota.SEND) or throttled."""
+    # A reply token of recent LINE activity makes the message free. If it is gone by the
+    # time of sending, send_messages checks the quota and raises line_quota.QuotaExhausted.
+    account = accounts.for_group(line_group_id)
+    if line_bot.reply_tokens.has(account.name, line_group_id):
+        return line_quota.SEND
+    return await asyncio.to_thread(account.quota.decide, line_group_id, folder_name)
+
+
+def remember_sent(message, line_group_id: str, sent):
+    """Record the LINE copy of a Discord message, for its later edits and deletion."""
+    if sent is not None and line_bot.message_ids.by_discord(message.id) is None:
+        line_bot.message_ids.add(message.id, message.channel.id, sent.id, line_group_id,
+                                 sent.quote_token)
+
+
+async def forward_message(message, line_group_id: str, folder_name: str):
+    """Forward a Discord message to its bound LINE group.
+
+    Runs on the lane of the bound channel in `delivery_lanes`, so messages of one channel
+    reach LINE in order while other channels proceed in parallel.
+
+    :param message: The Discord message.
+    :param str line_group_id: The bound LINE group ID.
+    :param str folder_name: Folder name of the binding.
+    """
+    render = author_renders.get(getattr(message.guild, 'id', None), message.author.id,
+                                message.author.display_name,
+                                getattr(message.author.display_avatar, 'key', None))
+    author = render.display_name
+    logger.debug("準備傳送訊息到 LINE 群組 %s, 作者: %s", line_group_id, author)
+    archiver.record(folder_name, 'discord_to_line', author, message.content,
+                    'attachment' if message.attachments else 'text', str(message.id),
+                    urls=[attachment.url for attachment in message.attachments])
     try:
-        #await line_bot.send_author_avatar(line_group_id,re.sub(r'\?.*$', '', message.author.avatar.url))
+        decision = await push_decision(line_group_id, folder_name)
+        if decision != line_quota.SEND:
+            digests.add(line_group_id, digest_line(message, author))
+            logger.info("LINE 訊息額度節流中 (%s)，訊息併入摘要: 群組 %s", decision, line_group_id)
+            return
+        # Sent with the first push of the message only
+        avatar_url = await author_avatar_url(message, line_group_id, render)
         if message.attachments:
             for attachment in message.attachments:
-                logger.debug(f"處理附件: {attachment}")
+                logger.debug("處理附件: %s", attachment)
                 try:
                     if attachment.filename.lower().endswith(supported_image_format):
                         message_content = message.content or f"{author}\n在 {message.channel}\n傳送了圖片 {attachment.title}"
-                        line_bot.send_image_message(line_group_id, message_content, attachment.url)
+                        image_url, preview_url = await media.processor.prepare_image(attachment.url)
+                        sent = await asyncio.to_thread(line_bot.send_image_message, line_group_id,
+                                                       message_content, image_url, preview_url,
+                                                       avatar_url)
+                        avatar_url = None
                     elif attachment.filename.lower().endswith(supported_video_format):
                         message_content = message.content or f"{author}\n在 {message.channel}\n傳送了影片 {attachment.title}"
-                        thumbnail_path = attachment.proxy_url #取得縮圖過於麻煩，有檔名提示即可
-                        line_bot.send_video_message(line_group_id, message_content, attachment.url, thumbnail_path)
+                        video_url, thumbnail_path = await media.processor.prepare_video(
+                            attachment.url, attachment.proxy_url)
+                        sent = await asyncio.to_thread(line_bot.send_video_message, line_group_id,
+                                                       message_content, video_url, thumbnail_path,
+                                                       avatar_url)
+                        avatar_url = None
 
                     elif attachment.filename.lower().endswith(supported_audio_format):
                         message_content = message.content or f"{author}\n在 {message.channel}\n傳送了音訊 {attachment.title}"
-                        line_bot.send_audio_message(line_group_id, message_content, attachment.url, attachment.size/128)
+                        audio_url, duration = await media.processor.prepare_audio(attachment.url)
+                        # Without a probed duration, estimate it from the size at 128 kbps
+                        duration = duration or attachment.size // 16
+                        sent = await asyncio.to_thread(line_bot.send_audio_message, line_group_id,
+                                                       message_content, audio_url, duration,
+                                                       avatar_url)
+                        avatar_url = None
                     else:
-                        message_content = f"{message.name}\n在 {message.channel}\n 傳送了檔案 {attachment.title}\n (URL: {attachment.url})"
-                        line_bot.send_image_message(line_group_id, message_content, message.author.avatar)
-                        line_bot.send_text_message(line_group_id, message_content)
+                        message_content = f"{author}\n在 {message.channel}\n 傳送了檔案 {attachment.title}\n (URL: {attachment.url})"
+                        sent = await asyncio.to_thread(line_bot.send_text_message, line_group_id,
+                                                       message_content, avatar_url)
+                        avatar_url = None
+                    remember_sent(message, line_group_id, sent)
+                except line_quota.QuotaExhausted:
+                    raise
                 except Exception as e:
-                    logger.error(f"處理 Discord 附件時發生錯誤: {e}")
+                    logger.error("處理 Discord 附件時發生錯誤: %s", e)
         else:
-            message_content = message.content
-            if message.mentions:
-                for mention in message.mentions:
-                    message_content = re.sub(rf'<@!?{mention.id}>',"@"+mention.display_name, message_content)
-            if message.role_mentions:
-                for role in message.role_mentions:
-                    message_content = re.sub(rf'<@&{role.id}>', "@"+role.name, message_content)
-            if message.channel_mentions:
-                for channel in message.channel_mentions:
-                    message_content = re.sub(rf'<#{channel.id}>', "#"+channel.name, message_content)
-            message_content = (f"{author}\n在 {message.channel.name}：\n{message_content}") or f"{author}: [無文字內容]"
-            logger.info(f"傳送文字訊息: {message_content}")
-            line_bot.send_text_message(line_group_id, message_content)
+            message_content = render.header(message.channel.name) + render_mentions(message)
+            logger.info("傳送文字訊息: %s", log_config.content(message_content))
+            sent = await asyncio.to_thread(line_bot.send_text_message, line_group_id,
+                                           message_content, avatar_url)
+            remember_sent(message, line_group_id, sent)
 
+    except line_quota.QuotaExhausted:
+        # The reply token push_decision counted on was gone by the time of sending
+        digests.add(line_group_id, digest_line(message, author))
+        logger.info("LINE 訊息額度不足，訊息併入摘要: 群組 %s", line_group_id)
     except Exception as e:
-        logger.error(f"處理 Discord 訊息時發生錯誤: {e}")
-    await client.process_commands(message)
+        logger.error("處理 Discord 訊息時發生錯誤: %s", e)
+
+
+async def forward_edit(message, entry: MessageIds, folder_name: str):
+    """Send the new text of an edited Discord message to LINE, quoting its previous copy.
+
+    Runs on the lane of the bound channel, after the message itself was forwarded.
+
+    :param message: The edited Discord message.
+    :param MessageIds entry: The IDs of the message and its LINE copy.
+    :param str folder_name: Folder name of the binding.
+    """
+    render = author_renders.get(getattr(message.guild, 'id', None), message.author.id,
+                                message.author.display_name,
+                                getattr(message.author.display_avatar, 'key', None))
+    line_group_id = entry.line_group_id
+    try:
+        decision = await push_decision(line_group_id, folder_name)
+        if decision != line_quota.SEND:
+            digests.add(line_group_id, digest_line(message, f"{render.display_name}（已編輯）"))
+            return
+        message_content = render.header(message.channel.name) + "（已編輯）" + render_mentions(message)
+        sent = await asyncio.to_thread(line_bot.send_text_message, line_group_id,
+                                       message_content, None, entry.quote_token)
+        if sent is not None:
+            # Later edits quote the latest copy
+            line_bot.message_ids.add(message.id, entry.discord_channel_id, sent.id, line_group_id,
+                                     sent.quote_token)
+        logger.info("已傳送編輯後的訊息至 LINE 群組 %s", line_group_id)
+    except line_quota.QuotaExhausted:
+        digests.add(line_group_id, digest_line(message, f"{render.display_name}（已編輯）"))
+        logger.info("LINE 訊息額度不足，編輯後的訊息併入摘要: 群組 %s", line_group_id)
+    except Exception as e:
+        logger.error("傳送編輯後的 Discord 訊息時發生錯誤: %s", e)
+
+
+async def forward_delete(entry: MessageIds, folder_name: str):
+    """Tell a LINE group that a forwarded Discord message was deleted, quoting its copy.
+
+    The Messaging API can't unsend messages of the bot, so the copy stays in LINE.
+
+    :param MessageIds entry: The IDs of the deleted message and its LINE copy.
+    :param str folder_name: Folder name of the binding.
+    """
+    try:
+        if await push_decision(entry.line_group_id, folder_name) != line_quota.SEND:
+            logger.info("LINE 訊息額度節流中，略過刪除通知: 群組 %s", entry.line_group_id)
+            return
+        await asyncio.to_thread(line_bot.send_text_message, entry.line_group_id,
+                                "（此訊息已於 Discord 刪除）", None, entry.quote_token)
+    except line_quota.QuotaExhausted:
+        logger.info("LINE 訊息額度不足，略過刪除通知: 群組 %s", entry.line_group_id)
+    except Exception as e:
+        logger.error("傳送 Discord 訊息刪除通知時發生錯誤: %s", e)
+
+def render_mentions(message) -> str:
+    """Replace user, role and channel mentions in a message by their names."""
+    message_content = message.content
+    if message.mentions:
+        for mention in message.mentions:
+            message_content = re.sub(rf'<@!?{mention.id}>',"@"+mention.display_name, message_content)
+    if message.role_mentions:
+        for role in message.role_mentions:
+            message_content = re.sub(rf'<@&{role.id}>', "@"+role.name, message_content)
+    if message.channel_mentions:
+        for channel in message.channel_mentions:
+            message_content = re.sub(rf'<#{channel.id}>', "#"+channel.name, message_content)
+    return message_content
+
+async def author_avatar_url(message, line_group_id: str, render: AuthorRender) -> str | None:
+    """Get the avatar to send with a message, only when the speaker of the group changed.
+
+    :param message: The Discord message.
+    :param str line_group_id: The bound LINE group ID.
+    :param AuthorRender render: The cached render of the author.
+    :return str: URL of the resized avatar, None if it shouldn't be sent.
+    """
+    if not config['send_author_avatar'] or render.avatar_key is None:
+        return None
+    if not author_renders.speaker_changed(line_group_id, message.author.id, render):
+        return None
+    if render.avatar_url is None:
+        asset = message.author.display_avatar.replace(size=256, format='png')
+        render.avatar_url = await media.processor.prepare_avatar(asset.url)
+    return render.avatar_url
 
 if __name__ == '__main__':
     client.run(config.get('discord_bot_token'))
\ No newline at end of file
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+import utilities as utils
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+LAG_INTERVAL = 0.5
+LAG_WINDOW = 60
+
+router = APIRouter()
+
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes up, i.e. how long handlers block it.
+
+    A task sleeps LAG_INTERVAL seconds in a loop; any extra delay is time the loop spent
+    running something else without yielding. A warning is logged when it exceeds the
+    threshold.
+    """
+
+    def __init__(self, warn_seconds: float):
+        self.warn_seconds = warn_seconds
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._samples: deque[tuple[float, float]] = deque()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def snapshot(self) -> dict:
+        return {'lag_ms': round(self.lag * 1000, 1),
+                'max_lag_ms_1m': round(max((lag for _, lag in self._samples), default=0) * 1000, 1),
+                'max_lag_ms': round(self.max_lag * 1000, 1)}
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            now = loop.time()
+            self.lag = max(0.0, now - started - LAG_INTERVAL)
+            self.max_lag = max(self.max_lag, self.lag)
+            self._samples.append((now, self.lag))
+            while self._samples and self._samples[0][0] < now - LAG_WINDOW:
+                self._samples.popleft()
+            if self.lag > self.warn_seconds:
+                logger.warning("事件迴圈被阻塞 %.0f ms，請檢查是否有同步的處理程序", self.lag * 1000,
+                               extra={'rate_key': 'loop_lag'})
+
+
+class Health:
+    """Registry of the checks and queue depths reported by /healthz and /readyz.
+
+    Modules register what they know about without this module importing them:
+    `add_check` for readiness conditions and `add_gauge` for numbers such as queue depths.
+    Checks with an interval (e.g. calls to the LINE API) run in the background and
+    /readyz only reads their last result, so probes stay cheap.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.last_activity = time.monotonic()
+        self.lag_monitor = LoopLagMonitor(config['loop_lag_warn_ms'] / 1000)
+        self._checks: dict[str, tuple] = {}
+        self._results: dict[str, tuple[bool, object]] = {}
+        self._gauges: dict[str, object] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def add_check(self, name: str, func, interval: float | None = None):
+        """Register a readiness check.
+
+        :param str name: Name shown in /readyz.
+        :param func: Returns (ok, detail). Without an interval it is called on every probe
+            and must be cheap; with one it is called in a thread every `interval` seconds.
+        :param float interval: Seconds between background runs, None to run on every probe.
+        """
+        self._checks[name] = (func, interval)
+        if interval is not None:
+            self._results[name] = (False, 'not checked yet')
+            if self._tasks:
+                self._tasks.append(asyncio.create_task(self._run_check(name, func, interval)))
+
+    def add_gauge(self, name: str, func):
+        """Register a value reported by both probes, e.g. a queue depth."""
+        self._gauges[name] = func
+
+    def mark_activity(self):
+        """Record that a request was received, see keep_alive.keep_alive_task."""
+        self.last_activity = time.monotonic()
+
+    def start(self):
+        """Start the lag monitor and background checks. Call from the running loop."""
+        if self._tasks:
+            return
+        self.lag_monitor.start()
+        self._tasks = [self.lag_monitor._task]
+        for name, (func, interval) in self._checks.items():
+            if interval is not None:
+                self._tasks.append(asyncio.create_task(self._run_check(name, func, interval)))
+
+    def gauges(self) -> dict:
+        values = {}
+        for name, func in self._gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                values[name] = f'error: {e}'
+        return values
+
+    def readiness(self) -> tuple[bool, dict]:
+        checks = {}
+        for name, (func, interval) in self._checks.items():
+            if interval is not None:
+                ok, detail = self._results[name]
+            else:
+                try:
+                    ok, detail = func()
+                except Exception as e:
+                    ok, detail = False, str(e)
+            checks[name] = {'ok': ok, 'detail': detail}
+        return all(check['ok'] for check in checks.values()), checks
+
+    async def _run_check(self, name: str, func, interval: float):
+        while True:
+            try:
+                self._results[name] = await asyncio.to_thread(func)
+            except Exception as e:
+                self._results[name] = (False, str(e))
+            if not self._results[name][0]:
+                logger.warning("健康檢查失敗: %s, %s", name, self._results[name][1],
+                               extra={'rate_key': f'health_{name}'})
+            await asyncio.sleep(interval)
+
+
+@router.get('/healthz')
+async def healthz():
+    """Liveness: the process and its event loop are running."""
+    return {'status': 'ok', 'uptime_s': round(time.time() - health.started_at),
+            'loop': health.lag_monitor.snapshot(), 'queues': health.gauges()}
+
+
+@router.get('/readyz')
+async def readyz():
+    """Readiness: Discord is connected and the LINE API is reachable."""
+    ready, checks = health.readiness()
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={'status': 'ready' if ready else 'not ready', 'checks': checks,
+                                 'loop': health.lag_monitor.snapshot(),
+                                 'queues': health.gauges()})
+
+
+health = Health()
+
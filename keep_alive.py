@@ -1,21 +1,42 @@
 import aiohttp
 import asyncio
 import logging
+import time
+
+import utilities as utils
+from health import health
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+config = utils.read_config()
+
 async def keep_alive_task(webhook_url: str):
-    #每 14 分鐘訪問webhook以維持Render不下線。
-    async with aiohttp.ClientSession() as session:
+    """Ping our own /healthz after idle periods to keep hosts like Render from sleeping.
+
+    Real traffic keeps the host awake as well, so a ping is only sent once nothing was
+    received for keep_alive_idle_minutes.
+
+    :param str webhook_url: Public URL of the webhook server, empty to disable.
+    """
+    if not webhook_url:
+        logger.info("未設定 webhook_url，不啟用 Keep-alive")
+        return
+    idle_seconds = config['keep_alive_idle_minutes'] * 60
+    # Keep a path prefix of the webhook server, e.g. behind a reverse proxy
+    url = webhook_url.rstrip('/') + '/healthz'
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
         while True:
+            idle_for = time.monotonic() - health.last_activity
+            if idle_for < idle_seconds:
+                await asyncio.sleep(idle_seconds - idle_for)
+                continue
             try:
-                async with session.get(webhook_url) as response:
+                async with session.get(url) as response:
                     if response.status == 200:
-                        logger.info(f"Keep-alive: 成功訪問 webhook URL，狀態碼 {response.status}")
+                        logger.info("Keep-alive: 成功訪問 %s，狀態碼 %s", url, response.status)
                     else:
-                        logger.error(f"Keep-alive: 訪問 webhook URL 失敗，狀態碼 {response.status}")
-                await asyncio.sleep(14 * 60)
+                        logger.error("Keep-alive: 訪問 %s 失敗，狀態碼 %s", url, response.status)
+                health.mark_activity()
             except Exception as e:
-                logger.error(f"Keep-alive 失敗: {e}")
-                await asyncio.sleep(60)
\ No newline at end of file
+                logger.error("Keep-alive 失敗: %s", e)
+                await asyncio.sleep(60)
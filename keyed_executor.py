@@ -0,0 +1,148 @@
+import asyncio
+import inspect
+import itertools
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Deepest lanes reported by the /healthz gauges
+GAUGE_LANES = 10
+
+
+class KeyedExecutor:
+    """Run work in submission order per key, and in parallel across keys.
+
+    Every key (a LINE group ID or Discord channel ID) has its own FIFO lane, and a lane is
+    handed to at most one worker at a time, so work of one key never overlaps or
+    reorders. Lanes with pending work wait in a ready queue ordered by the priority of
+    their next item, then by when they became ready, so busy keys take turns with quiet
+    ones. Empty lanes are dropped, which keeps thousands of idle bindings free.
+
+    Coroutine functions run on the event loop; plain functions run on a thread pool of
+    the same size as the worker pool.
+    """
+
+    def __init__(self, workers: int, name: str):
+        self.workers = workers
+        self.name = name
+        self.pending = 0
+        self._lanes: dict[object, deque] = {}
+        self._sequence = itertools.count()
+        self._ready: asyncio.PriorityQueue | None = None
+        self._thread_pool: ThreadPoolExecutor | None = None
+        self._worker_tasks: list[asyncio.Task] = []
+        self._idle: asyncio.Event | None = None
+        self._running: set = set()
+
+    def submit(self, key, func, *args, priority: int = 0) -> asyncio.Future:
+        """Queue work on the lane of a key.
+
+        :param key: The ordering key.
+        :param func: Function or coroutine function, called with `args`.
+        :param int priority: Lower runs first when several lanes are ready.
+        :return asyncio.Future: Resolved with the result of `func`.
+        """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+            lane.append((priority, func, args, future))
+            self._schedule(key, lane)
+        else:
+            lane.append((priority, func, args, future))
+        self.pending += 1
+        self._idle.clear()
+        return future
+
+    def lane_depths(self, limit: int = None) -> dict:
+        """Number of queued items per key, including the running one, deepest first.
+
+        :param int limit: Report at most this many keys, None for all of them.
+        """
+        depths = sorted(((key, len(lane)) for key, lane in self._lanes.items()),
+                        key=lambda item: item[1], reverse=True)
+        return {str(key): depth for key, depth in depths[:limit]}
+
+    async def join(self):
+        """Wait until every submitted item has finished."""
+        if self._idle is not None:
+            await self._idle.wait()
+
+    def cancel_pending(self) -> list[tuple]:
+        """Take out every item that hasn't started, e.g. to save it at shutdown.
+
+        Their futures are cancelled; running items are left to finish.
+
+        :return list: (key, func, args) of the taken items, in submission order per key.
+        """
+        taken = []
+        for key in list(self._lanes):
+            lane = self._lanes[key]
+            keep = 1 if key in self._running else 0
+            while len(lane) > keep:
+                _, func, args, future = lane[keep]
+                del lane[keep]
+                taken.append((key, func, args))
+                future.cancel()
+                self.pending -= 1
+            if not lane:
+                del self._lanes[key]
+        if not self.pending and self._idle is not None:
+            self._idle.set()
+        return taken
+
+    def _schedule(self, key, lane: deque):
+        self._ready.put_nowait((lane[0][0], next(self._sequence), key, lane))
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, key, lane = await self._ready.get()
+            if self._lanes.get(key) is not lane:
+                # The lane was emptied by cancel_pending
+                continue
+            _, func, args, future = lane[0]
+            self._running.add(key)
+            try:
+                if inspect.iscoroutinefunction(func):
+                    result = await func(*args)
+                else:
+                    result = await loop.run_in_executor(self._thread_pool, func, *args)
+            except Exception as e:
+                logger.error("%s 執行工作時發生錯誤 (key=%s): %s", self.name, key, e,
+                             exc_info=True)
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._running.discard(key)
+                lane.popleft()
+                self.pending -= 1
+                if lane:
+                    self._schedule(key, lane)
+                else:
+                    del self._lanes[key]
+                if not self.pending:
+                    self._idle.set()
+
+    def _start(self):
+        if self._ready is not None:
+            return
+        self._ready = asyncio.PriorityQueue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._thread_pool = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix=self.name)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+
+def _consume_exception(future: asyncio.Future):
+    # Errors are already logged by the worker, callers may still await the future
+    if not future.cancelled():
+        future.exception()
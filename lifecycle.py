@@ -0,0 +1,166 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+
+import utilities as utils
+from health import health
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+
+class Lifecycle:
+    """Shut the bridge down without losing or duplicating messages.
+
+    Modules register what matters at shutdown without this module importing them:
+    `add_drain` for queues to wait on, `add_state` for work to persist when the queues
+    didn't empty in time and to restore at the next start, `add_close` for what to flush
+    or close last.
+
+    On SIGTERM/SIGINT the bridge first stops accepting work: `draining` is set, webhooks
+    are answered with 503 so LINE redelivers them later, and /readyz reports not ready.
+    It then waits up to `drain_seconds` for the queues, saves what is left to
+    `state_path`, and closes everything. A second signal skips the rest of the wait.
+
+    The state file is only removed by a shutdown that drained everything, and replaced by
+    one that saved new state. Work restored from it but not sent yet when the bot stops
+    again, or crashes, is therefore not lost.
+    """
+
+    def __init__(self, drain_seconds: float, state_path: str):
+        self.drain_seconds = drain_seconds
+        self.state_path = state_path
+        self.draining = False
+        self._drains: list[tuple[str, object]] = []
+        self._states: dict[str, tuple[object, object]] = {}
+        self._closes: list[tuple[str, object]] = []
+        self._stopping: asyncio.Task | None = None
+        self._hurry: asyncio.Event | None = None
+
+    def add_drain(self, name: str, func):
+        """Register a queue to wait on.
+
+        :param str name: Name used in logs.
+        :param func: Coroutine function returning once the queue is empty.
+        """
+        self._drains.append((name, func))
+
+    def add_state(self, name: str, save, restore):
+        """Register work to carry over a restart.
+
+        :param str name: Key in the state file.
+        :param save: Called after the drain, returns a list of JSON serializable items
+            still unsent and takes them out of the queue.
+        :param restore: Called with the saved items at the next start, from the event loop.
+        """
+        self._states[name] = (save, restore)
+
+    def add_close(self, name: str, func):
+        """Register a function or coroutine function to run once the queues are done."""
+        self._closes.append((name, func))
+
+    async def restore(self):
+        """Give the work saved by the last shutdown back to its owners.
+
+        Call at startup before serving webhooks and logging in to Discord, so the saved
+        work is queued ahead of new messages and the saved event IDs are known before
+        redeliveries come in.
+        """
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, encoding='utf8') as file:
+                state = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.error("無法讀取上次關機保存的工作 %s: %s", self.state_path, e)
+            return
+        for name, items in state.items():
+            if name not in self._states or not items:
+                continue
+            try:
+                self._states[name][1](items)
+                logger.info("已恢復上次關機時未完成的 %s: %s 筆", name, len(items))
+            except Exception as e:
+                logger.error("恢復 %s 失敗: %s", name, e, exc_info=True)
+
+    def request_stop(self, on_stopped=None):
+        """Start the shutdown, or skip the rest of the drain if it is already running.
+
+        :param on_stopped: Coroutine function run after everything registered is closed,
+            e.g. to stop the web server and the Discord client.
+        """
+        if self._stopping is None:
+            self._hurry = asyncio.Event()
+            self._stopping = asyncio.ensure_future(self.shutdown(on_stopped))
+        else:
+            logger.warning("再次收到停止訊號，不再等待處理中的訊息")
+            self._hurry.set()
+
+    async def shutdown(self, on_stopped=None):
+        """Stop accepting work, drain, save what is left and close."""
+        self.draining = True
+        self._hurry = self._hurry or asyncio.Event()
+        logger.info("開始關機: 停止接收新工作，最多等待 %s 秒處理中的訊息", self.drain_seconds)
+        await self._drain()
+        self._save()
+        for name, func in self._closes:
+            try:
+                if inspect.iscoroutinefunction(func):
+                    await func()
+                else:
+                    await asyncio.to_thread(func)
+            except Exception as e:
+                logger.warning("關閉 %s 時發生錯誤: %s", name, e)
+        if on_stopped is not None:
+            await on_stopped()
+        logger.info("已完成關機")
+
+    async def _drain(self):
+        if not self._drains:
+            return
+        tasks = {asyncio.ensure_future(func()): name for name, func in self._drains}
+        hurry = asyncio.ensure_future(self._hurry.wait())
+        pending = set(tasks)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_seconds
+        try:
+            while pending and not hurry.done() and loop.time() < deadline:
+                done, _ = await asyncio.wait(pending | {hurry}, timeout=deadline - loop.time(),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                pending -= done
+        finally:
+            hurry.cancel()
+            for task in pending:
+                task.cancel()
+        if pending:
+            logger.warning("關機期限內未處理完: %s，剩餘工作將保存至下次啟動",
+                           ', '.join(tasks[task] for task in pending))
+
+    def _save(self):
+        state = {}
+        failed = False
+        for name, (save, _) in self._states.items():
+            try:
+                items = save()
+            except Exception as e:
+                logger.error("保存 %s 失敗: %s", name, e, exc_info=True)
+                failed = True
+                continue
+            if items:
+                state[name] = items
+        if not state:
+            # Everything was sent, what the last shutdown saved is done too
+            if not failed and os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            return
+        utils.update_json(self.state_path, state)
+        logger.info("已保存未完成的工作至 %s: %s", self.state_path,
+                    ', '.join(f'{name} {len(items)} 筆' for name, items in state.items()))
+
+
+lifecycle = Lifecycle(config['shutdown_drain_seconds'], config['shutdown_state_file'])
+health.add_check('accepting_work', lambda: (not lifecycle.draining,
+                                            'shutting down' if lifecycle.draining else 'ok'))
@@ -0,0 +1,113 @@
+import contextvars
+import functools
+import logging
+import time
+
+from linebot.v3 import SignatureValidator
+from linebot.v3.messaging import ApiClient, Configuration, MessagingApi
+
+import line_quota
+import utilities as utils
+from cache import DEFAULT_LINE_ACCOUNT, sync_channels_cache
+from warm_start import warm_start
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+# The account whose webhook delivered the LINE event being handled
+current_account: contextvars.ContextVar['LineAccount'] = contextvars.ContextVar('line_account')
+
+
+class LineAccount:
+    """A LINE bot account (Messaging API channel) of the bridge.
+
+    Every account receives its webhooks on its own path, checked with its own channel
+    secret, and has its own rate limits and message quota. All calls of an account share
+    one API client, so its connections are reused instead of opened per request.
+    """
+
+    def __init__(self, name: str, access_token: str, channel_secret: str):
+        self.name = name
+        self.access_token = access_token
+        self.channel_secret = channel_secret
+        self.configuration = Configuration(host=config['line_api_endpoint'],
+                                           access_token=access_token)
+        self.api = MessagingApi(ApiClient(self.configuration))
+        self.signature_validator = SignatureValidator(channel_secret)
+        self.quota = line_quota.QuotaManager(self.api, config['line_quota_refresh_seconds'],
+                                             config['line_quota_weights'],
+                                             config['line_push_rate_per_second'])
+        self._bot_name = None
+        self._bot_name_at = 0.0
+
+    @property
+    def webhook_path(self) -> str:
+        return '/callback' if self.name == DEFAULT_LINE_ACCOUNT else f'/callback/{self.name}'
+
+    @property
+    def bot_name(self) -> str:
+        """Display name of the bot, read from LINE once, or from the warm start snapshot."""
+        if self._bot_name is None:
+            saved = saved_bot_names().get(self.name)
+            if saved is not None:
+                self._bot_name, self._bot_name_at = saved
+                return self._bot_name
+            self._bot_name = self.api.get_bot_info().display_name
+            self._bot_name_at = time.time()
+            logger.debug("取得 LINE bot 名稱: %s (%s)", self._bot_name, self.name)
+        return self._bot_name
+
+
+class LineAccounts:
+    """The LINE accounts of the bridge and the groups each of them is bound to."""
+
+    def __init__(self, accounts: list[LineAccount]):
+        self._accounts = {account.name: account for account in accounts}
+        self.default = accounts[0]
+
+    def get(self, name: str) -> LineAccount | None:
+        return self._accounts.get(name)
+
+    def for_group(self, line_group_id: str) -> LineAccount:
+        """The account bound to a LINE group, the default one for unbound groups.
+
+        :param str line_group_id: LINE group ID.
+        :return LineAccount: The account to send to the group with.
+        """
+        name = sync_channels_cache.line_accounts.get(line_group_id, DEFAULT_LINE_ACCOUNT)
+        account = self._accounts.get(name)
+        if account is None:
+            logger.warning("LINE 群組 %s 綁定的帳號 %s 不在設定檔中，改用預設帳號", line_group_id,
+                           name, extra={'rate_key': f'line_account_{name}'})
+            return self.default
+        return account
+
+    def can_send_digest(self, line_group_id: str) -> bool:
+        """Whether the quota of the account bound to a group can pay for its digest today."""
+        subscribed_info = sync_channels_cache.get_info_by_line_group_id(line_group_id)
+        folder_name = subscribed_info['folder_name'] if subscribed_info else line_group_id
+        return self.for_group(line_group_id).quota.can_send_digest(line_group_id, folder_name)
+
+    def __iter__(self):
+        return iter(self._accounts.values())
+
+    def __len__(self):
+        return len(self._accounts)
+
+
+@functools.cache
+def saved_bot_names() -> dict[str, list]:
+    """Bot names read by the previous run: {account name: [bot name, read at]}."""
+    names = warm_start.restore('line_bot_names') or {}
+    return {name: saved for name, saved in names.items()
+            if time.time() - saved[1] < warm_start.max_age}
+
+
+accounts = LineAccounts(
+    [LineAccount(DEFAULT_LINE_ACCOUNT, config['line_channel_access_token'],
+                 config['line_channel_secret'])]
+    + [LineAccount(account['name'], account['channel_access_token'], account['channel_secret'])
+       for account in config['line_accounts']])
+warm_start.add('line_bot_names', lambda: {account.name: [account._bot_name, account._bot_name_at]
+                                          for account in accounts if account._bot_name is not None})
@@ -1,26 +1,52 @@
+import asyncio
 import datetime
+import functools
+import glob
+import hashlib
+import hmac
+import io
 import os
+import re
+import threading
+import time
 import urllib.parse
+import aiohttp
 import requests
 from discord import SyncWebhook, File
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, TextMessage, \
-    ReplyMessageRequest, TemplateMessage, ConfirmTemplate, MessageAction, PushMessageRequest, \
-    ImageMessage, VideoMessage, AudioMessage
-from linebot.v3.webhooks import MessageEvent, TextMessageContent, ImageMessageContent, \
+from linebot.v3.messaging import TextMessage, ReplyMessageRequest, TemplateMessage, \
+    ConfirmTemplate, MessageAction, PushMessageRequest, ImageMessage, VideoMessage, AudioMessage, \
+    ApiException, GroupUserProfileResponse
+from linebot.v3.webhooks import Event, MessageEvent, TextMessageContent, ImageMessageContent, \
     VideoMessageContent, AudioMessageContent, StickerMessageContent, FileMessageContent, \
-    LocationMessageContent
+    LocationMessageContent, UnsendEvent
 from pydantic import StrictStr
 import logging
 
 import line_sticker_downloader
+from line_pipeline import CONTENT, MessageContext, MessagePipeline
+from admission import (ACCEPT, DEGRADE, PRIORITY_MEDIA, PRIORITY_TEXT,
+                       AdmissionController)
+from archive import archiver
+from keyed_executor import GAUGE_LANES
+from lifecycle import lifecycle
+from line_accounts import LineAccount, accounts, current_account
+import line_quota
+import log_config
+import diagnostics
+import media
+import media_relay
+from health import health, router as health_router
+from sticker_cache import sticker_cache
 import utilities as utils
-from cache import sync_channels_cache
+import webhook_filter
+from warm_start import warm_start
+from cache import DEFAULT_LINE_ACCOUNT, MemberProfiles, MessageIdIndex, RecentEventIds, \
+    ReplyTokens, sync_channels_cache
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
@@ -33,372 +59,790 @@ app.add_middleware(
     allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
+app.include_router(media_relay.router)
+app.include_router(health_router)
+app.include_router(diagnostics.router)
+
+
+@app.middleware("http")
+async def record_activity(request: Request, call_next):
+    health.mark_activity()
+    return await call_next(request)
 
 config = utils.read_config()
-configuration = Configuration(access_token=config['line_channel_access_token'])
+# Registry of the event handlers, signatures are checked per account by the callbacks
 handler = WebhookHandler(config['line_channel_secret'])
+webhook_event_ids = RecentEventIds(config['webhook_dedup_window_seconds'],
+                                   config['webhook_dedup_max_events'])
+admission = AdmissionController(config['webhook_workers'], config['max_pending_events'],
+                                config['max_pending_events_per_group'])
+reply_tokens = ReplyTokens(config['line_reply_token_seconds'])
+message_ids = MessageIdIndex(config['message_id_index_hours'] * 3600, config['message_id_index_max'])
+member_profiles = MemberProfiles(config['line_profile_cache_minutes'] * 60)
+# Webhooks of the bindings, sending over one pool of keep-alive connections to Discord
+discord_session = requests.Session()
+discord_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=config['webhook_workers']))
+discord_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=config['webhook_workers']))
+delivery_stats = {'push': 0, 'reply': 0, 'reply_failed': 0}
 logger.info("Line Bot is ready.")
 
-def get_bot_name() -> str:
+def get_bot_name(account: LineAccount = None) -> str:
     """Get the bot name.
 
+    :param LineAccount account: The LINE account, the default one if None.
     :return str: The bot name.
     """
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        profile = line_bot_api.get_bot_info()
-        logger.debug(f"取得 LINE bot 名稱: {profile.display_name}")
-        return profile.display_name
+    return (account or accounts.default).bot_name
 
 bot_name = get_bot_name()
+
+
+def check_line_api(account: LineAccount):
+    """Readiness check: the LINE Messaging API answers with the access token of an account."""
+    started = time.perf_counter()
+    account.api.get_bot_info()
+    return True, {'latency_ms': round((time.perf_counter() - started) * 1000)}
+
+
+for line_account in accounts:
+    health.add_check('line_api' if line_account.name == DEFAULT_LINE_ACCOUNT
+                     else f'line_api_{line_account.name}',
+                     functools.partial(check_line_api, line_account), interval=60)
+health.add_gauge('line_events', lambda: admission.pending)
+health.add_gauge('line_event_groups', lambda: len(admission.pending_by_group))
+health.add_gauge('line_event_lanes', lambda: admission.executor.lane_depths(GAUGE_LANES))
+health.add_gauge('archive_queue', lambda: archiver.pending)
+health.add_gauge('line_events_filtered', lambda: routing_stats['filtered'])
+health.add_gauge('message_ids', lambda: len(message_ids))
+health.add_gauge('line_member_profiles', lambda: len(member_profiles))
 dc_bot_invite_link = config['discord_bot_invite_link']
+# Texts answered by handle_message in any group, bound or not
+bot_commands = frozenset({"!ID", "獲取 Discord 備份機器人邀請連結", "確認並開始綁定",
+                          *(f"@{get_bot_name(account)} " for account in accounts)})
+routing_stats = {'handled': 0, 'filtered': 0}
 
-async def send_author_avatar(line_group_id: str, image_path: str):
-    """使用 Messaging API 傳送使用者頭像到 LINE 群組。
+def send_messages(line_group_id: str, messages: list, account: LineAccount = None) -> list:
+    """Send messages to a LINE group, with a reply token of a recent event when possible.
 
-    :param str line_group_id: LINE 群組 ID。
-    :param str image_path: Discord雲端圖片檔案網址。
+    Replies cost no quota; without a valid token the messages are pushed, paced and
+    counted against the message quota.
+
+    :raises line_quota.QuotaExhausted: No valid token, and the quota can't pay for the push.
+
+    :param str line_group_id: LINE group ID.
+    :param list messages: Up to 5 LINE message objects.
+    :param LineAccount account: The account to send with, None for the one bound to the group.
+    :return list: The SentMessage (ID and quote token) of every message, in order.
     """
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    account = account or accounts.for_group(line_group_id)
+    reply_token = reply_tokens.take(account.name, line_group_id)
+    if reply_token is not None:
         try:
-            #image_url = get_image_url(image_path)
-            line_bot_api.push_message(PushMessageRequest(
-                to=line_group_id,
-                messages=[ImageMessage(originalContentUrl=image_path, previewImageUrl=image_path)]
-            ))
-            logger.info(f"成功傳送發言者頭像至 LINE 群組 {line_group_id}, URL: {image_path}")
-        except Exception as e:
-            logger.error(f"傳送發言者頭像至 LINE 群組 {line_group_id} 失敗: {e}")
-            raise
-
-def send_text_message(line_group_id: str, message: str):
+            response = account.api.reply_message(ReplyMessageRequest(reply_token=reply_token,
+                                                                     messages=messages))
+            _count_delivery('reply')
+            return response.sent_messages or []
+        except ApiException as e:
+            # Expired or used by LINE's side already, push instead
+            delivery_stats['reply_failed'] += 1
+            logger.debug("回覆權杖無效，改用推播: %s", e.status)
+    # The caller may have counted on a token that expired or was used by another message
+    if not account.quota.can_push(line_group_id):
+        raise line_quota.QuotaExhausted(line_group_id)
+    account.quota.wait_for_rate_limit()
+    response = account.api.push_message(PushMessageRequest(to=line_group_id, messages=messages))
+    subscribed_info = sync_channels_cache.get_info_by_line_group_id(line_group_id)
+    account.quota.consume(line_group_id, subscribed_info['folder_name'] if subscribed_info else None)
+    _count_delivery('push')
+    return response.sent_messages or []
+
+def _count_delivery(method: str):
+    delivery_stats[method] += 1
+    total = delivery_stats['push'] + delivery_stats['reply']
+    if total % 100 == 0:
+        logger.info("LINE 訊息傳送方式: 推播 %s 次, 回覆 %s 次 (回覆比例 %.0f%%)",
+                    delivery_stats['push'], delivery_stats['reply'],
+                    delivery_stats['reply'] / total * 100)
+
+def send_texts(line_group_id: str, texts: list):
+    """Send up to 5 texts to a LINE group in one request, used for digests."""
+    send_messages(line_group_id, [TextMessage(text=text) for text in texts])
+
+def with_avatar(avatar_url: str | None, messages: list) -> list:
+    """Prepend the avatar of the speaker to the messages of a push, if any."""
+    if not avatar_url:
+        return messages
+    return [ImageMessage(originalContentUrl=avatar_url, previewImageUrl=avatar_url)] + messages
+
+def first_sent(sent: list, avatar_url: str | None):
+    """The SentMessage of the first message of a push, after the avatar sent with it."""
+    index = 1 if avatar_url else 0
+    return sent[index] if len(sent) > index else None
+
+def send_text_message(line_group_id: str, message: str, avatar_url: str = None,
+                      quote_token: str = None):
     """Send text message to LINE group using Messaging API.
 
     :param str line_group_id: LINE group ID.
     :param str message: Message to send.
+    :param str avatar_url: Avatar of the speaker to send first in the same push, None to skip.
+    :param str quote_token: Quote token of a message of the group to quote, None to skip.
+    :return: The SentMessage of the text, None if LINE didn't return it.
     """
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        try:
-            line_bot_api.push_message(PushMessageRequest(
-                to=line_group_id,
-                messages=[TextMessage(text=message)]
-            ))
-            logger.info(f"成功傳送文字訊息至 LINE 群組 {line_group_id}: {message}")
-        except Exception as e:
-            logger.error(f"傳送文字訊息至 LINE 群組 {line_group_id} 失敗: {e}")
-            raise
+    try:
+        sent = send_messages(line_group_id, with_avatar(
+            avatar_url, [TextMessage(text=message, quoteToken=quote_token)]))
+        logger.info("成功傳送文字訊息至 LINE 群組 %s: %s", line_group_id, log_config.content(message))
+        return first_sent(sent, avatar_url)
+    except Exception as e:
+        logger.error("傳送文字訊息至 LINE 群組 %s 失敗: %s", line_group_id, e)
+        raise
 
-def send_image_message(line_group_id: str, message: str, image_path: str):
+def send_image_message(line_group_id: str, message: str, image_path: str,
+                       preview_path: str = None, avatar_url: str = None):
     """使用 Messaging API 傳送圖片訊息到 LINE 群組。
 
     :param str line_group_id: LINE 群組 ID。
     :param str message: 要傳送的文字訊息。
     :param str image_path: Discord雲端圖片檔案網址。
+    :param str preview_path: 預覽縮圖網址，None 則使用原圖。
+    :param str avatar_url: 發言者頭像網址，於同一次推播中先行傳送，None 則略過。
+    :return: 文字訊息的 SentMessage，LINE 未回傳時為 None。
     """
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        try:
-            #image_url = get_image_url(image_path)
-            line_bot_api.push_message(PushMessageRequest(
-                to=line_group_id,
-                messages=[
-                    TextMessage(text=message),
-                    ImageMessage(originalContentUrl=image_path, previewImageUrl=image_path)
-                ]
-            ))
-            logger.info(f"成功傳送圖片訊息至 LINE 群組 {line_group_id}: {message}, URL: {image_path}")
-        except Exception as e:
-            logger.error(f"傳送圖片訊息至 LINE 群組 {line_group_id} 失敗: {e}")
-            raise
+    try:
+        #image_url = get_image_url(image_path)
+        sent = send_messages(line_group_id, with_avatar(avatar_url, [
+            TextMessage(text=message),
+            ImageMessage(originalContentUrl=image_path,
+                         previewImageUrl=preview_path or image_path)
+        ]))
+        logger.info("成功傳送圖片訊息至 LINE 群組 %s: %s, URL: %s", line_group_id, log_config.content(message), image_path)
+        return first_sent(sent, avatar_url)
+    except Exception as e:
+        logger.error("傳送圖片訊息至 LINE 群組 %s 失敗: %s", line_group_id, e)
+        raise
 
-def send_video_message(line_group_id: str, message: str, video_path: str, thumbnail_path: str):
+def send_video_message(line_group_id: str, message: str, video_path: str, thumbnail_path: str,
+                       avatar_url: str = None):
     """Send video message to LINE group using Messaging API.
 
     :param str line_group_id: LINE group ID.
     :param str message: Message to send.
     :param str video_path: Path to video file.
     :param str thumbnail_path: Path to thumbnail image.
+    :param str avatar_url: Avatar of the speaker to send first in the same push, None to skip.
+    :return: The SentMessage of the text, None if LINE didn't return it.
     """
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        try:
-            #video_url = upload_file(video_path)
-            #thumbnail_url = upload_file(thumbnail_path)
-            line_bot_api.push_message(PushMessageRequest(
-                to=line_group_id,
-                messages=[
-                    TextMessage(text=message),
-                    VideoMessage(originalContentUrl=video_path, previewImageUrl=thumbnail_path)
-                ]
-            ))
-            logger.info(f"成功傳送影片訊息至 LINE 群組 {line_group_id}: {message}, Video URL: {video_path}")
-        except Exception as e:
-            logger.error(f"傳送影片訊息至 LINE 群組 {line_group_id} 失敗: {e}")
-            raise
+    try:
+        #video_url = upload_file(video_path)
+        #thumbnail_url = upload_file(thumbnail_path)
+        sent = send_messages(line_group_id, with_avatar(avatar_url, [
+            TextMessage(text=message),
+            VideoMessage(originalContentUrl=video_path, previewImageUrl=thumbnail_path)
+        ]))
+        logger.info("成功傳送影片訊息至 LINE 群組 %s: %s, Video URL: %s", line_group_id, log_config.content(message), video_path)
+        return first_sent(sent, avatar_url)
+    except Exception as e:
+        logger.error("傳送影片訊息至 LINE 群組 %s 失敗: %s", line_group_id, e)
+        raise
 
-def send_audio_message(line_group_id: str, message: str, audio_path: str, audio_duration: int):
+def send_audio_message(line_group_id: str, message: str, audio_path: str, audio_duration: int,
+                       avatar_url: str = None):
     """Send audio message to LINE group using Messaging API.
 
     :param str line_group_id: LINE group ID.
     :param str message: Message to send.
     :param str audio_path: Path to audio file.
     :param int audio_duration: Duration of audio in milliseconds.
+    :param str avatar_url: Avatar of the speaker to send first in the same push, None to skip.
+    :return: The SentMessage of the text, None if LINE didn't return it.
     """
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        try:
-            line_bot_api.push_message(PushMessageRequest(
-                to=line_group_id,
-                messages=[
-                    TextMessage(text=message),
-                    AudioMessage(originalContentUrl=audio_path, duration = 60)
-                ]
-            ))
-            logger.info(f"成功傳送音訊訊息至 LINE 群組 {line_group_id}: {message}, Audio URL: {audio_path}")
-        except Exception as e:
-            logger.error(f"傳送音訊訊息至 LINE 群組 {line_group_id} 失敗: {e}")
-            raise
+    try:
+        sent = send_messages(line_group_id, with_avatar(avatar_url, [
+            TextMessage(text=message),
+            AudioMessage(originalContentUrl=audio_path, duration=int(audio_duration))
+        ]))
+        logger.info("成功傳送音訊訊息至 LINE 群組 %s: %s, Audio URL: %s", line_group_id, log_config.content(message), audio_path)
+        return first_sent(sent, avatar_url)
+    except Exception as e:
+        logger.error("傳送音訊訊息至 LINE 群組 %s 失敗: %s", line_group_id, e)
+        raise
+
+def push_message(line_group_id: str, message: str, account: LineAccount = None) -> bool:
+    """Push a notice to the specified LINE group, e.g. about its binding.
 
-def push_message(line_group_id: str, message: str):
-    """Push a message to the specified LINE group.
+    Sent like forwarded messages: free with a reply token, else paced and counted against
+    the quota, and skipped when the quota can't pay for it. Blocks, call it off the event loop.
 
     :param str line_group_id: LINE group ID.
     :param str message: Message to push.
+    :param LineAccount account: The account to send with, None for the one bound to the group.
+    :return bool: Whether the message was sent.
     """
-    send_text_message(line_group_id, message)
+    account = account or accounts.for_group(line_group_id)
+    if not reply_tokens.has(account.name, line_group_id) \
+            and not account.quota.can_push(line_group_id):
+        logger.warning("LINE 訊息額度不足，未傳送通知至群組 %s", line_group_id)
+        return False
+    try:
+        send_messages(line_group_id, [TextMessage(text=message)], account)
+    except Exception as e:
+        logger.error("傳送通知至 LINE 群組 %s 失敗: %s", line_group_id, e)
+        return False
+    logger.info("成功傳送通知至 LINE 群組 %s", line_group_id)
+    return True
+
+MEDIA_LABELS = {'image': '圖片', 'video': '影片', 'audio': '音訊', 'file': '檔案', 'sticker': '貼圖'}
+
+CONTENT_CHUNK_SIZE = 256 * 1024
+# Suffix of files still being downloaded
+PARTIAL_SUFFIX = '.part'
+
+
+def filter_source(context: MessageContext) -> bool:
+    """Only group messages are forwarded."""
+    if context.event.source.type == 'user':
+        logger.debug("忽略來自單獨用戶的%s", context.event.message.type)
+        return False
+    context.group_id = context.event.source.group_id
+    return True
+
+
+def resolve_route(context: MessageContext) -> bool:
+    """Find the Discord channel bound to the LINE group."""
+    context.route = sync_channels_cache.get_info_by_line_group_id(context.group_id)
+    return context.route is not None
+
+
+def resolve_author(context: MessageContext):
+    """Get the LINE profile of the sender, from the cache while it is recent."""
+    user_id = context.event.source.user_id
+    context.author = member_profiles.get(context.group_id, user_id)
+    if context.author is None:
+        context.author = accounts.for_group(context.group_id).api.get_group_member_profile(
+            context.group_id, user_id)
+        member_profiles.put(context.group_id, user_id, context.author)
+
+
+def save_member_profiles() -> list:
+    return [[group_id, user_id, profile.to_dict(), fetched_at]
+            for group_id, user_id, profile, fetched_at in member_profiles.items()]
+
+
+def restore_member_profiles():
+    """Reuse the profiles saved by the previous run, see warm_start."""
+    items = warm_start.restore('line_member_profiles') or []
+    member_profiles.restore([(group_id, user_id, GroupUserProfileResponse.from_dict(profile),
+                              fetched_at) for group_id, user_id, profile, fetched_at in items])
+    if items:
+        logger.info("已恢復 %s 筆 LINE 成員資料", len(items))
+
+
+warm_start.add('line_member_profiles', save_member_profiles)
+# Off the import, the first messages fetch their profile themselves meanwhile
+threading.Thread(target=restore_member_profiles, name='profile-warm-up', daemon=True).start()
+
+
+@functools.lru_cache(maxsize=1024)
+def discord_webhook(url: str) -> SyncWebhook:
+    """The webhook of a binding, built once per URL."""
+    return SyncWebhook.from_url(url, session=discord_session)
+
+
+def quoted_link(message) -> str | None:
+    """Link to the Discord copy of the message a LINE message quotes, if it is known."""
+    quoted_message_id = getattr(message, 'quoted_message_id', None)
+    if not quoted_message_id:
+        return None
+    return message_ids.jump_url(message_ids.by_line(quoted_message_id))
+
+
+def deliver(context: MessageContext):
+    """Send the content prepared by the content stage through the Discord webhook."""
+    webhook = discord_webhook(context.route['discord_channel_webhook'])
+    kwargs = {'username': f"{context.author.display_name} - (Line訊息)",
+              'avatar_url': context.author.picture_url}
+    if context.text is not None:
+        kwargs['content'] = context.text
+    quoted = quoted_link(context.event.message)
+    if quoted:
+        kwargs['content'] = f"↪ 回覆 {quoted}\n{kwargs.get('content', '')}".rstrip('\n')
+    try:
+        if context.file_data is not None:
+            kwargs['file'] = File(io.BytesIO(context.file_data),
+                                  filename=os.path.basename(context.file_path))
+        elif context.file_path is not None and context.upload:
+            kwargs['file'] = File(context.file_path)
+        # wait=True returns the webhook message, whose ID later edits and unsends refer to
+        sent = webhook.send(wait=True, **kwargs)
+        message_ids.add(sent.id, int(context.route['discord_channel_id']),
+                        context.event.message.id, context.group_id,
+                        getattr(context.event.message, 'quote_token', None), from_line=True)
+        logger.info("已傳送%s至 Discord: %s", context.label,
+                    context.file_path or log_config.content(context.text))
+    finally:
+        if context.file_path and context.remove_file and os.path.exists(context.file_path):
+            os.remove(context.file_path)
+            logger.debug("已刪除%s檔案: %s", context.label, context.file_path)
+
+
+def archive_message(context: MessageContext):
+    """Queue the message for the archive, before deliver removes its file."""
+    archiver.record(context.route['folder_name'], 'line_to_discord', context.author.display_name,
+                    context.text, context.event.message.type, context.event.message.id,
+                    files=[context.file_path] if context.file_path else None)
+
+
+pipeline = MessagePipeline([
+    ('filter', filter_source),
+    ('route', resolve_route),
+    ('author', resolve_author),
+    (CONTENT, None),
+    ('archive', archive_message),
+    ('deliver', deliver),
+])
+
 
 @app.post("/callback")
 async def callback(request: Request):
     """Callback function for line webhook."""
+    return await handle_webhook(request, accounts.default)
+
+
+@app.post("/callback/{account_name}")
+async def account_callback(request: Request, account_name: str):
+    """Callback function for the line webhook of the other LINE accounts."""
+    account = accounts.get(account_name)
+    if account is None:
+        raise HTTPException(status_code=404, detail="Not found.")
+    return await handle_webhook(request, account)
+
+
+async def handle_webhook(request: Request, account: LineAccount):
+    """Check, filter and queue the events of a webhook request to a LINE account."""
     signature = request.headers['X-Line-Signature']
-    body = await request.body()
-    try:
-        handler.handle(body.decode("utf-8"), signature)
-        logger.debug("成功處理 LINE webhook 回調")
-    except InvalidSignatureError:
-        logger.error("無效簽章。請檢查您的 LINE 頻道存取權杖或秘密金鑰。")
+    body = (await request.body()).decode("utf-8")
+    if not account.signature_validator.validate(body, signature):
+        logger.error("無效簽章。請檢查 LINE 帳號 %s 的頻道存取權杖或秘密金鑰。", account.name)
         raise HTTPException(status_code=400, detail="Invalid signature.")
+
+    if lifecycle.draining:
+        # Refused before the events are recorded as seen, so the redelivery is handled
+        raise HTTPException(status_code=503, detail="Shutting down.")
+
+    rejected = 0
+    for event_data in webhook_filter.loads(body)['events']:
+        if not webhook_filter.wanted_event(event_data, sync_channels_cache.line_accounts,
+                                           account.name, bot_commands):
+            routing_stats['filtered'] += 1
+            continue
+        routing_stats['handled'] += 1
+        event_id = event_data.get('webhookEventId')
+        if webhook_event_ids.check_and_add(event_id):
+            logger.info("略過重送的 LINE 事件: %s (累計略過 %s 筆)",
+                        event_id, webhook_event_ids.suppressed)
+            continue
+        try:
+            event = Event.from_dict(event_data)
+        except ValueError:
+            logger.info("未知的 LINE 事件類型: %s", event_data.get('type'))
+            continue
+
+        group_id = event_data.get('source', {}).get('groupId', '')
+        if group_id and event_data.get('replyToken'):
+            reply_tokens.add(account.name, group_id, event_data['replyToken'],
+                             event_data.get('timestamp', time.time() * 1000) / 1000)
+        message_type = event_data.get('message', {}).get('type')
+        priority = PRIORITY_MEDIA if message_type in MEDIA_LABELS else PRIORITY_TEXT
+        decision = admission.admit(priority, group_id)
+        if decision == ACCEPT:
+            admission.submit(priority, group_id, dispatch_event, event, account)
+        elif decision == DEGRADE:
+            admission.submit(PRIORITY_TEXT, group_id, dispatch_event, event, account,
+                             forward_media_link)
+        else:
+            webhook_event_ids.discard(event_id)
+            rejected += 1
+
+    if rejected:
+        logger.warning("系統過載，拒絕 %s 筆 LINE 事件並等待重送 (佇列中 %s 筆)",
+                       rejected, admission.pending)
+        raise HTTPException(status_code=503, detail="Overloaded.")
+    logger.debug("成功接收 LINE webhook 回調")
     return 'OK'
 
+
+def dispatch_event(event: Event, account: LineAccount, func=None):
+    """Call the handler registered on `handler` for an event.
+
+    Mirrors the lookup of WebhookHandler.handle, which can't be used after the events
+    are filtered because it verifies and parses the whole body again.
+
+    :param Event event: The parsed LINE webhook event.
+    :param LineAccount account: The account that received the event, see `current_account`.
+    :param func: Handler to call instead of the registered one.
+    """
+    current_account.set(account)
+    if func is None and isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{type(event).__name__}_{type(event.message).__name__}")
+    if func is None:
+        func = handler._handlers.get(type(event).__name__)
+    if func is None:
+        logger.debug("沒有對應的處理器: %s", type(event).__name__)
+        return
+    func(event)
+
+
+def save_pending_events() -> list:
+    """Take the LINE events that haven't been handled yet, to send them after a restart."""
+    items = []
+    for _, _, (event, account, *func) in admission.executor.cancel_pending():
+        # func is only given for media degraded to links
+        items.append({'account': account.name, 'event': event.to_dict(), 'degraded': bool(func)})
+    return items
+
+
+def restore_pending_events(items: list):
+    """Queue the LINE events saved by `save_pending_events`."""
+    for item in items:
+        event = Event.from_dict(item['event'])
+        account = accounts.get(item['account']) or accounts.default
+        group_id = getattr(event.source, 'group_id', None) or ''
+        if item['degraded']:
+            admission.submit(PRIORITY_TEXT, group_id, dispatch_event, event, account,
+                             forward_media_link)
+        else:
+            message_type = getattr(getattr(event, 'message', None), 'type', None)
+            priority = PRIORITY_MEDIA if message_type in MEDIA_LABELS else PRIORITY_TEXT
+            admission.submit(priority, group_id, dispatch_event, event, account)
+
+
+lifecycle.add_drain('line_events', admission.executor.join)
+lifecycle.add_state('line_events', save_pending_events, restore_pending_events)
+lifecycle.add_state('webhook_event_ids', webhook_event_ids.snapshot, webhook_event_ids.restore)
+lifecycle.add_state('message_ids', message_ids.snapshot, message_ids.restore)
+lifecycle.add_close('archive', archiver.flush)
+
+
+def content_signature(message_id: str, account: LineAccount) -> str:
+    """Sign a LINE message ID so /line-content only serves links the bot handed out."""
+    return hmac.new(account.channel_secret.encode('utf-8'), message_id.encode('utf-8'),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def content_link(message_id: str) -> str | None:
+    """Link to /line-content for the content of a message, None without public_base_url."""
+    if not config['public_base_url']:
+        return None
+    account = current_account.get(accounts.default)
+    link = (f"{config['public_base_url'].rstrip('/')}/line-content/{message_id}"
+            f"?sig={content_signature(message_id, account)}")
+    if account is not accounts.default:
+        link += f"&account={account.name}"
+    return link
+
+
+@pipeline.content_stage
+def forward_media_link(context: MessageContext):
+    """Forward a media message to Discord as a link instead of re-uploading it.
+
+    Used when the bot is overloaded, so no media is held in memory or on disk.
+    """
+    message = context.event.message
+    context.label = MEDIA_LABELS[message.type]
+    if message.type == 'sticker':
+        link = (f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{message.sticker_id}"
+                f"/android/sticker.png")
+    else:
+        link = content_link(message.id)
+    context.text = (f"傳送了{context.label}：{link}" if link
+                    else f"傳送了{context.label}（系統忙碌中，未能轉傳）")
+    logger.info("系統忙碌，已改以連結傳送%s至 Discord: message_id=%s", context.label, message.id)
+
+
+# Shared by the line_content streams; no total timeout, as large videos take a while
+content_session: aiohttp.ClientSession | None = None
+CONTENT_TIMEOUT = aiohttp.ClientTimeout(sock_connect=10, sock_read=60)
+
+
+async def close_content_session():
+    if content_session is not None:
+        await content_session.close()
+
+
+lifecycle.add_close('line_content', close_content_session)
+
+
+@app.get("/line-content/{message_id}")
+async def line_content(message_id: str, sig: str, account: str = DEFAULT_LINE_ACCOUNT):
+    """Stream LINE message content for links sent by forward_media_link."""
+    global content_session
+    line_account = accounts.get(account)
+    if line_account is None or not hmac.compare_digest(sig, content_signature(message_id,
+                                                                              line_account)):
+        raise HTTPException(status_code=404, detail="Not found.")
+    if content_session is None or content_session.closed:
+        content_session = aiohttp.ClientSession(timeout=CONTENT_TIMEOUT)
+    try:
+        response = await content_session.get(
+            f"{config['line_data_api_endpoint']}/v2/bot/message/{message_id}/content",
+            headers={"Authorization": f"Bearer {line_account.access_token}"})
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning("讀取 LINE 訊息內容失敗: message_id=%s, %s", message_id, e)
+        raise HTTPException(status_code=502, detail="Bad gateway.")
+    if response.status != 200:
+        response.release()
+        raise HTTPException(status_code=404, detail="Not found.")
+
+    async def body():
+        try:
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                yield chunk
+        finally:
+            response.release()
+
+    headers = {}
+    if response.content_length is not None:
+        headers['Content-Length'] = str(response.content_length)
+    return StreamingResponse(body(), media_type=response.content_type, headers=headers)
+
+
+def text_content(context: MessageContext):
+    context.text = context.event.message.text
+    logger.debug("收到 LINE 訊息: %s, 群組: %s", log_config.content(context.text), context.group_id)
+
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
-    with ApiClient(configuration) as api_client:
-        if event.source.type == 'user':
-            logger.debug("忽略來自單獨用戶的訊息")
-            return
-        line_bot_api = MessagingApi(api_client)
-        message_received = event.message.text
-        group_id = event.source.group_id
-        logger.debug(f"收到 LINE 訊息: {message_received}, 群組: {group_id}")
-
+    pipeline.run(event, text_content)
+    if event.source.type == 'user':
+        return
+    account = current_account.get(accounts.default)
+    line_bot_api = account.api
+    message_received = event.message.text
+    group_id = event.source.group_id
+
+    if message_received == "!ID":
+        reply_message = TextMessage(text=f"Group ID: {group_id}")
+    elif message_received == f"@{get_bot_name(account)} ":
         if group_id in sync_channels_cache.line_group_ids:
-            author = line_bot_api.get_group_member_profile(group_id, event.source.user_id)
-            dc_channel_webhook = sync_channels_cache.get_dc_webhook_by_line_group_id(group_id)
-            discord_webhook = SyncWebhook.from_url(dc_channel_webhook)
-            discord_webhook.send(message_received, username=f"{author.display_name} - (Line訊息)",
-                                avatar_url=author.picture_url)
-            logger.info(f"已傳送 LINE 訊息至 Discord: {message_received}")
-
-        if message_received == "!ID":
-            reply_message = TextMessage(text=f"Group ID: {group_id}")
-        elif message_received == f"@{bot_name} ":
-            if group_id in sync_channels_cache.line_group_ids:
-                reply_message = TextMessage(text="此群組已綁定，新增綁定Discord頻道")
-            #else:
-            confirm_template = ConfirmTemplate(
-                text=StrictStr("請問你的 Discord 伺服器邀請備份機器人了嗎？"),
-                actions=[
-                    MessageAction(label=StrictStr("還沒"),
-                                    text=StrictStr("獲取 Discord 備份機器人邀請連結")),
-                    MessageAction(label=StrictStr("已邀請"),
-                                    text=StrictStr("確認並開始綁定"))
-                ])
-            reply_message = TemplateMessage(altText="是否完成加入 Discord 機器人？",
-                                            template=confirm_template)
-        elif message_received == "獲取 Discord 備份機器人邀請連結":
-            if dc_bot_invite_link:
-                reply_message = TextMessage(text=dc_bot_invite_link)
-            else:
-                reply_message = TextMessage(text="架設者未公開 Discord Bot 邀請連結")
-        elif message_received == "確認並開始綁定":
-            group_name = line_bot_api.get_group_summary(group_id).group_name
-            binding_code = utils.generate_binding_code(group_id, group_name)
-            reply_message = TextMessage(text=f"請至欲同步的Discord頻道中\n" \
-                                            f"\n----------------------\n" \
-                                            f"輸入以下指令來完成綁定\n" \
-                                            f"/link {binding_code}\n" \
-                                            f"----------------------\n" \
-                                            f"\n※注意※\n" \
-                                            f"此綁定碼僅能使用一次\n" \
-                                            f"並將於5分鐘後過期")
+            reply_message = TextMessage(text="此群組已綁定，新增綁定Discord頻道")
+        #else:
+        confirm_template = ConfirmTemplate(
+            text=StrictStr("請問你的 Discord 伺服器邀請備份機器人了嗎？"),
+            actions=[
+                MessageAction(label=StrictStr("還沒"),
+                                text=StrictStr("獲取 Discord 備份機器人邀請連結")),
+                MessageAction(label=StrictStr("已邀請"),
+                                text=StrictStr("確認並開始綁定"))
+            ])
+        reply_message = TemplateMessage(altText="是否完成加入 Discord 機器人？",
+                                        template=confirm_template)
+    elif message_received == "獲取 Discord 備份機器人邀請連結":
+        if dc_bot_invite_link:
+            reply_message = TextMessage(text=dc_bot_invite_link)
         else:
-            return
+            reply_message = TextMessage(text="架設者未公開 Discord Bot 邀請連結")
+    elif message_received == "確認並開始綁定":
+        group_name = line_bot_api.get_group_summary(group_id).group_name
+        binding_code = utils.generate_binding_code(group_id, group_name, account.name)
+        reply_message = TextMessage(text=f"請至欲同步的Discord頻道中\n" \
+                                        f"\n----------------------\n" \
+                                        f"輸入以下指令來完成綁定\n" \
+                                        f"/link {binding_code}\n" \
+                                        f"----------------------\n" \
+                                        f"\n※注意※\n" \
+                                        f"此綁定碼僅能使用一次\n" \
+                                        f"並將於5分鐘後過期")
+    else:
+        return
+    if reply_tokens.claim(account.name, group_id, event.reply_token):
         line_bot_api.reply_message(ReplyMessageRequest(
             reply_token=event.reply_token, messages=[reply_message]))
-        logger.debug(f"回覆 LINE 訊息: {reply_message.text}")
+    else:
+        # The token was already used to forward a Discord message
+        send_messages(group_id, [reply_message], account)
+    # Template messages have no text, only the alt text shown in notifications
+    logger.debug("回覆 LINE 訊息: %s", log_config.content(
+        getattr(reply_message, 'text', None) or reply_message.alt_text))
+
+@handler.add(UnsendEvent)
+def handle_unsend(event: UnsendEvent):
+    """Delete the Discord copy of a LINE message that was unsent."""
+    entry = message_ids.pop_line(event.unsend.message_id)
+    if entry is None or not entry.from_line:
+        return
+    route = sync_channels_cache.get_info_by_line_group_id(entry.line_group_id)
+    if route is None:
+        return
+    try:
+        discord_webhook(route['discord_channel_webhook']).delete_message(entry.discord_message_id)
+        logger.info("LINE 訊息已收回，已刪除 Discord 訊息 %s", entry.discord_message_id)
+    except Exception as e:
+        logger.warning("刪除已收回的 LINE 訊息於 Discord 的副本失敗: %s, 錯誤: %s",
+                       entry.discord_message_id, e)
 
 @handler.add(MessageEvent, message=StickerMessageContent)
-def handle_sticker_message(event):
-    with ApiClient(configuration) as api_client:
-        if event.source.type == 'user':
-            logger.debug("忽略來自單獨用戶的貼圖訊息")
-            return
-        line_bot_api = MessagingApi(api_client)
-        group_id = event.source.group_id
-        if group_id in sync_channels_cache.line_group_ids:
-            subscribed_info = sync_channels_cache.get_info_by_line_group_id(group_id)
-            author = line_bot_api.get_group_member_profile(group_id, event.source.user_id)
-            is_animated = True if event.message.sticker_resource_type == 'ANIMATION' else False
-            sticker_file = get_sticker_file(event.message.package_id, event.message.sticker_id, is_animated)
-            if not sticker_file:
-                logger.warning(f"無法找到貼圖: package_id={event.message.package_id}, sticker_id={event.message.sticker_id}")
-                return
-            discord_webhook = SyncWebhook.from_url(subscribed_info['discord_channel_webhook'])
-            try:
-                discord_webhook.send(file=File(sticker_file),
-                                    username=f"{author.display_name} - (Line訊息)",
-                                    avatar_url=author.picture_url)
-                logger.info(f"已傳送貼圖至 Discord: {sticker_file}")
-            finally:
-                if os.path.exists(sticker_file):
-                    os.remove(sticker_file)
-                    logger.debug(f"已刪除貼圖檔案: {sticker_file}")
+@pipeline.content_stage
+def handle_sticker_message(context: MessageContext):
+    message = context.event.message
+    context.label = '貼圖'
+    is_animated = True if message.sticker_resource_type == 'ANIMATION' else False
+    sticker = sticker_cache.get(message.package_id, message.sticker_id, is_animated, get_sticker_file)
+    if not sticker:
+        logger.warning("無法找到貼圖: package_id=%s, sticker_id=%s", message.package_id, message.sticker_id)
+        return False
+    # Sticker files are kept for the next use
+    context.file_data, context.file_path = sticker
+    context.remove_file = False
 
 @handler.add(MessageEvent, message=ImageMessageContent)
-def handle_image_message(event):
-    with ApiClient(configuration) as api_client:
-        if event.source.type == 'user':
-            logger.debug("忽略來自單獨用戶的圖片訊息")
-            return
-        line_bot_api = MessagingApi(api_client)
-        group_id = event.source.group_id
-        if group_id in sync_channels_cache.line_group_ids:
-            subscribed_info = sync_channels_cache.get_info_by_line_group_id(group_id)
-            author = line_bot_api.get_group_member_profile(group_id, event.source.user_id)
-            file_path = download_content(event.message.id, subscribed_info['folder_name'], 'image')
-            discord_webhook = SyncWebhook.from_url(subscribed_info['discord_channel_webhook'])
-            try:
-                discord_webhook.send(file=File(file_path),
-                                    username=f"{author.display_name} - (Line訊息)",
-                                    avatar_url=author.picture_url)
-                logger.info(f"已傳送圖片至 Discord: {file_path}")
-            finally:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.debug(f"已刪除圖片檔案: {file_path}")
+@pipeline.content_stage
+def handle_image_message(context: MessageContext):
+    context.label = '圖片'
+    fetch_media(context, 'image')
 
 @handler.add(MessageEvent, message=VideoMessageContent)
-def handle_video_message(event):
-    with ApiClient(configuration) as api_client:
-        if event.source.type == 'user':
-            logger.debug("忽略來自單獨用戶的影片訊息")
-            return
-        line_bot_api = MessagingApi(api_client)
-        group_id = event.source.group_id
-        if group_id in sync_channels_cache.line_group_ids:
-            subscribed_info = sync_channels_cache.get_info_by_line_group_id(group_id)
-            author = line_bot_api.get_group_member_profile(group_id, event.source.user_id)
-            file_path = download_content(event.message.id, subscribed_info['folder_name'], 'video')
-            discord_webhook = SyncWebhook.from_url(subscribed_info['discord_channel_webhook'])
-            try:
-                discord_webhook.send(file=File(file_path),
-                                    username=f"{author.display_name} - (Line訊息)",
-                                    avatar_url=author.picture_url)
-                logger.info(f"已傳送影片至 Discord: {file_path}")
-            finally:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.debug(f"已刪除影片檔案: {file_path}")
+@pipeline.content_stage
+def handle_video_message(context: MessageContext):
+    context.label = '影片'
+    fetch_media(context, 'video')
 
 @handler.add(MessageEvent, message=AudioMessageContent)
-def handle_audio_message(event):
-    with ApiClient(configuration) as api_client:
-        if event.source.type == 'user':
-            logger.debug("忽略來自單獨用戶的音訊訊息")
-            return
-        line_bot_api = MessagingApi(api_client)
-        group_id = event.source.group_id
-        if group_id in sync_channels_cache.line_group_ids:
-            subscribed_info = sync_channels_cache.get_info_by_line_group_id(group_id)
-            author = line_bot_api.get_group_member_profile(group_id, event.source.user_id)
-            file_path = download_content(event.message.id, subscribed_info['folder_name'], 'audio')
-            discord_webhook = SyncWebhook.from_url(subscribed_info['discord_channel_webhook'])
-            try:
-                discord_webhook.send(file=File(file_path),
-                                    username=f"{author.display_name} - (Line訊息)",
-                                    avatar_url=author.picture_url)
-                logger.info(f"已傳送音訊至 Discord: {file_path}")
-            finally:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.debug(f"已刪除音訊檔案: {file_path}")
+@pipeline.content_stage
+def handle_audio_message(context: MessageContext):
+    context.label = '音訊'
+    fetch_media(context, 'audio')
 
 @handler.add(MessageEvent, message=FileMessageContent)
-def handle_file_message(event):
-    with ApiClient(configuration) as api_client:
-        if event.source.type == 'user':
-            logger.debug("忽略來自單獨用戶的檔案訊息")
-            return
-        line_bot_api = MessagingApi(api_client)
-        group_id = event.source.group_id
-        if group_id in sync_channels_cache.line_group_ids:
-            subscribed_info = sync_channels_cache.get_info_by_line_group_id(group_id)
-            author = line_bot_api.get_group_member_profile(group_id, event.source.user_id)
-            file_path = download_content(event.message.id, subscribed_info['folder_name'], 'file', file_name=event.message.file_name)
-            discord_webhook = SyncWebhook.from_url(subscribed_info['discord_channel_webhook'])
-            try:
-                discord_webhook.send(file=File(file_path),
-                                    username=f"{author.display_name} - (Line訊息)",
-                                    avatar_url=author.picture_url)
-                logger.info(f"已傳送檔案至 Discord: {file_path}")
-            finally:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.debug(f"已刪除檔案: {file_path}")
+@pipeline.content_stage
+def handle_file_message(context: MessageContext):
+    context.label = '檔案'
+    fetch_media(context, 'file', file_name=context.event.message.file_name)
 
 @handler.add(MessageEvent, message=LocationMessageContent)
-def handle_location_message(event):
-    with ApiClient(configuration) as api_client:
-        if event.source.type == 'user':
-            logger.debug("忽略來自單獨用戶的位置訊息")
+@pipeline.content_stage
+def handle_location_message(context: MessageContext):
+    context.label = '位置訊息'
+    location = context.event.message
+    if hasattr(location, 'address') and location.address:
+        encoded_address = urllib.parse.quote(location.address)
+        google_maps_link = f"https://www.google.com/maps/place/{encoded_address}"
+    else:
+        google_maps_link = f"https://www.google.com/maps?q={location.latitude},{location.longitude}"
+
+    location_message = f"📍 {context.author.display_name}分享了位置訊息\n\n"
+    if hasattr(location, 'title') and location.title:
+        location_message += f"地點名稱: **{location.title}**\n"
+    if hasattr(location, 'address') and location.address:
+        location_message += f"詳細地址: [{location.address}]({google_maps_link})\n"
+    else:
+        location_message += google_maps_link
+    context.text = location_message
+
+def fetch_media(context: MessageContext, content_type: str, file_name: str = None):
+    """Content stage part of media messages: get the content to Discord by its size.
+
+    Content within the Discord upload limit is uploaded as before. Larger videos are
+    re-encoded to fit when ffmpeg is available; anything else too large is moved into the
+    media relay and sent as a link, or, when even the relay can't hold it, linked to
+    /line-content without being downloaded at all. The size is taken from the event
+    (files) or the Content-Length of the content response before its body is read, so
+    content is downloaded at most once and only when it is going to be used.
+
+    :param MessageContext context: Context of the message, `label` already set.
+    :param str content_type: image, video, audio or file.
+    :param str file_name: Name of a file message.
+    """
+    message = context.event.message
+    duration_ms = getattr(message, 'duration', None)
+    size = getattr(message, 'file_size', None)
+
+    def accept_size(content_length: int | None) -> bool:
+        nonlocal size
+        size = content_length or size
+        return media.route(size, content_type, duration_ms) not in (media.PROXY, media.SKIP)
+
+    file_path = None
+    if accept_size(size):
+        file_path = download_content(message.id, context.route['folder_name'], content_type,
+                                     file_name, accept_size)
+    if file_path:
+        size = os.path.getsize(file_path)
+    route = media.route(size, content_type, duration_ms)
+    if route == media.UPLOAD:
+        context.file_path = file_path
+        return
+    if route == media.SHRINK:
+        shrunk_path = f"{os.path.splitext(file_path)[0]}_shrunk.mp4"
+        try:
+            media.shrink_video(file_path, shrunk_path, duration_ms, media.DISCORD_UPLOAD_MAX_BYTES)
+            os.remove(file_path)
+            context.file_path = shrunk_path
+            logger.info("影片超過 Discord 上傳上限，已壓縮: %.1f MB -> %.1f MB", size / 1024 / 1024,
+                        os.path.getsize(shrunk_path) / 1024 / 1024)
             return
-        line_bot_api = MessagingApi(api_client)
-        group_id = event.source.group_id
-        if group_id in sync_channels_cache.line_group_ids:
-            subscribed_info = sync_channels_cache.get_info_by_line_group_id(group_id)
-            author = line_bot_api.get_group_member_profile(group_id, event.source.user_id)
-            location = event.message
-            if hasattr(location, 'address') and location.address:
-                encoded_address = urllib.parse.quote(location.address)
-                google_maps_link = f"https://www.google.com/maps/place/{encoded_address}"
-            else:
-                google_maps_link = f"https://www.google.com/maps?q={location.latitude},{location.longitude}"
-
-            location_message = f"📍 {author.display_name}分享了位置訊息\n\n"
-            if hasattr(location, 'title') and location.title:
-                location_message += f"地點名稱: **{location.title}**\n"
-            if hasattr(location, 'address') and location.address:
-                location_message += f"詳細地址: [{location.address}]({google_maps_link})\n"
-            else:
-                location_message += google_maps_link
-
-            discord_webhook = SyncWebhook.from_url(subscribed_info['discord_channel_webhook'])
-            discord_webhook.send(location_message, username=f"{author.display_name} - (Line訊息)",
-                                avatar_url=author.picture_url)
-            logger.info(f"已傳送位置訊息至 Discord: {location_message}")
+        except Exception as e:
+            logger.warning("壓縮影片失敗，改以連結傳送: %s", e)
+            if os.path.exists(shrunk_path):
+                os.remove(shrunk_path)
+            route = media.route(size, content_type, duration_ms, allow_shrink=False)
+    size_text = f"{size / 1024 / 1024:.1f} MB"
+    if route == media.RELAY:
+        entry = media_relay.store.put_file(file_path, relay_name(file_path))
+        # Kept in the relay for the link, archived from there, not uploaded
+        context.file_path = entry.path
+        context.remove_file = False
+        context.upload = False
+        link = media_relay.store.url_for(entry)
+    else:
+        if file_path:
+            os.remove(file_path)
+        link = content_link(message.id)
+    context.text = (f"傳送了{context.label}（{size_text}）：{link}" if link
+                    else f"傳送了{context.label}（{size_text}，超過 Discord 上傳上限，未能轉傳）")
+    logger.info("%s超過 Discord 上傳上限 (%s)，改以連結傳送 (%s): message_id=%s", context.label,
+                size_text, route, message.id)
+
+
+def relay_name(file_path: str) -> str:
+    """Media relay store name of a downloaded file, `<sha256>.<ext>`."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(CONTENT_CHUNK_SIZE):
+            digest.update(chunk)
+    extension = os.path.splitext(file_path)[1].lower()
+    if not re.fullmatch(r'\.[a-z0-9]{1,5}', extension):
+        extension = '.bin'
+    return f"{digest.hexdigest()}{extension}"
+
+
+def remove_partial_downloads(download_dir: str = './downloads'):
+    """Remove downloads left unfinished by a crash or a killed process."""
+    for path in glob.glob(os.path.join(download_dir, '**', f'*{PARTIAL_SUFFIX}'), recursive=True):
+        try:
+            os.remove(path)
+            logger.info("已移除未完成的下載: %s", path)
+        except OSError as e:
+            logger.warning("無法移除未完成的下載 %s: %s", path, e)
+
+
+remove_partial_downloads()
+
 
 def download_content(message_id: str, folder_name: str, content_type: str,
-                     file_name: str = None) -> str:
+                     file_name: str = None, accept_size=None) -> str | None:
     """Download content from LINE.
 
     :param str message_id: Message ID from LINE.
     :param str folder_name: The name of the folder you want to save files at.
     :param str content_type: File type, image, video, audio or file.
     :param str file_name: The file name you want to save as. Only used when content_type is file.
-    :return str: The path of the downloaded file.
+    :param accept_size: Called with the Content-Length (None if not sent) before the body is
+        read, the download is skipped when it returns False.
+    :return str: The path of the downloaded file, None if skipped.
     """
+    # Content can only be read by the account that received the message
     type_map = {
         'image': 'jpg',
         'video': 'mp4',
@@ -406,11 +850,16 @@ def download_content(message_id: str, folder_name: str, content_type: str,
         'file': 'Get file name from args'
     }
 
-    headers = {"Authorization": f"Bearer {config['line_channel_access_token']}"}
-    url = f"https://api-data.line.me/v2/bot/message/{message_id}/content"
+    headers = {"Authorization": f"Bearer {current_account.get(accounts.default).access_token}"}
+    url = f"{config['line_data_api_endpoint']}/v2/bot/message/{message_id}/content"
     try:
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, stream=True, timeout=(10, 300))
         response.raise_for_status()
+        content_length = int(response.headers.get('Content-Length') or 0) or None
+        if accept_size is not None and not accept_size(content_length):
+            response.close()
+            logger.debug("略過下載 LINE 內容: message_id=%s, 大小 %s bytes", message_id, content_length)
+            return None
         download_path = f"./downloads/{folder_name}/"
         if not os.path.exists(download_path):
             os.makedirs(download_path)
@@ -421,13 +870,22 @@ def download_content(message_id: str, folder_name: str, content_type: str,
             file_name = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}.{type_map[content_type]}"
 
         file_path = f"{download_path}{file_name}"
-        with open(file_path, 'wb') as fd:
-            for chunk in response.iter_content():
-                fd.write(chunk)
-        logger.debug(f"檔案下載成功: {file_path}")
+        # Written under another name until complete, so a shutdown never leaves a truncated
+        # file behind that looks like a finished download
+        part_path = f"{file_path}{PARTIAL_SUFFIX}"
+        try:
+            with open(part_path, 'wb') as fd:
+                for chunk in response.iter_content(CONTENT_CHUNK_SIZE):
+                    fd.write(chunk)
+            os.replace(part_path, file_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        logger.debug("檔案下載成功: %s", file_path)
         return file_path
     except Exception as e:
-        logger.error(f"下載 LINE 內容失敗: message_id={message_id}, 錯誤: {e}")
+        logger.error("下載 LINE 內容失敗: message_id=%s, 錯誤: %s", message_id, e)
         raise
 
 def get_sticker_file(sticker_package_id: int, single_sticker_id: int,
@@ -458,16 +916,16 @@ def get_sticker_file(sticker_package_id: int, single_sticker_id: int,
         if is_animation:
             if file_name.startswith(f"{single_sticker_id}.gif"):
                 sticker_path = os.path.join(sticker_package_dir, file_name)
-                logger.debug(f"找到動畫貼圖: {sticker_path}")
+                logger.debug("找到動畫貼圖: %s", sticker_path)
                 return sticker_path
             continue
         else:
             if file_name.startswith(f"{single_sticker_id}.png"):
                 sticker_path = os.path.join(sticker_package_dir, file_name)
-                logger.debug(f"找到靜態貼圖: {sticker_path}")
+                logger.debug("找到靜態貼圖: %s", sticker_path)
                 return sticker_path
             continue
-    logger.warning(f"貼圖未找到: package_id={sticker_package_id}, sticker_id={single_sticker_id}")
+    logger.warning("貼圖未找到: package_id=%s, sticker_id=%s", sticker_package_id, single_sticker_id)
     return None
 
 if __name__ == '__main__':
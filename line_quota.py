@@ -0,0 +1,273 @@
+import asyncio
+import calendar
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from linebot.v3.messaging import MessagingApi
+
+logger = logging.getLogger(__name__)
+
+SEND = 'send'
+DIGEST = 'digest'
+HOLD = 'hold'
+
+MEMBER_COUNT_TTL = 24 * 60 * 60
+DIGEST_MAX_LINES = 200
+TEXT_MAX_CHARS = 5000
+PUSH_MAX_MESSAGES = 5
+
+
+class QuotaExhausted(Exception):
+    """The month's quota can't pay for a push to a LINE group."""
+
+
+class QuotaManager:
+    """Keep LINE pushes within the monthly message quota.
+
+    The quota and usage are read from the LINE API every `refresh_seconds` and pushes
+    since then are counted locally. A push to a group costs one message per member, so
+    member counts are looked up and cached per group.
+
+    The remaining quota is spread over the remaining days of the month. Each day's budget
+    is shared between the bindings active that day in proportion to their weight; a
+    binding over its share, or any binding once the day budget is spent, gets DIGEST so
+    its messages are coalesced, and HOLD when the month's quota can't pay for a push.
+    Pushes are also paced to `rate_per_second` to stay under the API rate limit.
+
+    Quota and rate limits belong to a LINE channel, so every LINE account has its own.
+    """
+
+    def __init__(self, api: MessagingApi, refresh_seconds: float, weights: dict,
+                 rate_per_second: float):
+        self.refresh_seconds = refresh_seconds
+        self.weights = weights
+        self.rate_per_second = rate_per_second
+        self.limit: int | None = None
+        self.used = 0
+        self.refreshed_at = 0.0
+        self.stats = {SEND: 0, DIGEST: 0, HOLD: 0}
+        self._api = api
+        self._day = None
+        self._day_budget = None
+        self._used_today: dict[str, int] = defaultdict(int)
+        self._member_counts: dict[str, tuple[int, float]] = {}
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._next_push = 0.0
+
+    def decide(self, line_group_id: str, folder_name: str) -> str:
+        """Decide how a message to a LINE group should be sent.
+
+        Blocks on the first call while the quota is read, so call it off the event loop.
+
+        :param str line_group_id: The LINE group ID.
+        :param str folder_name: Folder name of the binding, the key of its weight.
+        :return str: SEND, DIGEST or HOLD.
+        """
+        decision = self._decide(line_group_id, folder_name)
+        self.stats[decision] += 1
+        return decision
+
+    def can_send_digest(self, line_group_id: str, folder_name: str) -> bool:
+        """Whether the held digest of a LINE group can be pushed now.
+
+        A digest is a push like any other, so it has to fit in the day budget and the
+        share of its binding too; until then its lines keep waiting.
+        """
+        return self._decide(line_group_id, folder_name) == SEND
+
+    def _decide(self, line_group_id: str, folder_name: str) -> str:
+        if not self.refreshed_at:
+            self.refresh()
+        elif time.time() - self.refreshed_at > self.refresh_seconds:
+            self._refresh_in_background()
+        if self.limit is None:
+            decision = SEND
+        else:
+            cost = self.member_count(line_group_id)
+            with self._lock:
+                self._roll_day()
+                remaining = self.limit - self.used
+                used_today = sum(self._used_today.values())
+                if remaining < cost:
+                    decision = HOLD
+                elif used_today + cost > self._day_budget or \
+                        self._used_today[folder_name] + cost > self._share(folder_name):
+                    decision = DIGEST
+                else:
+                    decision = SEND
+        return decision
+
+    def consume(self, line_group_id: str, folder_name: str | None = None):
+        """Count a push to a LINE group against the quota."""
+        cost = self.member_count(line_group_id)
+        with self._lock:
+            self._roll_day()
+            self.used += cost
+            self._used_today[folder_name or line_group_id] += cost
+
+    def can_push(self, line_group_id: str) -> bool:
+        """Whether the month's quota can pay for a push to a group."""
+        return self.limit is None or self.limit - self.used >= self.member_count(line_group_id)
+
+    def wait_for_rate_limit(self):
+        """Sleep until the next push is allowed by the rate limit. Call from a worker thread."""
+        if not self.rate_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_push)
+            self._next_push = slot + 1 / self.rate_per_second
+        if slot > now:
+            time.sleep(slot - now)
+
+    def member_count(self, line_group_id: str) -> int:
+        cached = self._member_counts.get(line_group_id)
+        if cached is not None and time.time() - cached[1] < MEMBER_COUNT_TTL:
+            return cached[0]
+        try:
+            count = self._api.get_group_member_count(line_group_id).count
+        except Exception as e:
+            logger.warning("無法取得 LINE 群組 %s 成員數，以 1 計算: %s", line_group_id, e)
+            count = cached[0] if cached else 1
+        self._member_counts[line_group_id] = (count, time.time())
+        return count
+
+    def refresh(self):
+        """Read the quota and the usage of this month from the LINE API."""
+        try:
+            quota = self._api.get_message_quota()
+            usage = self._api.get_message_quota_consumption().total_usage
+        except Exception as e:
+            logger.warning("無法取得 LINE 訊息額度: %s", e)
+            self.refreshed_at = self.refreshed_at or time.time()
+            return
+        with self._lock:
+            self.limit = quota.value if quota.type == 'limited' else None
+            self.used = usage
+            self.refreshed_at = time.time()
+        logger.info("LINE 訊息額度: 已使用 %s / %s", usage,
+                    self.limit if self.limit is not None else '無上限')
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='line-quota', daemon=True).start()
+
+    def _roll_day(self):
+        today = datetime.date.today()
+        if today != self._day:
+            if self._day is not None and today.month != self._day.month:
+                self.used = 0
+            self._day = today
+            self._day_budget = None
+            self._used_today.clear()
+        if self._day_budget is None and self.limit is not None:
+            days_left = calendar.monthrange(today.year, today.month)[1] - today.day + 1
+            self._day_budget = max(0, self.limit - self.used) / days_left
+
+    def _share(self, folder_name: str) -> float:
+        active = set(self._used_today) | {folder_name}
+        total_weight = sum(self.weights.get(name, 1) for name in active)
+        return self._day_budget * self.weights.get(folder_name, 1) / total_weight
+
+
+class DigestBuffer:
+    """Coalesce messages to LINE groups into one push per group and interval.
+
+    :param send: Function pushing a list of texts to a LINE group, run in a thread.
+    :param may_send: Function telling whether the digest of a LINE group can be pushed now,
+        within the day budget of the quota; held digests wait until it can. Run in a thread.
+    :param float interval: Seconds between digests of a group.
+    """
+
+    def __init__(self, send, may_send, interval: float):
+        self.send = send
+        self.may_send = may_send
+        self.interval = interval
+        self.dropped = 0
+        self._lines: dict[str, deque] = {}
+        self._task: asyncio.Task | None = None
+
+    def add(self, line_group_id: str, line: str):
+        """Queue a line for the next digest of a group."""
+        lines = self._lines.setdefault(line_group_id, deque(maxlen=DIGEST_MAX_LINES))
+        if len(lines) == lines.maxlen:
+            self.dropped += 1
+            logger.warning("LINE 摘要佇列已滿，捨棄最舊的訊息 (累計 %s 筆)", self.dropped,
+                           extra={'rate_key': 'line_digest_full'})
+        lines.append(line)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def pending(self) -> int:
+        return sum(len(lines) for lines in self._lines.values())
+
+    def take(self) -> list[dict]:
+        """Take every queued line out, e.g. to save them at shutdown.
+
+        :return list: {'line_group_id', 'line'} of the lines, oldest first per group.
+        """
+        taken = [{'line_group_id': line_group_id, 'line': line}
+                 for line_group_id, lines in self._lines.items() for line in lines]
+        self._lines.clear()
+        return taken
+
+    async def flush(self):
+        """Push the digest of every group with queued lines that the quota allows.
+
+        Lines stay queued while they are sent, and are only removed once the push succeeded.
+        """
+        for line_group_id in list(self._lines):
+            lines = self._lines.get(line_group_id)
+            if not lines:
+                self._lines.pop(line_group_id, None)
+                continue
+            if not await asyncio.to_thread(self.may_send, line_group_id):
+                continue
+            sent = list(lines)
+            texts = _pack("（額度節流中，以下為 {} 則訊息摘要）".format(len(sent)), sent)
+            try:
+                await asyncio.to_thread(self.send, line_group_id, texts)
+            except Exception as e:
+                logger.error("傳送摘要至 LINE 群組 %s 失敗，保留 %s 則訊息: %s", line_group_id, len(sent), e)
+                continue
+            logger.info("已傳送 %s 則訊息的摘要至 LINE 群組 %s", len(sent), line_group_id)
+            # Lines may have been added, or the oldest dropped, while sending
+            for line in sent:
+                if lines and lines[0] == line:
+                    lines.popleft()
+            if not lines and self._lines.get(line_group_id) is lines:
+                del self._lines[line_group_id]
+
+    async def _run(self):
+        while self._lines:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+def _pack(title: str, lines) -> list[str]:
+    """Pack lines into at most PUSH_MAX_MESSAGES texts of TEXT_MAX_CHARS."""
+    texts = [title]
+    for line in lines:
+        line = line[:TEXT_MAX_CHARS - 1]
+        if len(texts[-1]) + 1 + len(line) <= TEXT_MAX_CHARS:
+            texts[-1] += '\n' + line
+        elif len(texts) < PUSH_MAX_MESSAGES:
+            texts.append(line)
+        else:
+            texts[-1] = texts[-1][:TEXT_MAX_CHARS - 2] + '…'
+            break
+    return texts
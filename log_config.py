@@ -0,0 +1,161 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed through `extra=` and is
+# emitted as a structured field by JsonFormatter.
+_RECORD_ATTRS = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {
+    'message', 'asctime', 'rate_key'}
+
+_listener: logging.handlers.QueueListener | None = None
+_options: tuple | None = None
+_redact_content = True
+
+
+class Content:
+    """Message content passed as a logging argument.
+
+    The text is only rendered when the record is actually emitted, and is replaced by its
+    length when content redaction is enabled.
+    """
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        text = '' if self.text is None else str(self.text)
+        if _redact_content:
+            return f'<{len(text)} 字元>'
+        return text
+
+
+def content(text) -> Content:
+    """Wrap user generated text so it can be redacted in logs.
+
+    :param text: The message content.
+    :return Content: Lazy, redactable wrapper for the content.
+    """
+    return Content(text)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value if isinstance(value, (int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """Drop repeated warnings with the same key within an interval.
+
+    The key is the `rate_key` passed through `extra=`, or the logger name, template and
+    arguments of the record. The next emitted record of a key reports how many were dropped.
+    """
+
+    def __init__(self, interval: float, max_keys: int = 4096):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self._seen: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.interval <= 0:
+            return True
+        key = getattr(record, 'rate_key', None)
+        if key is None:
+            key = (record.name, record.msg, tuple(str(arg) for arg in record.args or ()))
+        now = time.monotonic()
+        with self._lock:
+            last_emitted, suppressed = self._seen.get(key, (None, 0))
+            if last_emitted is not None and now - last_emitted < self.interval:
+                self._seen[key] = (last_emitted, suppressed + 1)
+                return False
+            self._seen[key] = (now, 0)
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_keys:
+                self._seen.popitem(last=False)
+        if suppressed:
+            record.msg = f'{record.msg} (已略過 {suppressed} 筆重複紀錄)'
+        return True
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(config: dict | None = None):
+    """Route all logging through a background queue listener.
+
+    Calling it again with the same options is a no-op, so every module may call it.
+
+    :param dict config: Config read by `utilities.read_config`, None to use defaults.
+    """
+    global _listener, _options, _redact_content
+    config = config or {}
+    options = (str(config.get('log_level', 'INFO')).upper(),
+               config.get('log_format', 'text'),
+               bool(config.get('log_redact_content', True)),
+               float(config.get('log_rate_limit_seconds', 60)))
+    if options == _options:
+        return
+    level, log_format, redact, rate_limit = options
+
+    if _listener is not None:
+        _listener.stop()
+    _redact_content = redact
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if log_format == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _LazyQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate_limit))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    _options = options
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener, _options
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        _options = None
+
+
+atexit.register(shutdown_logging)
@@ -1,4 +1,6 @@
 import asyncio
+import contextlib
+import signal
 
 import uvicorn
 
@@ -6,17 +8,55 @@ import utilities as utils
 from cache import sync_channels_cache
 from discord_bot import client, on_ready, about, help, link, unlink
 from line_bot import app as fastapi_app
+import diagnostics
+from health import health
 from keep_alive import keep_alive_task
+from lifecycle import lifecycle
+import server_runtime
+from warm_start import warm_start
 
 config = utils.read_config()
 
+
+class WebhookServer(uvicorn.Server):
+    """uvicorn server that leaves SIGTERM/SIGINT to the lifecycle.
+
+    uvicorn would stop right away on a signal, while webhooks still need a 503 answer
+    during the drain and queued messages need the Discord client.
+    """
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+
+server = WebhookServer(server_runtime.server_config(fastapi_app, "0.0.0.0", config['webhook_port']))
+
+
+async def stop_servers():
+    server.should_exit = True
+    await client.close()
+
+
+def install_signal_handlers():
+    """Start a graceful shutdown on SIGTERM/SIGINT, a second signal hurries it."""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, lifecycle.request_stop, stop_servers)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers
+            signal.signal(signum, lambda *_: loop.call_soon_threadsafe(lifecycle.request_stop,
+                                                                       stop_servers))
+
 async def setup_hook():
-    webhook_url = config.get('webhook_url')
-    client.loop.create_task(keep_alive_task(webhook_url))
+    health.start()
+    diagnostics.detector.start()
+    client.loop.create_task(keep_alive_task(config['webhook_url']))
+    client.loop.create_task(utils.watch_sync_channels(config['sync_channels_reload_seconds']))
+    client.loop.create_task(warm_start.run())
 
 async def run_linebot():
-    host_config = uvicorn.Config(fastapi_app, host="0.0.0.0", port=config['webhook_port'])
-    server = uvicorn.Server(host_config)
     await server.serve()
 
 
@@ -36,8 +76,11 @@ async def run_discord_bot():
 async def main():
     # Initialize the cache
     sync_channels_cache.load_all_sync_channels()
+    # Work left by the last shutdown is queued before new webhooks and Discord messages
+    await lifecycle.restore()
 
     client.setup_hook = setup_hook
+    install_signal_handlers()
 
     await asyncio.gather(
         run_linebot(),
@@ -47,4 +90,5 @@ async def main():
 
 
 if __name__ == '__main__':
+    server_runtime.install_event_loop()
     asyncio.run(main())
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import utilities as utils
+from media_relay import RELAY_DIR, RELAY_MAX_SHARE, MediaEntry, MediaStore, probe_duration_ms, \
+    store
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, images are then forwarded as they are
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+FFMPEG = shutil.which('ffmpeg')
+
+# LINE Messaging API limits, see https://developers.line.biz/en/reference/messaging-api/#image-message
+LINE_IMAGE_FORMATS = ('jpeg', 'png')
+LINE_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+LINE_PREVIEW_MAX_BYTES = 1024 * 1024
+LINE_VIDEO_SUFFIXES = ('.mp4',)
+LINE_AUDIO_SUFFIXES = ('.m4a', '.mp3')
+PREVIEW_SIZE = (480, 480)
+AVATAR_SIZE = (240, 240)
+# Videos shrunk for a Discord upload: audio bitrate, lowest video bitrate worth sending
+SHRINK_AUDIO_BITRATE = 64_000
+SHRINK_MIN_VIDEO_BITRATE = 250_000
+# How LINE media reaches Discord, see route
+UPLOAD = 'upload'
+SHRINK = 'shrink'
+RELAY = 'relay'
+PROXY = 'proxy'
+SKIP = 'skip'
+DISCORD_UPLOAD_MAX_BYTES = config['discord_upload_limit_mb'] * 1024 * 1024
+
+
+class MediaProcessor:
+    """Produce LINE compatible media and preview thumbnails from Discord attachments.
+
+    Sources are fetched once through the media relay store and every result is stored
+    there under the SHA-256 of the source, so the same attachment is processed once.
+    CPU bound work runs on a thread pool; when Pillow or ffmpeg is missing the matching
+    step is skipped and the relayed original is used instead.
+    """
+
+    def __init__(self, media_store: MediaStore, workers: int):
+        self.store = media_store
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media')
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.store.enabled
+
+    async def prepare_image(self, url: str) -> tuple[str, str]:
+        """Get the original and preview URLs of an image.
+
+        :param str url: URL of the Discord attachment.
+        :return tuple: (originalContentUrl, previewImageUrl) for an ImageMessage.
+        """
+        if not self.enabled:
+            return url, url
+        try:
+            return await self._prepare_image(url)
+        except Exception as e:
+            logger.warning("處理圖片失敗，改用原始網址: %s, 錯誤: %s", url, e)
+            return url, url
+
+    async def _prepare_image(self, url: str) -> tuple[str, str]:
+        source = await self.store.fetch(url)
+        if Image is None:
+            relay_url = self.store.url_for(source)
+            return relay_url, relay_url
+        image_format = await self._run(_image_format, source.path)
+        if image_format in LINE_IMAGE_FORMATS and source.size <= LINE_IMAGE_MAX_BYTES:
+            original_url = self.store.url_for(source)
+        else:
+            original_url = self.store.url_for(
+                await self._produce(source, 'full', '.jpg', _to_jpeg))
+        preview = await self._produce(source, 'preview', '.jpg', _image_preview)
+        return original_url, self.store.url_for(preview)
+
+    async def prepare_avatar(self, url: str) -> str:
+        """Get the URL of an avatar resized for LINE.
+
+        :param str url: URL of the Discord avatar, as PNG.
+        :return str: URL of a small JPEG, or `url` when it can't be made.
+        """
+        if not self.enabled or Image is None:
+            return url
+        try:
+            source = await self.store.fetch(url)
+            avatar = await self._produce(source, 'avatar', '.jpg', _to_jpeg, AVATAR_SIZE,
+                                         LINE_PREVIEW_MAX_BYTES)
+            return self.store.url_for(avatar)
+        except Exception as e:
+            logger.warning("處理頭像失敗，改用原始網址: %s, 錯誤: %s", url, e)
+            return url
+
+    async def prepare_video(self, url: str, preview_fallback: str) -> tuple[str, str]:
+        """Get the MP4 and preview URLs of a video.
+
+        :param str url: URL of the Discord attachment.
+        :param str preview_fallback: Preview URL to use when no thumbnail can be made.
+        :return tuple: (originalContentUrl, previewImageUrl) for a VideoMessage.
+        """
+        if not self.enabled:
+            return url, preview_fallback
+        try:
+            return await self._prepare_video(url, preview_fallback)
+        except Exception as e:
+            logger.warning("處理影片失敗，改用原始網址: %s, 錯誤: %s", url, e)
+            return url, preview_fallback
+
+    async def _prepare_video(self, url: str, preview_fallback: str) -> tuple[str, str]:
+        source = await self.store.fetch(url)
+        if FFMPEG is None:
+            return self.store.url_for(source), preview_fallback
+        if os.path.splitext(source.name)[1] in LINE_VIDEO_SUFFIXES:
+            video = source
+        else:
+            video = await self._produce(source, 'video', '.mp4', _ffmpeg_transcode,
+                                        ['-c:v', 'libx264', '-preset', 'veryfast',
+                                         '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+                                         '-movflags', '+faststart'])
+        preview = await self._produce(source, 'preview', '.jpg', _ffmpeg_transcode,
+                                      ['-frames:v', '1', '-vf', f'scale={PREVIEW_SIZE[0]}:-2'])
+        return self.store.url_for(video), self.store.url_for(preview)
+
+    async def prepare_audio(self, url: str) -> tuple[str, int | None]:
+        """Get the URL and duration of an audio file in a format LINE accepts.
+
+        :param str url: URL of the Discord attachment.
+        :return tuple: (originalContentUrl, duration in milliseconds or None if unknown).
+        """
+        if not self.enabled:
+            return url, None
+        try:
+            source = await self.store.fetch(url, probe_duration=True)
+            if FFMPEG is None or os.path.splitext(source.name)[1] in LINE_AUDIO_SUFFIXES:
+                return self.store.url_for(source), source.duration_ms
+            audio = await self._produce(source, 'audio', '.m4a', _ffmpeg_transcode,
+                                        ['-vn', '-c:a', 'aac', '-b:a', '128k'])
+            return self.store.url_for(audio), audio.duration_ms or source.duration_ms
+        except Exception as e:
+            logger.warning("處理音訊失敗，改用原始網址: %s, 錯誤: %s", url, e)
+            return url, None
+
+    async def close(self):
+        await self.store.close()
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _produce(self, source: MediaEntry, variant: str, extension: str, func,
+                       *args) -> MediaEntry:
+        """Run a conversion once per source and variant."""
+        name = f'{source.digest}_{variant}{extension}'
+        entry = self.store.get(name)
+        if entry is not None and os.path.exists(entry.path):
+            return entry
+        future = self._in_flight.get(name)
+        if future is None:
+            future = asyncio.ensure_future(self._convert(source, name, extension, func, *args))
+            self._in_flight[name] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(name, None))
+        return await asyncio.shield(future)
+
+    async def _convert(self, source: MediaEntry, name: str, extension: str, func,
+                       *args) -> MediaEntry:
+        os.makedirs(RELAY_DIR, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=RELAY_DIR, suffix=f'.part{extension}')
+        os.close(fd)
+        try:
+            await self._run(func, source.path, temp_path, *args)
+            duration_ms = None
+            if extension in LINE_AUDIO_SUFFIXES:
+                duration_ms = await self._run(probe_duration_ms, temp_path)
+            entry = self.store.put_file(temp_path, name, duration_ms)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logger.debug("已產生媒體檔案: %s (%s bytes)", entry.name, entry.size)
+        return entry
+
+
+def _image_format(path: str) -> str | None:
+    with Image.open(path) as image:
+        return (image.format or '').lower()
+
+
+def _to_jpeg(source_path: str, output_path: str, max_size: tuple | None = None,
+             max_bytes: int = LINE_IMAGE_MAX_BYTES):
+    with Image.open(source_path) as image:
+        image.seek(0)
+        image = image.convert('RGB')
+        if max_size:
+            image.thumbnail(max_size)
+        quality = 85
+        while True:
+            image.save(output_path, format='JPEG', quality=quality, optimize=True)
+            if os.path.getsize(output_path) <= max_bytes or quality <= 30:
+                return
+            quality -= 15
+
+
+def _image_preview(source_path: str, output_path: str):
+    _to_jpeg(source_path, output_path, PREVIEW_SIZE, LINE_PREVIEW_MAX_BYTES)
+
+
+def route(size: int | None, content_type: str, duration_ms: int | None,
+          allow_shrink: bool = True) -> str:
+    """Pick how LINE content of a given size reaches Discord.
+
+    :param int size: Content size in bytes, None if not known yet.
+    :param str content_type: image, video, audio or file.
+    :param int duration_ms: Duration of a video, used to tell whether it can be shrunk.
+    :param bool allow_shrink: False to skip SHRINK, e.g. after shrinking the video failed.
+    :return str: UPLOAD, SHRINK, RELAY, PROXY or SKIP.
+    """
+    if size is None or size <= DISCORD_UPLOAD_MAX_BYTES:
+        return UPLOAD
+    if allow_shrink and content_type == 'video' and \
+            can_shrink_video(duration_ms, DISCORD_UPLOAD_MAX_BYTES):
+        return SHRINK
+    if store.enabled and size <= store.max_bytes // RELAY_MAX_SHARE:
+        return RELAY
+    if config['public_base_url']:
+        return PROXY
+    return SKIP
+
+
+def can_shrink_video(duration_ms: int | None, max_bytes: int) -> bool:
+    """Whether a video of this duration can be re-encoded under max_bytes and stay watchable."""
+    return FFMPEG is not None and bool(duration_ms) and \
+        _shrink_bitrate(duration_ms, max_bytes) >= SHRINK_MIN_VIDEO_BITRATE
+
+
+def shrink_video(source_path: str, output_path: str, duration_ms: int, max_bytes: int):
+    """Re-encode a video to an MP4 of at most max_bytes, for uploads to Discord.
+
+    :param str source_path: Path to the video.
+    :param str output_path: Path of the MP4 to write.
+    :param int duration_ms: Duration of the video, to pick the bitrate.
+    :param int max_bytes: Size the result must fit in.
+    """
+    bitrate = _shrink_bitrate(duration_ms, max_bytes)
+    _ffmpeg_transcode(source_path, output_path,
+                      ['-c:v', 'libx264', '-preset', 'veryfast', '-b:v', str(bitrate),
+                       '-maxrate', str(bitrate), '-bufsize', str(bitrate * 2),
+                       '-vf', "scale='min(1280,iw)':-2", '-pix_fmt', 'yuv420p',
+                       '-c:a', 'aac', '-b:a', str(SHRINK_AUDIO_BITRATE), '-movflags', '+faststart'])
+    if os.path.getsize(output_path) > max_bytes:
+        raise RuntimeError(f"shrunk video is still {os.path.getsize(output_path)} bytes")
+
+
+def _shrink_bitrate(duration_ms: int, max_bytes: int) -> int:
+    # 10% headroom for the container and rate control overshoot
+    return int(max_bytes * 8 * 0.9 / (duration_ms / 1000)) - SHRINK_AUDIO_BITRATE
+
+
+def _ffmpeg_transcode(source_path: str, output_path: str, output_args: list):
+    result = subprocess.run([FFMPEG, '-loglevel', 'error', '-y', '-i', source_path,
+                             *output_args, output_path],
+                            capture_output=True, timeout=300, check=False)
+    if result.returncode != 0 or not os.path.getsize(output_path):
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace')[-500:]}")
+
+
+processor = MediaProcessor(store, config['media_workers'])
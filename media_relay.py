@@ -0,0 +1,335 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import aiohttp
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+import utilities as utils
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+RELAY_DIR = './downloads/media_relay'
+RELAY_ROUTE = '/media'
+CHUNK_SIZE = 64 * 1024
+# A single file may use at most 1/RELAY_MAX_SHARE of the media relay budget
+RELAY_MAX_SHARE = 4
+FFPROBE = shutil.which('ffprobe')
+
+_MEDIA_NAME = re.compile(r'^([0-9a-f]{64})(?:_[a-z]+)?\.[a-z0-9]+$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+router = APIRouter()
+
+
+@dataclass
+class MediaEntry:
+    name: str
+    digest: str
+    size: int
+    content_type: str
+    duration_ms: int | None = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(RELAY_DIR, self.name)
+
+
+class MediaStore:
+    """Bounded, content-addressed cache of media served to LINE.
+
+    Every source URL is downloaded once, streamed to disk while hashing, and stored as
+    `<sha256>.<ext>`; derived files (previews, conversions) are stored next to it as
+    `<sha256>_<variant>.<ext>`. Files are evicted least recently used first once the
+    total size exceeds the budget. Downloads larger than `max_file_bytes` are aborted,
+    so callers fall back to the source URL.
+    """
+
+    def __init__(self, public_base_url: str, max_bytes: int, max_urls: int = 10000):
+        self.public_base_url = public_base_url.rstrip('/')
+        self.max_bytes = max_bytes
+        self.max_urls = max_urls
+        self.total_bytes = 0
+        self._entries: OrderedDict[str, MediaEntry] = OrderedDict()
+        self._urls: OrderedDict[str, str] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self._session: aiohttp.ClientSession | None = None
+        self._load_existing()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.public_base_url)
+
+    @property
+    def max_file_bytes(self) -> int:
+        return self.max_bytes // RELAY_MAX_SHARE
+
+    def url_for(self, entry: MediaEntry) -> str:
+        return f'{self.public_base_url}{RELAY_ROUTE}/{entry.name}'
+
+    def get(self, name: str) -> MediaEntry | None:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+            return entry
+
+    async def fetch(self, url: str, probe_duration: bool = False) -> MediaEntry:
+        """Get the stored copy of a URL, downloading it once.
+
+        :param str url: Source URL, e.g. a Discord attachment URL.
+        :param bool probe_duration: Whether to compute the media duration while ingesting.
+        :return MediaEntry: The stored media.
+        """
+        key = url.split('?', 1)[0]
+        with self._lock:
+            name = self._urls.get(key)
+        if name is not None:
+            entry = self.get(name)
+            if entry is not None and os.path.exists(entry.path):
+                if probe_duration and entry.duration_ms is None:
+                    entry.duration_ms = await asyncio.to_thread(probe_duration_ms, entry.path)
+                return entry
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._download(url, key, probe_duration))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def put_file(self, temp_path: str, name: str, duration_ms: int | None = None) -> MediaEntry:
+        """Move a finished file into the store under a name.
+
+        :param str temp_path: Path of the file to move.
+        :param str name: Store file name, `<sha256>[_<variant>].<ext>`.
+        :param int duration_ms: Media duration if known.
+        """
+        os.makedirs(RELAY_DIR, exist_ok=True)
+        entry = MediaEntry(name=name, digest=name[:64], size=os.path.getsize(temp_path),
+                           content_type=_content_type(name), duration_ms=duration_ms)
+        os.replace(temp_path, entry.path)
+        self._add(entry)
+        return entry
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _download(self, url: str, key: str, probe_duration: bool) -> MediaEntry:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+        os.makedirs(RELAY_DIR, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=RELAY_DIR, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                async with self._session.get(url) as response:
+                    response.raise_for_status()
+                    if (response.content_length or 0) > self.max_file_bytes:
+                        raise ValueError(f"{response.content_length} bytes is over the "
+                                         f"{self.max_file_bytes} bytes limit of a file")
+                    content_type = response.content_type
+                    size = 0
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            raise ValueError(f"over the {self.max_file_bytes} bytes limit "
+                                             f"of a file")
+                        digest.update(chunk)
+                        file.write(chunk)
+            extension = _extension(url, content_type)
+            name = f'{digest.hexdigest()}{extension}'
+            existing = self.get(name)
+            if existing is not None and os.path.exists(existing.path):
+                os.remove(temp_path)
+                entry = existing
+            else:
+                entry = self.put_file(temp_path, name)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if probe_duration and entry.duration_ms is None:
+            entry.duration_ms = await asyncio.to_thread(probe_duration_ms, entry.path)
+        with self._lock:
+            self._urls[key] = entry.name
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.max_urls:
+                self._urls.popitem(last=False)
+        logger.debug("已快取媒體: %s -> %s (%s bytes)", key, entry.name, entry.size)
+        return entry
+
+    def _add(self, entry: MediaEntry):
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(entry.name, None)
+            if previous is not None:
+                self.total_bytes -= previous.size
+            self._entries[entry.name] = entry
+            self.total_bytes += entry.size
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, oldest = self._entries.popitem(last=False)
+                self.total_bytes -= oldest.size
+                evicted.append(oldest)
+        for oldest in evicted:
+            try:
+                os.remove(oldest.path)
+            except OSError:
+                pass
+            logger.debug("已移除最久未使用的媒體快取: %s", oldest.name)
+
+    def _load_existing(self):
+        if not os.path.isdir(RELAY_DIR):
+            return
+        files = []
+        for name in os.listdir(RELAY_DIR):
+            path = os.path.join(RELAY_DIR, name)
+            if '.part' in name:
+                os.remove(path)
+            elif _MEDIA_NAME.match(name):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._add(MediaEntry(name=name, digest=name[:64], size=size,
+                                 content_type=_content_type(name)))
+
+
+def _extension(url: str, content_type: str) -> str:
+    extension = os.path.splitext(url.split('?', 1)[0])[1].lower()
+    if re.fullmatch(r'\.[a-z0-9]{1,5}', extension):
+        return extension
+    return mimetypes.guess_extension(content_type or '') or '.bin'
+
+
+def _content_type(name: str) -> str:
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def probe_duration_ms(path: str) -> int | None:
+    """Get the duration of an audio or video file in milliseconds.
+
+    MP4/M4A durations are read from the `mvhd` box; other formats need ffprobe.
+
+    :param str path: Path to the media file.
+    :return int: Duration in milliseconds, None if unknown.
+    """
+    try:
+        duration = _mp4_duration_ms(path)
+    except (OSError, struct.error):
+        duration = None
+    if duration is None and FFPROBE is not None:
+        result = subprocess.run([FFPROBE, '-v', 'error', '-show_entries', 'format=duration',
+                                 '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                                capture_output=True, text=True, timeout=30, check=False)
+        try:
+            duration = int(float(result.stdout.strip()) * 1000)
+        except ValueError:
+            duration = None
+    return duration
+
+
+def _mp4_duration_ms(path: str) -> int | None:
+    with open(path, 'rb') as file:
+        end = os.fstat(file.fileno()).st_size
+        return _find_mvhd(file, 0, end)
+
+
+def _find_mvhd(file, start: int, end: int) -> int | None:
+    position = start
+    while position + 8 <= end:
+        file.seek(position)
+        size, box_type = struct.unpack('>I4s', file.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', file.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            return None
+        if box_type == b'moov':
+            return _find_mvhd(file, position + header, position + size)
+        if box_type == b'mvhd':
+            version = file.read(1)[0]
+            file.read(3)
+            if version == 1:
+                _, _, timescale, duration = struct.unpack('>QQIQ', file.read(28))
+            else:
+                _, _, timescale, duration = struct.unpack('>IIII', file.read(16))
+            return int(duration * 1000 / timescale) if timescale else None
+        position += size
+    return None
+
+
+def _parse_range(header: str, size: int) -> tuple[int, int] | None:
+    match = _RANGE.match(header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    else:
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+    return start, min(end, size - 1)
+
+
+def _iter_file(path: str, start: int, length: int):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@router.api_route(RELAY_ROUTE + '/{file_name}', methods=['GET', 'HEAD'])
+async def serve_media(file_name: str, request: Request):
+    """Serve stored media with ETag and single range support."""
+    entry = store.get(file_name) if _MEDIA_NAME.match(file_name) else None
+    if entry is None or not os.path.exists(entry.path):
+        raise HTTPException(status_code=404, detail="Not found.")
+
+    etag = f'"{entry.name}"'
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes',
+               'Cache-Control': 'public, max-age=31536000, immutable'}
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+
+    start, end = 0, entry.size - 1
+    status_code = 200
+    range_header = request.headers.get('range')
+    if range_header and request.headers.get('if-range', etag) == etag:
+        byte_range = _parse_range(range_header, entry.size)
+        if byte_range is None or byte_range[0] > byte_range[1]:
+            return Response(status_code=416, headers={**headers,
+                                                      'Content-Range': f'bytes */{entry.size}'})
+        start, end = byte_range
+        status_code = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{entry.size}'
+    length = end - start + 1
+    headers['Content-Length'] = str(length)
+    if request.method == 'HEAD':
+        return Response(status_code=status_code, headers=headers, media_type=entry.content_type)
+    return StreamingResponse(_iter_file(entry.path, start, length), status_code=status_code,
+                             headers=headers, media_type=entry.content_type)
+
+
+store = MediaStore(config['public_base_url'], config['media_cache_max_mb'] * 1024 * 1024)
@@ -10,7 +10,7 @@ if not exist .venv (
     where uv >nul 2>nul
     if %errorlevel% equ 0 (
         echo Found uv! Using uv for setup...
-        uv sync
+        uv sync --extra performance
         if errorlevel 1 (
             echo Failed to sync with uv
             pause
@@ -10,7 +10,7 @@ if [ ! -d ".venv" ]; then
     # Check if uv is installed
     if command -v uv &> /dev/null; then
         echo "Found uv! Using uv for setup..."
-        uv sync
+        uv sync --extra performance
         if [ $? -ne 0 ]; then
             echo "Failed to sync with uv"
             exit 1
@@ -0,0 +1,66 @@
+import asyncio
+import importlib.util
+import logging
+
+import uvicorn
+
+import utilities as utils
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+STANDARD = 'standard'
+PERFORMANCE = 'performance'
+
+
+def install_event_loop(profile: str = None) -> str:
+    """Pick the event loop of the whole bot, the web server and the Discord client share it.
+
+    Call before asyncio.run. uvloop is optional: without it, or on Windows, the standard
+    asyncio loop is used.
+
+    :param str profile: STANDARD or PERFORMANCE, server_profile of config.yml if None.
+    :return str: 'uvloop' or 'asyncio'.
+    """
+    if (profile or config['server_profile']) == PERFORMANCE:
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("未安裝 uvloop，使用標準 asyncio 事件迴圈")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("使用 uvloop 事件迴圈")
+            return 'uvloop'
+    return 'asyncio'
+
+
+def http_implementation(profile: str = None) -> str:
+    """The HTTP parser of the web server: httptools for PERFORMANCE when installed, else h11."""
+    if (profile or config['server_profile']) == PERFORMANCE:
+        if importlib.util.find_spec('httptools') is not None:
+            return 'httptools'
+        logger.warning("未安裝 httptools，使用 h11 解析 HTTP")
+    return 'h11'
+
+
+def server_config(app, host: str, port: int, profile: str = None, **kwargs) -> uvicorn.Config:
+    """uvicorn settings of the webhook server, from the server_* settings of config.yml.
+
+    The event loop isn't set here: the server runs in the loop picked by
+    `install_event_loop`, next to the Discord client.
+
+    :param app: The ASGI application.
+    :param str host: Address to listen on.
+    :param int port: Port to listen on.
+    :param str profile: STANDARD or PERFORMANCE, server_profile of config.yml if None.
+    :param kwargs: Other uvicorn.Config arguments.
+    """
+    http = http_implementation(profile)
+    logger.info("Web server 使用 %s 解析 HTTP，backlog %s，keep-alive %s 秒", http,
+                config['server_backlog'], config['server_keep_alive_seconds'])
+    return uvicorn.Config(app, host=host, port=port, http=http,
+                          backlog=config['server_backlog'],
+                          timeout_keep_alive=config['server_keep_alive_seconds'],
+                          limit_concurrency=config['server_limit_concurrency'] or None,
+                          **kwargs)
@@ -0,0 +1,180 @@
+import atexit
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import utilities as utils
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+STICKER_DIR = './downloads/stickers'
+USAGE_FILE = os.path.join(STICKER_DIR, 'usage.json')
+USAGE_HALF_LIFE_DAYS = 7
+USAGE_MAX_ENTRIES = 5000
+# Coldest entries dropped at once when USAGE_MAX_ENTRIES is exceeded
+USAGE_EVICT_BATCH = 500
+SAVE_EVERY = 50
+# Uses are saved in the background, at most this often
+SAVE_DELAY_SECONDS = 30
+
+
+class StickerCache:
+    """In-memory LRU of sticker file contents, bounded by total bytes.
+
+    Hot stickers are served from memory without touching the disk, not even to look up
+    their file. How often every sticker was used is saved to USAGE_FILE, and at startup
+    the cache is filled with the most used stickers of recent days.
+    """
+
+    def __init__(self, max_bytes: int, usage_path: str = USAGE_FILE):
+        self.max_bytes = max_bytes
+        self.usage_path = usage_path
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[bytes, str]] = OrderedDict()
+        self._usage: dict[str, list] = {}
+        self._unsaved = 0
+        self._save_timer: threading.Timer | None = None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def get(self, package_id, sticker_id, is_animation: bool, locate) -> tuple[bytes, str] | None:
+        """Get the content of a sticker.
+
+        :param package_id: Sticker package ID.
+        :param sticker_id: Sticker ID.
+        :param bool is_animation: Whether the animated version is wanted.
+        :param locate: Function finding (or downloading) the sticker file on a miss, called
+            with the three arguments above and returning its path or None.
+        :return tuple: (content, file path), None if the sticker can't be found.
+        """
+        key = _key(package_id, sticker_id, is_animation)
+        self._count_use(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            usage = self._usage.get(key)
+            # The path found by a previous run, saved in the usage file, spares the search
+            path = usage[2] if usage is not None else None
+        if not path or not os.path.isfile(path):
+            path = locate(package_id, sticker_id, is_animation)
+        if not path:
+            return None
+        with open(path, 'rb') as file:
+            data = file.read()
+        self._put(key, data, path)
+        return data, path
+
+    def warm_up(self):
+        """Load the most used stickers from disk, up to the byte budget."""
+        self._load_usage()
+        now = time.time()
+        ranked = sorted(self._usage.items(), key=lambda item: _score(item[1], now), reverse=True)
+        loaded = 0
+        for key, (_, _, path) in ranked:
+            if self.total_bytes >= self.max_bytes:
+                break
+            if not path or not os.path.exists(path) or os.path.getsize(path) > self.max_bytes - self.total_bytes:
+                continue
+            with open(path, 'rb') as file:
+                self._put(key, file.read(), path)
+            loaded += 1
+        if loaded:
+            logger.info("已預先載入 %s 張常用貼圖 (%.1f MB)", loaded, self.total_bytes / 1024 / 1024)
+
+    def save_usage(self):
+        """Write the usage statistics to disk."""
+        with self._lock:
+            usage = {key: list(value) for key, value in self._usage.items()}
+            self._unsaved = 0
+        with self._save_lock:
+            os.makedirs(os.path.dirname(self.usage_path), exist_ok=True)
+            temp_path = f'{self.usage_path}.tmp'
+            with open(temp_path, 'w', encoding='utf8') as file:
+                json.dump(usage, file)
+            os.replace(temp_path, self.usage_path)
+
+    def _put(self, key: str, data: bytes, path: str):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= len(previous[0])
+            self._entries[key] = (data, path)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, (oldest, _) = self._entries.popitem(last=False)
+                self.total_bytes -= len(oldest)
+            if key in self._usage:
+                self._usage[key][2] = path
+
+    def _count_use(self, key: str):
+        now = time.time()
+        with self._lock:
+            usage = self._usage.get(key)
+            if usage is None:
+                usage = self._usage[key] = [0.0, now, None]
+            # Decay the old count to the current time, then add this use
+            usage[0] = usage[0] * 0.5 ** ((now - usage[1]) / 86400 / USAGE_HALF_LIFE_DAYS) + 1
+            usage[1] = now
+            if len(self._usage) > USAGE_MAX_ENTRIES:
+                self._evict_coldest(key, now)
+            self._unsaved += 1
+            if self._unsaved >= SAVE_EVERY and self._save_timer is None:
+                self._save_timer = threading.Timer(SAVE_DELAY_SECONDS, self._save_in_background)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _evict_coldest(self, keep: str, now: float):
+        """Drop the USAGE_EVICT_BATCH least used entries, other than the one just used."""
+        coldest = heapq.nsmallest(USAGE_EVICT_BATCH + 1, self._usage,
+                                  key=lambda k: _score(self._usage[k], now))
+        for key in [key for key in coldest if key != keep][:USAGE_EVICT_BATCH]:
+            del self._usage[key]
+
+    def _save_in_background(self):
+        with self._lock:
+            self._save_timer = None
+        try:
+            self.save_usage()
+        except OSError as e:
+            logger.warning("無法儲存貼圖使用統計: %s", e)
+
+    def _load_usage(self):
+        if not os.path.exists(self.usage_path):
+            return
+        try:
+            with open(self.usage_path, encoding='utf8') as file:
+                usage = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning("無法讀取貼圖使用統計: %s", e)
+            return
+        with self._lock:
+            for key, value in usage.items():
+                self._usage.setdefault(key, value)
+
+
+def _key(package_id, sticker_id, is_animation: bool) -> str:
+    return f"{package_id}/{sticker_id}/{'gif' if is_animation else 'png'}"
+
+
+def _score(usage: list, now: float) -> float:
+    count, last_used, _ = usage
+    return count * 0.5 ** ((now - last_used) / 86400 / USAGE_HALF_LIFE_DAYS)
+
+
+sticker_cache = StickerCache(config['sticker_cache_mb'] * 1024 * 1024)
+atexit.register(sticker_cache.save_usage)
+threading.Thread(target=sticker_cache.warm_up, name='sticker-warm-up', daemon=True).start()
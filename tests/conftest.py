@@ -0,0 +1,32 @@
+"""Run the tests from a temporary working directory.
+
+The modules read config.yml and sync_channels.json from the working directory when they
+are imported, so both are written before the test modules are collected.
+"""
+import json
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def pytest_sessionstart(session):
+    workdir = tempfile.mkdtemp(prefix='line-discord-tests-')
+    with open(os.path.join(workdir, 'config.yml'), 'w', encoding='utf8') as file:
+        json.dump({
+            'line_channel_access_token': 'test-access-token',
+            'line_channel_secret': 'test-channel-secret',
+            'discord_bot_token': 'test-bot-token',
+            'webhook_port': 5000,
+            'line_bot_invite_link': '',
+            'discord_bot_invite_link': '',
+            'log_level': 'WARNING',
+            'line_api_endpoint': 'http://127.0.0.1:9',
+            'line_data_api_endpoint': 'http://127.0.0.1:9',
+        }, file)
+    with open(os.path.join(workdir, 'sync_channels.json'), 'w', encoding='utf8') as file:
+        json.dump([], file)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import utilities  # noqa: F401, imported before cache like main.py to avoid a cycle
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+import pytest
+
+from admission import (ACCEPT, DEGRADE, PRIORITY_MEDIA, PRIORITY_TEXT, REJECT,
+                       AdmissionController)
+
+
+def loaded(pending: int, group_pending: int) -> AdmissionController:
+    controller = AdmissionController(1, max_pending=10, max_pending_per_group=4)
+    controller.pending = pending
+    if group_pending:
+        controller.pending_by_group['C1'] = group_pending
+    return controller
+
+
+@pytest.mark.parametrize('pending, group_pending, text, media', [
+    (0, 0, ACCEPT, ACCEPT),
+    (9, 3, ACCEPT, ACCEPT),
+    # Media is degraded at the budget, of the queue or of its group
+    (10, 0, ACCEPT, DEGRADE),
+    (5, 4, ACCEPT, DEGRADE),
+    # Everything is rejected at twice the budget
+    (19, 7, ACCEPT, DEGRADE),
+    (20, 0, REJECT, REJECT),
+    (8, 8, REJECT, REJECT),
+])
+def test_admit_thresholds(pending, group_pending, text, media):
+    assert loaded(pending, group_pending).admit(PRIORITY_TEXT, 'C1') == text
+    assert loaded(pending, group_pending).admit(PRIORITY_MEDIA, 'C1') == media
+
+
+def test_budget_of_one_group_leaves_others_alone():
+    controller = loaded(5, 8)
+    assert controller.admit(PRIORITY_MEDIA, 'C1') == REJECT
+    assert controller.admit(PRIORITY_MEDIA, 'C2') == ACCEPT
+    assert controller.stats == {ACCEPT: 1, DEGRADE: 0, REJECT: 1}
+
+
+def test_submitted_work_is_counted_until_it_ran():
+    release = threading.Event()
+
+    async def main():
+        controller = AdmissionController(2, 10, 4)
+        futures = [controller.submit(PRIORITY_TEXT, 'C1', release.wait, 5) for _ in range(2)]
+        futures.append(controller.submit(PRIORITY_MEDIA, 'C2', release.wait, 5))
+        counts = controller.pending, dict(controller.pending_by_group)
+        release.set()
+        await asyncio.gather(*futures)
+        await asyncio.sleep(0)
+        return counts, controller.pending, dict(controller.pending_by_group)
+
+    counts, pending, by_group = asyncio.run(main())
+    assert counts == (3, {'C1': 2, 'C2': 1})
+    assert pending == 0 and by_group == {}
@@ -0,0 +1,25 @@
+import threading
+
+from archive import Archiver
+
+
+def test_flush_keeps_a_thread_that_is_still_writing(tmp_path, monkeypatch):
+    archiver = Archiver(str(tmp_path), 1024 * 1024)
+    release = threading.Event()
+    written = []
+
+    def write_frames(frames):
+        release.wait(5)
+        written.extend(record['text'] for records in frames.values() for record in records)
+        frames.clear()
+
+    monkeypatch.setattr(archiver, '_write_frames', write_frames)
+    archiver.record('folder', 'line_to_discord', 'author', 'hello')
+    thread = archiver._thread
+    archiver.flush(timeout=0.1)
+    assert archiver._thread is thread and thread.is_alive()
+
+    release.set()
+    archiver.flush()
+    assert archiver._thread is None
+    assert written == ['hello']
@@ -0,0 +1,200 @@
+import pytest
+
+import cache
+from cache import MemberProfiles, MessageIdIndex, RecentEventIds, ReplyTokens
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_recent_event_ids_suppress_redeliveries(clock):
+    ids = RecentEventIds(60, 100)
+    assert not ids.check_and_add('e1')
+    assert ids.check_and_add('e1')
+    assert not ids.check_and_add(None)
+    assert not ids.check_and_add(None)
+    assert ids.suppressed == 1
+
+
+def test_recent_event_ids_expire_after_the_window(clock):
+    ids = RecentEventIds(60, 100)
+    ids.check_and_add('e1')
+    clock.now += 61
+    assert not ids.check_and_add('e1')
+
+
+def test_recent_event_ids_evict_oldest_beyond_max_size(clock):
+    ids = RecentEventIds(60, 3)
+    for index in range(4):
+        ids.check_and_add(f'e{index}')
+    assert len(ids) == 3
+    assert not ids.check_and_add('e0')
+    assert ids.check_and_add('e3')
+
+
+def test_recent_event_ids_discard_lets_a_redelivery_through(clock):
+    ids = RecentEventIds(60, 100)
+    ids.check_and_add('e1')
+    ids.discard('e1')
+    assert not ids.check_and_add('e1')
+
+
+def test_recent_event_ids_snapshot_round_trip(clock):
+    ids = RecentEventIds(60, 100)
+    ids.check_and_add('old')
+    clock.now += 50
+    ids.check_and_add('new')
+    snapshot = ids.snapshot()
+    assert snapshot == [['old', 50.0], ['new', 0.0]]
+
+    restored = RecentEventIds(60, 100)
+    restored.restore(snapshot)
+    assert restored.check_and_add('new')
+    clock.now += 11
+    assert not restored.check_and_add('old')
+
+
+def binding(sub_num, line_group_id, discord_channel_id, **fields):
+    return {'sub_num': sub_num, 'folder_name': f'folder_{sub_num}', 'line_group_id': line_group_id,
+            'line_group_name': line_group_id, 'discord_channel_id': discord_channel_id,
+            'discord_channel_name': str(discord_channel_id),
+            'discord_channel_webhook': f'https://discord.com/api/webhooks/{sub_num}/x', **fields}
+
+
+@pytest.fixture
+def sync_channels():
+    sync_channels = cache.sync_channels_cache
+    sync_channels.apply([])
+    yield sync_channels
+    sync_channels.apply([])
+
+
+def test_apply_adds_changes_and_removes_only_the_difference(sync_channels):
+    assert sync_channels.apply([binding(1, 'C1', 11), binding(2, 'C2', 12)]) == (2, 0, 0)
+    first = sync_channels.get_info_by_line_group_id('C1')
+    assert sync_channels.apply([binding(1, 'C1', 11),
+                                binding(2, 'C2', 12, line_account='second'),
+                                binding(3, 'C3', 13)]) == (1, 0, 1)
+    assert sync_channels.get_info_by_line_group_id('C1') is first
+    assert sync_channels.line_accounts == {'C1': 'default', 'C2': 'second', 'C3': 'default'}
+    assert sync_channels.apply([binding(3, 'C3', 13)]) == (0, 2, 0)
+    assert sync_channels.get_info_by_line_group_id('C1') is None
+    assert sync_channels.get_info_by_dc_channel_id(12) is None
+    assert sync_channels.get_dc_webhook_by_line_group_id('C3').endswith('/3/x')
+
+
+def test_apply_moves_the_indexes_of_a_rebound_channel(sync_channels):
+    sync_channels.apply([binding(1, 'C1', 11)])
+    assert sync_channels.apply([binding(1, 'C9', 19)]) == (0, 0, 1)
+    assert sync_channels.get_info_by_line_group_id('C1') is None
+    assert sync_channels.get_info_by_dc_channel_id(11) is None
+    assert sync_channels.get_info_by_dc_channel_id(19)['line_group_id'] == 'C9'
+
+
+def test_apply_reindexes_a_binding_shadowed_by_a_removed_one(sync_channels):
+    # Two bindings of one group: removing the indexed one exposes the other
+    sync_channels.apply([binding(1, 'C1', 11), binding(2, 'C1', 12)])
+    assert sync_channels.get_info_by_line_group_id('C1')['sub_num'] == 2
+    sync_channels.apply([binding(1, 'C1', 11)])
+    assert sync_channels.get_info_by_line_group_id('C1')['sub_num'] == 1
+    assert sync_channels.get_info_by_dc_channel_id(11)['sub_num'] == 1
+
+
+def test_message_ids_are_found_by_either_id(clock):
+    index = MessageIdIndex(60, 100)
+    index.add(1, 11, 'L1', 'C1', quote_token='q1', from_line=True)
+    assert index.by_discord(1) == index.by_line('L1')
+    assert index.by_line('L1').quote_token == 'q1'
+    assert index.pop_line('L1').discord_message_id == 1
+    assert index.by_discord(1) is None and len(index) == 0
+
+
+def test_message_ids_expire_and_evict_oldest(clock):
+    index = MessageIdIndex(60, 2)
+    index.add(1, 11, 'L1', 'C1')
+    clock.now += 30
+    index.add(2, 11, 'L2', 'C1')
+    index.add(3, 11, 'L3', 'C1')
+    assert index.by_line('L1') is None and len(index) == 2
+    clock.now += 60
+    # Expired entries are no longer returned, and dropped by the next add
+    assert index.by_discord(2) is None and index.by_line('L3') is None
+    index.add(4, 11, 'L4', 'C1')
+    assert len(index) == 1 and index.by_line('L4').discord_message_id == 4
+
+
+def test_message_ids_replace_entries_of_the_same_message(clock):
+    index = MessageIdIndex(60, 100)
+    index.add(1, 11, 'L1', 'C1')
+    index.add(2, 11, 'L1', 'C1')
+    assert index.by_discord(1) is None
+    assert index.by_line('L1').discord_message_id == 2
+    assert len(index) == 1
+
+
+def test_message_ids_jump_url_and_snapshot_round_trip(clock):
+    index = MessageIdIndex(60, 100)
+    index.add(1, 11, 'L1', 'C1', from_line=True)
+    assert index.jump_url(index.by_discord(1)) is None
+    index.guild_ids[11] = 5
+    assert index.jump_url(index.by_discord(1)) == 'https://discord.com/channels/5/11/1'
+
+    clock.now += 20
+    restored = MessageIdIndex(60, 100)
+    restored.restore(index.snapshot())
+    assert restored.by_line('L1').from_line
+    clock.now += 41
+    assert restored.by_line('L1') is None
+
+
+def test_member_profiles_expire_and_restore_keeps_newer(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    profiles = MemberProfiles(60, max_size=2)
+    profiles.put('C1', 'U1', 'old')
+    assert profiles.get('C1', 'U1') == 'old'
+    profiles.put('C1', 'U2', 'two')
+    profiles.put('C1', 'U3', 'three')
+    assert profiles.get('C1', 'U1') is None and len(profiles) == 2
+
+    restored = MemberProfiles(60)
+    restored.put('C1', 'U2', 'newer')
+    restored.restore(profiles.items() + [('C1', 'U4', 'stale', 900.0)])
+    assert restored.get('C1', 'U2') == 'newer'
+    assert restored.get('C1', 'U3') == 'three'
+    assert restored.get('C1', 'U4') is None
+    now[0] += 60
+    assert restored.get('C1', 'U3') is None
+    assert (restored.hits, restored.misses) == (2, 2)
+
+
+def test_reply_tokens_belong_to_the_account_that_received_them():
+    tokens = ReplyTokens(60)
+    now = cache.time.time()
+    tokens.add('main', 'C1', 'r1', now)
+    assert not tokens.has('other', 'C1')
+    assert tokens.take('other', 'C1') is None
+    assert tokens.has('main', 'C1')
+    assert tokens.take('main', 'C1') == 'r1'
+    assert tokens.take('main', 'C1') is None
+
+
+def test_reply_tokens_skip_expired_ones():
+    tokens = ReplyTokens(60)
+    now = cache.time.time()
+    tokens.add('main', 'C1', 'old', now - 61)
+    tokens.add('main', 'C1', 'new', now)
+    assert not tokens.claim('main', 'C1', 'missing')
+    assert tokens.take('main', 'C1') == 'new'
@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+import pytest
+
+import diagnostics
+
+
+def block_the_loop():
+    time.sleep(0.3)
+
+
+async def on_message():
+    block_the_loop()
+
+
+async def watch_a_block(detector: diagnostics.BlockingDetector):
+    detector.start()
+    await asyncio.sleep(0.1)
+    await asyncio.create_task(on_message())
+    await asyncio.sleep(0.2)
+
+
+def new_uvloop():
+    uvloop = pytest.importorskip('uvloop')
+    return uvloop.new_event_loop()
+
+
+@pytest.mark.parametrize('new_loop', [asyncio.new_event_loop, new_uvloop],
+                         ids=['asyncio', 'uvloop'])
+def test_block_is_attributed_to_its_handler(new_loop):
+    detector = diagnostics.BlockingDetector(0.1)
+    loop = new_loop()
+    try:
+        loop.run_until_complete(watch_a_block(detector))
+    finally:
+        loop.close()
+    assert detector.total_blocks == 1
+    block = detector.blocks[-1]
+    assert block['handler'].endswith(' on_message')
+    assert block['call_site'].endswith(' block_the_loop')
+    assert block['blocked_in'].endswith(' sleep') or 'block_the_loop' in block['blocked_in']
+
+
+def test_plain_callback_starts_after_the_loop_frames():
+    stack = ((True, 'main.py', '<module>', 1, False),
+             (False, 'runners.py', 'run', 44, False),
+             (True, 'line_bot.py', 'callback', 10, False))
+    assert diagnostics._callback_start(stack) == 2
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+
+from keyed_executor import KeyedExecutor
+
+
+def test_order_per_key_and_lane_depths():
+    done = []
+    release = threading.Event()
+
+    def work(key, index):
+        release.wait(5)
+        done.append((key, index))
+
+    async def main():
+        executor = KeyedExecutor(2, 'test')
+        futures = [executor.submit('a', work, 'a', index) for index in range(3)]
+        futures.append(executor.submit('b', work, 'b', 0))
+        await asyncio.sleep(0.05)
+        depths = executor.lane_depths()
+        assert executor.lane_depths(1) == {'a': 3}
+        release.set()
+        await asyncio.gather(*futures)
+        await executor.join()
+        return depths, executor.lane_depths()
+
+    depths, after = asyncio.run(main())
+    assert depths == {'a': 3, 'b': 1}
+    assert after == {}
+    assert [index for key, index in done if key == 'a'] == [0, 1, 2]
+
+
+def test_cancel_pending_keeps_running_items():
+    release = threading.Event()
+
+    async def main():
+        executor = KeyedExecutor(1, 'test')
+        running = executor.submit('a', release.wait, 5)
+        queued = [executor.submit(key, print, key, index)
+                  for key, index in [('a', 1), ('b', 0), ('a', 2)]]
+        await asyncio.sleep(0.05)
+        taken = executor.cancel_pending()
+        release.set()
+        await running
+        await executor.join()
+        return taken, queued, executor.pending
+
+    taken, queued, pending = asyncio.run(main())
+    assert [(key, args) for key, _, args in taken] == [('a', ('a', 1)), ('a', ('a', 2)),
+                                                        ('b', ('b', 0))]
+    assert all(future.cancelled() for future in queued)
+    assert pending == 0
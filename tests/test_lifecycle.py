@@ -0,0 +1,47 @@
+import asyncio
+import json
+import os
+
+from lifecycle import Lifecycle
+
+
+def new_lifecycle(tmp_path, queue: list) -> Lifecycle:
+    lifecycle = Lifecycle(0.1, str(tmp_path / 'unsent.json'))
+
+    def save():
+        items = list(queue)
+        queue.clear()
+        return items
+
+    lifecycle.add_state('messages', save, queue.extend)
+    return lifecycle
+
+
+def test_state_file_is_kept_until_the_work_is_sent(tmp_path):
+    queue = ['a', 'b']
+    asyncio.run(new_lifecycle(tmp_path, queue).shutdown())
+    with open(tmp_path / 'unsent.json', encoding='utf8') as file:
+        assert json.load(file) == {'messages': ['a', 'b']}
+
+    lifecycle = new_lifecycle(tmp_path, queue)
+    asyncio.run(lifecycle.restore())
+    assert queue == ['a', 'b']
+    # Stopped again before sending: the restored work is saved once more
+    asyncio.run(lifecycle.shutdown())
+    assert os.path.exists(tmp_path / 'unsent.json')
+
+    lifecycle = new_lifecycle(tmp_path, queue)
+    asyncio.run(lifecycle.restore())
+    queue.clear()
+    asyncio.run(lifecycle.shutdown())
+    assert not os.path.exists(tmp_path / 'unsent.json')
+
+
+def test_failed_save_keeps_the_previous_state(tmp_path):
+    queue = ['a']
+    asyncio.run(new_lifecycle(tmp_path, queue).shutdown())
+    lifecycle = Lifecycle(0.1, str(tmp_path / 'unsent.json'))
+    lifecycle.add_state('messages', lambda: 1 / 0, queue.extend)
+    asyncio.run(lifecycle.restore())
+    asyncio.run(lifecycle.shutdown())
+    assert os.path.exists(tmp_path / 'unsent.json')
@@ -0,0 +1,138 @@
+import asyncio
+from types import SimpleNamespace
+
+import line_quota
+from line_quota import DIGEST, HOLD, SEND, DigestBuffer, QuotaManager
+
+
+class FakeApi:
+    def __init__(self, limit, used, members=None):
+        self.limit = limit
+        self.used = used
+        self.members = members or {}
+
+    def get_message_quota(self):
+        return SimpleNamespace(type='limited' if self.limit is not None else 'none',
+                               value=self.limit)
+
+    def get_message_quota_consumption(self):
+        return SimpleNamespace(total_usage=self.used)
+
+    def get_group_member_count(self, line_group_id):
+        return SimpleNamespace(count=self.members.get(line_group_id, 1))
+
+
+def quota_manager(limit=1000, used=0, day_budget=10, weights=None, members=None) -> QuotaManager:
+    quota = QuotaManager(FakeApi(limit, used, members), 3600, weights or {}, 0)
+    quota.refresh()
+    with quota._lock:
+        quota._roll_day()
+        quota._day_budget = day_budget
+    return quota
+
+
+def test_unlimited_quota_always_sends():
+    quota = quota_manager(limit=None)
+    assert quota.decide('C1', 'a') == SEND
+    assert quota.can_send_digest('C1', 'a')
+
+
+def test_digest_once_day_budget_is_spent():
+    quota = quota_manager(day_budget=3)
+    for _ in range(3):
+        assert quota.decide('C1', 'a') == SEND
+        quota.consume('C1', 'a')
+    assert quota.decide('C1', 'a') == DIGEST
+    assert quota.stats == {SEND: 3, DIGEST: 1, HOLD: 0}
+
+
+def test_push_costs_one_message_per_member():
+    quota = quota_manager(day_budget=10, members={'C1': 4})
+    quota.consume('C1', 'a')
+    quota.consume('C1', 'a')
+    assert quota.used == 8
+    assert quota.decide('C1', 'a') == DIGEST
+
+
+def test_binding_over_its_weighted_share_gets_digest():
+    quota = quota_manager(day_budget=10, weights={'a': 1, 'b': 4})
+    quota.consume('C2', 'b')
+    # 'a' may use 1/5 of the day budget while 'b' is active
+    quota.consume('C1', 'a')
+    quota.consume('C1', 'a')
+    assert quota.decide('C1', 'a') == DIGEST
+    assert quota.decide('C2', 'b') == SEND
+
+
+def test_hold_when_month_quota_cannot_pay():
+    quota = quota_manager(limit=100, used=98, members={'C1': 3})
+    assert quota.decide('C1', 'a') == HOLD
+    assert not quota.can_push('C1')
+
+
+def test_digest_waits_for_day_budget_not_only_month_quota():
+    quota = quota_manager(limit=1000, day_budget=2)
+    quota.consume('C1', 'a')
+    quota.consume('C1', 'a')
+    assert quota.can_push('C1')
+    assert not quota.can_send_digest('C1', 'a')
+    assert quota.stats == {SEND: 0, DIGEST: 0, HOLD: 0}
+
+
+def test_day_budget_spreads_remaining_quota():
+    quota = QuotaManager(FakeApi(1000, 400), 3600, {}, 0)
+    quota.refresh()
+    with quota._lock:
+        quota._roll_day()
+    assert 600 / 31 <= quota._day_budget <= 600
+
+
+def run_digests(may_send, lines: dict, send=None):
+    sent = []
+
+    async def main():
+        digests = DigestBuffer(send or (lambda group, texts: sent.append((group, texts))), may_send, 3600)
+        for line_group_id, group_lines in lines.items():
+            for line in group_lines:
+                digests.add(line_group_id, line)
+        await digests.flush()
+        return digests
+
+    return asyncio.run(main()), sent
+
+
+def test_digest_flush_only_groups_allowed_to_send():
+    digests, sent = run_digests(lambda group: group == 'C1', {'C1': ['a', 'b'], 'C2': ['c']})
+    assert [group for group, _ in sent] == ['C1']
+    assert sent[0][1][0].endswith('a\nb')
+    assert digests.pending() == 1
+    assert digests.take() == [{'line_group_id': 'C2', 'line': 'c'}]
+    assert digests.pending() == 0
+
+
+def test_failed_digest_keeps_its_lines():
+    def send(group, texts):
+        raise RuntimeError('push failed')
+
+    digests, _ = run_digests(lambda group: True, {'C1': ['a', 'b']}, send=send)
+    assert digests.take() == [{'line_group_id': 'C1', 'line': 'a'}, {'line_group_id': 'C1', 'line': 'b'}]
+
+
+def test_sent_digest_removes_its_lines():
+    digests, sent = run_digests(lambda group: True, {'C1': ['a'], 'C2': ['b']})
+    assert len(sent) == 2
+    assert digests.pending() == 0
+
+
+def test_digest_drops_oldest_lines_when_full():
+    lines = [str(index) for index in range(line_quota.DIGEST_MAX_LINES + 5)]
+    digests, _ = run_digests(lambda group: False, {'C1': lines})
+    assert digests.dropped == 5
+    assert digests.take()[0]['line'] == '5'
+
+
+def test_pack_splits_into_at_most_five_texts():
+    texts = line_quota._pack('title', ['x' * 3000] * 10)
+    assert len(texts) == line_quota.PUSH_MAX_MESSAGES
+    assert all(len(text) <= line_quota.TEXT_MAX_CHARS for text in texts)
+    assert texts[-1].endswith('…')
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import pytest
+
+import media
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(media, 'DISCORD_UPLOAD_MAX_BYTES', 10 * MB)
+    monkeypatch.setattr(media, 'FFMPEG', '/usr/bin/ffmpeg')
+    monkeypatch.setattr(media, 'store', SimpleNamespace(enabled=True, max_bytes=400 * MB))
+    monkeypatch.setattr(media, 'config', {**media.config, 'public_base_url': 'https://bot'})
+
+
+@pytest.mark.parametrize('size, content_type, duration_ms, expected', [
+    (None, 'image', None, media.UPLOAD),
+    (10 * MB, 'file', None, media.UPLOAD),
+    # A minute of video fits in 10 MB at a watchable bitrate, an hour doesn't
+    (50 * MB, 'video', 60_000, media.SHRINK),
+    (50 * MB, 'video', 3_600_000, media.RELAY),
+    (50 * MB, 'file', None, media.RELAY),
+    (100 * MB, 'audio', None, media.RELAY),
+    (101 * MB, 'file', None, media.PROXY),
+])
+def test_route_by_size(limits, size, content_type, duration_ms, expected):
+    assert media.route(size, content_type, duration_ms) == expected
+
+
+def test_route_without_ffmpeg_or_public_url(limits, monkeypatch):
+    monkeypatch.setattr(media, 'FFMPEG', None)
+    assert media.route(50 * MB, 'video', 60_000) == media.RELAY
+    monkeypatch.setattr(media, 'store', SimpleNamespace(enabled=False, max_bytes=400 * MB))
+    monkeypatch.setattr(media, 'config', {**media.config, 'public_base_url': ''})
+    assert media.route(50 * MB, 'video', 60_000) == media.SKIP
+    assert media.route(5 * MB, 'video', 60_000) == media.UPLOAD
+
+
+def test_route_after_failed_shrink_keeps_the_size_cap(limits, monkeypatch):
+    assert media.route(50 * MB, 'video', 60_000, allow_shrink=False) == media.RELAY
+    assert media.route(200 * MB, 'video', 60_000, allow_shrink=False) == media.PROXY
+    monkeypatch.setattr(media, 'config', {**media.config, 'public_base_url': ''})
+    assert media.route(200 * MB, 'video', 60_000, allow_shrink=False) == media.SKIP
@@ -0,0 +1,68 @@
+import asyncio
+import os
+
+import pytest
+from aiohttp import web
+
+import media_relay
+from media_relay import MediaStore
+
+
+def fetch_from_server(store: MediaStore, handler):
+    async def main():
+        app = web.Application()
+        app.router.add_get('/{name}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await store.fetch(f'http://127.0.0.1:{port}/file.bin')
+        finally:
+            await store.close()
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+def relay_files() -> list:
+    return os.listdir(media_relay.RELAY_DIR) if os.path.isdir(media_relay.RELAY_DIR) else []
+
+
+def test_download_within_the_file_limit_is_stored():
+    store = MediaStore('https://bot', 4 * 1000)
+
+    async def handler(request):
+        return web.Response(body=b'x' * 1000)
+
+    entry = fetch_from_server(store, handler)
+    assert entry.size == 1000 and os.path.exists(entry.path)
+
+
+def test_download_over_the_declared_size_limit_is_aborted():
+    store = MediaStore('https://bot', 4 * 1000)
+
+    async def handler(request):
+        return web.Response(body=b'y' * 1001)
+
+    with pytest.raises(ValueError):
+        fetch_from_server(store, handler)
+    assert not any(name.endswith('.part') for name in relay_files())
+
+
+def test_download_without_content_length_is_counted():
+    store = MediaStore('https://bot', 4 * 1000)
+
+    async def handler(request):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for _ in range(3):
+            await response.write(b'z' * 500)
+        await response.write_eof()
+        return response
+
+    with pytest.raises(ValueError):
+        fetch_from_server(store, handler)
+    assert not any(name.endswith('.part') for name in relay_files())
@@ -0,0 +1,35 @@
+import json
+import time
+
+import sticker_cache
+from sticker_cache import StickerCache
+
+
+def test_usage_beyond_max_entries_is_evicted_in_a_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(sticker_cache, 'USAGE_MAX_ENTRIES', 10)
+    monkeypatch.setattr(sticker_cache, 'USAGE_EVICT_BATCH', 4)
+    monkeypatch.setattr(sticker_cache, 'SAVE_EVERY', 1000)
+    cache = StickerCache(1024, str(tmp_path / 'usage.json'))
+    for index in range(10):
+        # Used twice, so they are hotter than the new sticker below
+        cache._count_use(f'1/{index}/png')
+        cache._count_use(f'1/{index}/png')
+    cache._count_use('2/new/png')
+    assert len(cache._usage) == 7
+    assert '2/new/png' in cache._usage
+
+
+def test_usage_is_saved_off_the_calling_thread(tmp_path, monkeypatch):
+    monkeypatch.setattr(sticker_cache, 'SAVE_EVERY', 2)
+    monkeypatch.setattr(sticker_cache, 'SAVE_DELAY_SECONDS', 0.05)
+    usage_path = tmp_path / 'usage.json'
+    cache = StickerCache(1024, str(usage_path))
+    cache._count_use('1/1/png')
+    cache._count_use('1/1/png')
+    assert not usage_path.exists()
+    for _ in range(100):
+        if usage_path.exists():
+            break
+        time.sleep(0.02)
+    assert json.loads(usage_path.read_text(encoding='utf8'))['1/1/png'][0] > 1
+    assert cache._save_timer is None
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+import zlib
+
+from warm_start import MAGIC, WarmStart
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'warm_start.bin')
+    saved = WarmStart(path, 300, 3600)
+    saved.add('profiles', lambda: [['C1', 'U1', {'displayName': '名字'}, 1.5]])
+    saved.add('names', lambda: {'default': ['bot', 2.5]})
+    saved.save()
+    with open(path, 'rb') as file:
+        assert file.read().startswith(MAGIC)
+    assert not os.path.exists(f'{path}.tmp')
+
+    restored = WarmStart(path, 300, 3600)
+    assert restored.restore('profiles') == [['C1', 'U1', {'displayName': '名字'}, 1.5]]
+    assert restored.restore('names') == {'default': ['bot', 2.5]}
+    # Every section is handed out once
+    assert restored.restore('profiles') is None
+    assert restored.restore('unknown') is None
+
+
+def test_failing_section_does_not_stop_the_others(tmp_path):
+    path = str(tmp_path / 'warm_start.bin')
+    saved = WarmStart(path, 300, 3600)
+    saved.add('broken', lambda: 1 / 0)
+    saved.add('names', lambda: {'default': ['bot', 2.5]})
+    saved.save()
+    restored = WarmStart(path, 300, 3600)
+    assert restored.restore('broken') is None
+    assert restored.restore('names') == {'default': ['bot', 2.5]}
+
+
+def test_bad_magic_and_corrupt_files_are_ignored(tmp_path):
+    path = str(tmp_path / 'warm_start.bin')
+    with open(path, 'wb') as file:
+        file.write(b'PICKLE' + zlib.compress(b'{}'))
+    assert WarmStart(path, 300, 3600).restore('names') is None
+    with open(path, 'wb') as file:
+        file.write(MAGIC + b'not zlib')
+    assert WarmStart(path, 300, 3600).restore('names') is None
+    for state in ([], {'sections': {}}, {'saved_at': time.time(), 'sections': []}):
+        with open(path, 'wb') as file:
+            file.write(MAGIC + zlib.compress(json.dumps(state).encode('utf-8')))
+        assert WarmStart(path, 300, 3600).restore('names') is None
+
+
+def test_old_snapshot_is_ignored(tmp_path):
+    path = str(tmp_path / 'warm_start.bin')
+    state = {'saved_at': time.time() - 7200, 'sections': {'names': {'default': ['bot', 0]}}}
+    with open(path, 'wb') as file:
+        file.write(MAGIC + zlib.compress(json.dumps(state).encode('utf-8')))
+    assert WarmStart(path, 300, 3600).restore('names') is None
+    assert WarmStart(path, 300, 10800).restore('names') == {'default': ['bot', 0]}
+
+
+def test_disabled_warm_start_neither_saves_nor_loads(tmp_path):
+    path = str(tmp_path / 'warm_start.bin')
+    disabled = WarmStart(path, 0, 3600)
+    disabled.add('names', lambda: {'default': ['bot', 2.5]})
+    disabled.save()
+    assert not os.path.exists(path)
+    WarmStart(path, 300, 3600).save()
+    assert WarmStart(path, 0, 3600).restore('names') is None
@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+import webhook_filter
+
+COMMANDS = frozenset({'!ID'})
+BOUND = {'Cbound': 'default', 'Cother': 'second'}
+
+
+def event(group_id='Cbound', source_type='group', message_type='text', text='hello'):
+    data = {'type': 'message', 'source': {'type': source_type, 'groupId': group_id,
+                                          'userId': 'U1'}}
+    if message_type is not None:
+        data['message'] = {'type': message_type, 'id': '1', 'text': text}
+    return data
+
+
+@pytest.mark.parametrize('data, account, wanted', [
+    (event(), 'default', True),
+    (event(message_type='image'), 'default', True),
+    (event(message_type=None), 'default', True),
+    # Another account in the same group would forward it again
+    (event(), 'second', False),
+    (event(group_id='Cother'), 'second', True),
+    (event(group_id='Cunbound'), 'default', False),
+    (event(group_id='Cunbound', text='!ID'), 'default', True),
+    (event(group_id='Cunbound', message_type='image', text='!ID'), 'default', False),
+    (event(source_type='user'), 'default', False),
+    ({'type': 'message'}, 'default', False),
+], ids=['bound', 'bound-media', 'bound-no-message', 'other-account', 'own-account',
+        'unbound', 'unbound-command', 'unbound-media', 'direct-chat', 'no-source'])
+def test_wanted_event(data, account, wanted):
+    assert webhook_filter.wanted_event(data, BOUND, account, COMMANDS) is wanted
+
+
+def test_loads_with_and_without_orjson(monkeypatch):
+    body = json.dumps({'destination': 'U0', 'events': [event(text='中文')]}, ensure_ascii=False)
+    decoded = webhook_filter.loads(body.encode('utf-8'))
+    monkeypatch.setattr(webhook_filter, 'orjson', None)
+    assert webhook_filter.loads(body) == decoded
+    assert decoded['events'][0]['message']['text'] == '中文'
@@ -1,4 +1,6 @@
+import asyncio
 import json
+import os
 import random
 import sys
 import time
@@ -7,10 +9,11 @@ from os.path import exists
 import yaml
 from yaml import SafeLoader
 
-from cache import sync_channels_cache
+import log_config
+from cache import DEFAULT_LINE_ACCOUNT, sync_channels_cache
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log_config.setup_logging()
 logger = logging.getLogger(__name__)
 
 def graceful_exit(message=""):
@@ -35,6 +38,17 @@ def config_file_generator():
 line_channel_access_token: ''
 line_channel_secret: ''
 
+# More LINE bot accounts, each with its own rate limits and message quota.
+# Every account needs its own webhook URL in the LINE console: <webhook server>/callback/<name>
+# (the account above keeps /callback). A group is bound through the account whose mention was
+# used to start the binding, and messages from Discord are sent to it by that account, so busy
+# groups can be spread over several accounts. For example:
+# line_accounts:
+#   - name: 'second'
+#     channel_access_token: ''
+#     channel_secret: ''
+line_accounts: []
+
 # Discord Bot token
 # You can get it from https://discord.com/developers/applications
 discord_bot_token: ''
@@ -43,6 +57,11 @@ discord_bot_token: ''
 # If you change port, make sure to change the port in your reverse proxy(ngrok etc..) as well.
 webhook_port: 5000
 
+# Public URL of the webhook server, e.g. 'https://example.onrender.com/'
+# When set, the bot requests its own /healthz after keep_alive_idle_minutes without traffic,
+# so free hosts like Render don't put it to sleep. Leave it empty to disable.
+webhook_url: ''
+
 
 # (Optional settings)
 # You can fill in your own bot invite link and hosted by information
@@ -51,6 +70,124 @@ webhook_port: 5000
 bot_hosted_by: 'PlayfunI Network'
 line_bot_invite_link: ''
 discord_bot_invite_link: ''
+
+# Logging settings.
+# log_format can be 'text' or 'json'.
+# When log_redact_content is true, message contents are replaced by their length in logs.
+# Repeated warnings with the same content are logged at most once every log_rate_limit_seconds.
+log_level: 'INFO'
+log_format: 'text'
+log_redact_content: true
+log_rate_limit_seconds: 60
+
+# Public HTTPS URL of this server (the same host LINE sends webhooks to), e.g. 'https://example.com'
+# It is used to relay Discord attachments, preview thumbnails and converted media to LINE,
+# since Discord attachment URLs expire. Leave it empty to forward Discord URLs as they are.
+# Converting images needs Pillow (pip install pillow), converting video and audio needs ffmpeg.
+# media_cache_max_mb limits the disk space used by relayed media.
+public_base_url: ''
+media_workers: 2
+media_cache_max_mb: 1024
+
+# LINE media larger than discord_upload_limit_mb (10 without server boosts) can't be uploaded to
+# Discord. Larger videos are re-encoded to fit when ffmpeg is installed, anything else is sent as a
+# link to this server when public_base_url is set.
+discord_upload_limit_mb: 10
+
+# Memory used to keep the most used LINE stickers, so they are sent without reading the disk.
+sticker_cache_mb: 64
+
+# Send the Discord avatar of the speaker to LINE, together with their message, whenever the
+# speaker of a group changes or changes their avatar.
+send_author_avatar: true
+
+# Archive mode keeps a compressed copy of every forwarded message and its media per binding
+# under archive_dir, in chunk files of about archive_chunk_mb.
+# Export it with: python archive.py <folder_name> [--since 2024-01-01] [--until ...] [-o out.jsonl]
+archive_enabled: false
+archive_dir: './archive'
+archive_chunk_mb: 64
+
+# (Advanced settings)
+# sync_channels.json is checked for changes every sync_channels_reload_seconds (0 to disable), so
+# bindings edited by hand or by another instance apply without a restart.
+sync_channels_reload_seconds: 2
+
+# On SIGTERM/SIGINT the bot stops taking new work and waits up to shutdown_drain_seconds for queued
+# messages. Messages still unsent are saved to shutdown_state_file and sent after the next start.
+# Webhooks received meanwhile are refused, enable "Webhook redelivery" in the LINE Developers
+# Console so LINE sends them again once the bot is back.
+shutdown_drain_seconds: 20
+shutdown_state_file: ./unsent_messages.json
+
+# Runtime of the webhook server. 'performance' runs the bot on uvloop and parses HTTP with httptools
+# when they are installed (pip install uvloop httptools; uvloop isn't available on Windows), falling
+# back to the standard ones otherwise. 'standard' uses the asyncio event loop and the h11 parser.
+server_profile: performance
+# Connections the OS queues while the server is busy, raise it for large bursts of webhooks.
+server_backlog: 2048
+# Seconds an idle connection, e.g. from LINE, is kept open for the next request.
+server_keep_alive_seconds: 15
+# At most this many connections and requests are served at once, beyond that requests are answered
+# with 503 and LINE redelivers them later. 0 for no limit.
+server_limit_concurrency: 0
+
+# LINE profiles of group members are reused for line_profile_cache_minutes instead of being requested
+# for every message.
+line_profile_cache_minutes: 30
+# Caches filled through API calls (member profiles, bot names) are saved to warm_start_file every
+# warm_start_interval_minutes and at shutdown, and reused after a restart while younger than
+# warm_start_max_age_hours, so the bot starts at full speed. 0 minutes to disable.
+warm_start_file: ./warm_start.bin
+warm_start_interval_minutes: 5
+warm_start_max_age_hours: 24
+
+# LINE redelivers webhook events when the bot answers slowly. Events already processed within
+# this many seconds are dropped, remembering at most webhook_dedup_max_events event IDs.
+webhook_dedup_window_seconds: 3600
+webhook_dedup_max_events: 100000
+
+# The Discord and LINE IDs of forwarded messages are remembered for message_id_index_hours (at most
+# message_id_index_max messages), so Discord edits and deletes, LINE unsends and LINE quote replies
+# can be applied to the copy on the other side.
+message_id_index_hours: 72
+message_id_index_max: 50000
+
+# Messages are delivered in order per bound group, with different groups handled in parallel by
+# webhook_workers (LINE -> Discord) and discord_workers (Discord -> LINE) workers.
+# LINE events are handled by webhook_workers threads. Beyond max_pending_events queued events
+# (or max_pending_events_per_group for one group) media is forwarded as a link instead of being
+# re-uploaded, and beyond twice that events are refused so LINE redelivers them later.
+webhook_workers: 8
+discord_workers: 8
+max_pending_events: 200
+max_pending_events_per_group: 50
+
+# LINE push quota. Usage is read from LINE every line_quota_refresh_seconds and the remaining
+# quota is spread over the rest of the month. Once a day's share is used, messages of a binding
+# are sent as one digest every line_digest_interval_seconds instead of one push each.
+# line_quota_weights gives some bindings (by folder_name) a larger share, e.g. {'family_chat': 2}
+line_quota_refresh_seconds: 600
+line_digest_interval_seconds: 300
+line_quota_weights: {}
+line_push_rate_per_second: 100
+# Messages to a group within this many seconds of a LINE event use its reply token, which is free.
+line_reply_token_seconds: 50
+
+# /healthz and /readyz report the health of the bridge. A warning is logged whenever the event
+# loop is blocked for more than loop_lag_warn_ms.
+keep_alive_idle_minutes: 14
+loop_lag_warn_ms: 200
+# Whenever the event loop is blocked for more than loop_block_threshold_ms (0 to disable), the
+# blocking function and the handler it ran under are logged, appended to diagnostics_file as
+# JSON lines if set, and summarized at /admin/diagnostics with header 'Authorization: Bearer <admin_token>'.
+loop_block_threshold_ms: 100
+diagnostics_file: ''
+admin_token: ''
+
+# LINE API endpoints, only change them to point the bot at a local stand-in (e.g. benchmarks).
+line_api_endpoint: 'https://api.line.me'
+line_data_api_endpoint: 'https://api-data.line.me'
 """
                    )
         file.close()
@@ -76,12 +213,58 @@ def read_config():
             config = {
                 'line_channel_access_token': data['line_channel_access_token'],
                 'line_channel_secret': data['line_channel_secret'],
+                'line_accounts': data.get('line_accounts') or [],
                 'discord_bot_token': data['discord_bot_token'],
-                'webhook_url':data['webhook_url'],
+                'webhook_url': data.get('webhook_url', ''),
                 'webhook_port': data['webhook_port'],
                 'bot_hosted_by': data.get('bot_hosted_by', 'PlayfunI Network'),
                 'line_bot_invite_link': data['line_bot_invite_link'],
-                'discord_bot_invite_link': data['discord_bot_invite_link']
+                'discord_bot_invite_link': data['discord_bot_invite_link'],
+                'log_level': data.get('log_level', 'INFO'),
+                'log_format': data.get('log_format', 'text'),
+                'log_redact_content': data.get('log_redact_content', True),
+                'log_rate_limit_seconds': data.get('log_rate_limit_seconds', 60),
+                'public_base_url': data.get('public_base_url', ''),
+                'media_workers': data.get('media_workers', 2),
+                'media_cache_max_mb': data.get('media_cache_max_mb', 1024),
+                'discord_upload_limit_mb': data.get('discord_upload_limit_mb', 10),
+                'sticker_cache_mb': data.get('sticker_cache_mb', 64),
+                'send_author_avatar': data.get('send_author_avatar', True),
+                'archive_enabled': data.get('archive_enabled', False),
+                'archive_dir': data.get('archive_dir', './archive'),
+                'archive_chunk_mb': data.get('archive_chunk_mb', 64),
+                'sync_channels_reload_seconds': data.get('sync_channels_reload_seconds', 2),
+                'shutdown_drain_seconds': data.get('shutdown_drain_seconds', 20),
+                'shutdown_state_file': data.get('shutdown_state_file', './unsent_messages.json'),
+                'server_profile': data.get('server_profile', 'performance'),
+                'server_backlog': data.get('server_backlog', 2048),
+                'server_keep_alive_seconds': data.get('server_keep_alive_seconds', 15),
+                'server_limit_concurrency': data.get('server_limit_concurrency', 0),
+                'line_profile_cache_minutes': data.get('line_profile_cache_minutes', 30),
+                'warm_start_file': data.get('warm_start_file', './warm_start.bin'),
+                'warm_start_interval_minutes': data.get('warm_start_interval_minutes', 5),
+                'warm_start_max_age_hours': data.get('warm_start_max_age_hours', 24),
+                'webhook_dedup_window_seconds': data.get('webhook_dedup_window_seconds', 3600),
+                'webhook_dedup_max_events': data.get('webhook_dedup_max_events', 100000),
+                'message_id_index_hours': data.get('message_id_index_hours', 72),
+                'message_id_index_max': data.get('message_id_index_max', 50000),
+                'webhook_workers': data.get('webhook_workers', 8),
+                'discord_workers': data.get('discord_workers', 8),
+                'max_pending_events': data.get('max_pending_events', 200),
+                'max_pending_events_per_group': data.get('max_pending_events_per_group', 50),
+                'line_quota_refresh_seconds': data.get('line_quota_refresh_seconds', 600),
+                'line_digest_interval_seconds': data.get('line_digest_interval_seconds', 300),
+                'line_quota_weights': data.get('line_quota_weights') or {},
+                'line_push_rate_per_second': data.get('line_push_rate_per_second', 100),
+                'line_reply_token_seconds': data.get('line_reply_token_seconds', 50),
+                'keep_alive_idle_minutes': data.get('keep_alive_idle_minutes', 14),
+                'loop_lag_warn_ms': data.get('loop_lag_warn_ms', 200),
+                'loop_block_threshold_ms': data.get('loop_block_threshold_ms', 100),
+                'diagnostics_file': data.get('diagnostics_file', ''),
+                'admin_token': data.get('admin_token', ''),
+                'line_api_endpoint': data.get('line_api_endpoint', 'https://api.line.me'),
+                'line_data_api_endpoint': data.get('line_data_api_endpoint',
+                                                   'https://api-data.line.me')
             }
             file.close()
     except (KeyError, TypeError):
@@ -95,6 +278,21 @@ def read_config():
         if field not in config or not config[field]:
             graceful_exit(f"Missing required field: {field} in config.yml")
             sys.exit()
+    account_names = {DEFAULT_LINE_ACCOUNT}
+    for index, account in enumerate(config['line_accounts']):
+        for field in ['name', 'channel_access_token', 'channel_secret']:
+            if not isinstance(account, dict) or not account.get(field):
+                graceful_exit(f"Missing required field: line_accounts[{index}].{field} in config.yml")
+                sys.exit()
+        if account['name'] in account_names or not str(account['name']).isidentifier():
+            graceful_exit(f"Invalid or duplicated LINE account name: {account['name']} in config.yml")
+            sys.exit()
+        account_names.add(account['name'])
+    if config['server_profile'] not in ('standard', 'performance'):
+        graceful_exit(f"Invalid server_profile: {config['server_profile']} in config.yml, "
+                      f"use 'standard' or 'performance'")
+        sys.exit()
+    log_config.setup_logging(config)
     return config
 
 
@@ -110,7 +308,8 @@ def read_sync_channels():
 
 
 def add_new_sync_channel(line_group_id: str, line_group_name: str, discord_channel_id: int,
-                         discord_channel_name: str, discord_channel_webhook: str):
+                         discord_channel_name: str, discord_channel_webhook: str,
+                         line_account: str = DEFAULT_LINE_ACCOUNT):
     """Add new sync channel.
 
     :param str line_group_id: Line group id.
@@ -118,6 +317,7 @@ def add_new_sync_channel(line_group_id: str, line_group_name: str, discord_chann
     :param int discord_channel_id: Discord channel id.
     :param str discord_channel_name: Discord channel name.
     :param str discord_channel_webhook: Discord channel webhook.
+    :param str line_account: Name of the LINE account that sends to the group.
     """
     data = json.load(open('sync_channels.json', 'r', encoding="utf8"))
     if not data:  # If the file is empty
@@ -133,23 +333,19 @@ def add_new_sync_channel(line_group_id: str, line_group_name: str, discord_chann
         'line_group_name': line_group_name,
         'discord_channel_id': discord_channel_id,
         'discord_channel_name': discord_channel_name,
-        'discord_channel_webhook': discord_channel_webhook
+        'discord_channel_webhook': discord_channel_webhook,
+        'line_account': line_account
     })
-    logger.info(f"""
-    新連動設定已紀錄 {line_group_id}, json: {{
-        'sub_num': {sub_num},
-        'folder_name': {folder_name},
-        'line_group_id': {line_group_id},
-        'line_group_name': {line_group_name},
-        'discord_channel_id': {discord_channel_id},
-        'discord_channel_name': {discord_channel_name},
-        'discord_channel_webhook': {discord_channel_webhook}
-    }}
-    """)
+    logger.info("新連動設定已紀錄 %s", line_group_id,
+                extra={'sub_num': sub_num, 'folder_name': folder_name,
+                       'line_group_id': line_group_id, 'line_group_name': line_group_name,
+                       'discord_channel_id': discord_channel_id,
+                       'discord_channel_name': discord_channel_name,
+                       'line_account': line_account})
     update_json('sync_channels.json', data)
     sync_channels_cache.add_sync_channel(sub_num, folder_name, line_group_id, line_group_name,
                                          discord_channel_id, discord_channel_name,
-                                         discord_channel_webhook)
+                                         discord_channel_webhook, line_account)
 
 
 def remove_sync_channel(line_group_id: str = None, discord_channel_id: int = None):
@@ -167,11 +363,13 @@ def remove_sync_channel(line_group_id: str = None, discord_channel_id: int = Non
     sync_channels_cache.remove_sync_channel(line_group_id, discord_channel_id)
 
 
-def generate_binding_code(line_group_id: str, line_group_name: str) -> int:
+def generate_binding_code(line_group_id: str, line_group_name: str,
+                          line_account: str = DEFAULT_LINE_ACCOUNT) -> int:
     """Generate binding code.
 
     :param str line_group_id: Line group id.
     :param str line_group_name: Line group name.
+    :param str line_account: Name of the LINE account the binding was started with.
     :return int: Binding code.
     """
     if not exists('./binding_codes.json'):
@@ -181,7 +379,7 @@ def generate_binding_code(line_group_id: str, line_group_name: str) -> int:
     data = json.load(open('binding_codes.json', 'r', encoding="utf8"))
     binding_code = random.randint(100000, 999999)
     data[binding_code] = {'line_group_id': line_group_id, 'line_group_name': line_group_name,
-                          'expiration': time.time() + 300}
+                          'line_account': line_account, 'expiration': time.time() + 300}
     update_json('binding_codes.json', data)
     return binding_code
 
@@ -215,6 +413,51 @@ def update_json(file_name: str, data: dict):
     :param str file_name: The file to update.
     :param dict data: The data to update.
     """
-    with open(file_name, 'w', encoding="utf8") as file:
+    # Written to a temporary file first, so readers such as watch_sync_channels never see
+    # a half written file
+    temp_name = f'{file_name}.tmp'
+    with open(temp_name, 'w', encoding="utf8") as file:
         json.dump(data, file, indent=4, ensure_ascii=False)
         file.close()
+    os.replace(temp_name, file_name)
+
+
+async def watch_sync_channels(interval: float):
+    """Reload sync_channels.json into the cache whenever it changes, without a restart.
+
+    The file is checked every `interval` seconds by its modification time and size, so
+    edits by hand and by other instances of the bot are picked up. Only the added, removed
+    and changed sync channels are applied to the cache.
+
+    :param float interval: Seconds between checks, 0 to disable.
+    """
+    if interval <= 0:
+        return
+    last_seen = _file_signature('sync_channels.json')
+    while True:
+        await asyncio.sleep(interval)
+        signature = _file_signature('sync_channels.json')
+        if signature is None or signature == last_seen:
+            continue
+        started = time.perf_counter()
+        try:
+            with open('sync_channels.json', 'r', encoding="utf8") as file:
+                data = json.load(file)
+            added, removed, changed = sync_channels_cache.apply(data)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # Retried on the next change, the cache keeps the last good sync channels
+            logger.warning("無法重新載入 sync_channels.json: %s", e)
+            last_seen = signature
+            continue
+        last_seen = signature
+        if added or removed or changed:
+            logger.info("已重新載入綁定設定: 新增 %s, 移除 %s, 變更 %s (%.1f ms)", added, removed,
+                        changed, (time.perf_counter() - started) * 1000)
+
+
+def _file_signature(file_name: str) -> tuple | None:
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
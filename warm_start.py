@@ -0,0 +1,110 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+import utilities as utils
+from lifecycle import lifecycle
+
+logger = logging.getLogger(__name__)
+
+config = utils.read_config()
+
+# Start of a snapshot file, followed by the zlib compressed JSON of the sections
+MAGIC = b'LBWS1\n'
+
+
+class WarmStart:
+    """Snapshot of caches that are filled through API calls, for the next start of the bot.
+
+    Modules register a section with `add`: a function returning its entries as JSON
+    serializable data. `save` writes every section to one compact file, atomically and
+    off the event loop, every `interval` seconds and at shutdown. After a restart a cache
+    asks for its section with `restore` when it is first used; the file is read then, and
+    ignored when older than `max_age` seconds. Entries carry their own timestamps, so each
+    cache also drops the ones past its own TTL.
+    """
+
+    def __init__(self, path: str, interval: float, max_age: float):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self._sections: dict[str, object] = {}
+        self._loaded: dict | None = None
+        self._load_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def add(self, name: str, snapshot):
+        """Register a section.
+
+        :param str name: Name of the section in the file.
+        :param snapshot: Function returning the entries of the cache, called from a thread.
+        """
+        self._sections[name] = snapshot
+
+    def restore(self, name: str):
+        """The entries of a section saved by the previous run, None if there are none.
+
+        Every section is handed out once, the first caller owns the entries.
+        """
+        with self._load_lock:
+            if self._loaded is None:
+                self._loaded = self._load()
+            return self._loaded.pop(name, None)
+
+    def save(self):
+        """Write every section to the snapshot file."""
+        if not self.interval:
+            return
+        state = {}
+        for name, snapshot in self._sections.items():
+            try:
+                state[name] = snapshot()
+            except Exception as e:
+                logger.warning("無法取得快取 %s 的快照: %s", name, e)
+        data = MAGIC + zlib.compress(json.dumps({'saved_at': time.time(), 'sections': state},
+                                                ensure_ascii=False).encode('utf-8'))
+        with self._save_lock:
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, self.path)
+        logger.debug("已儲存快取快照 %s (%s bytes)", self.path, len(data))
+
+    async def run(self):
+        """Save the snapshot every `interval` seconds."""
+        while self.interval:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.save)
+            except OSError as e:
+                logger.warning("無法儲存快取快照 %s: %s", self.path, e)
+
+    def _load(self) -> dict:
+        if not self.interval or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+            if not data.startswith(MAGIC):
+                raise ValueError("unknown format")
+            state = json.loads(zlib.decompress(data[len(MAGIC):]))
+            age = time.time() - state['saved_at']
+            if not isinstance(state['sections'], dict):
+                raise ValueError("sections is not an object")
+        except (OSError, ValueError, KeyError, TypeError, zlib.error) as e:
+            logger.warning("無法讀取快取快照 %s: %s", self.path, e)
+            return {}
+        if age > self.max_age:
+            logger.info("快取快照已過期 (%.0f 小時前)，不使用", age / 3600)
+            return {}
+        logger.info("載入快取快照: %s", ', '.join(state['sections']))
+        return state['sections']
+
+
+warm_start = WarmStart(config['warm_start_file'], config['warm_start_interval_minutes'] * 60,
+                       config['warm_start_max_age_hours'] * 3600)
+lifecycle.add_close('warm_start', warm_start.save)
@@ -0,0 +1,38 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson comes with the performance extra, else the standard decoder
+    orjson = None
+
+
+def loads(body: str | bytes):
+    """Decode a webhook body, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def wanted_event(event_data: dict, line_accounts, account_name: str, commands) -> bool:
+    """Decide from the raw JSON of a LINE event whether it needs to be handled at all.
+
+    Only group events reach a handler: events of bound groups are forwarded by the account
+    bound to the group, and in other groups only text messages that are bot commands get an
+    answer (e.g. to bind the group). Everything else is dropped before it is parsed into
+    line-bot-sdk models.
+
+    :param dict event_data: One event of the webhook body.
+    :param line_accounts: Mapping of the bound LINE group IDs to the name of their account.
+    :param str account_name: Name of the LINE account that received the event.
+    :param commands: Container of the texts the bot answers to.
+    :return bool: True if the event should be parsed and dispatched.
+    """
+    source = event_data.get('source')
+    if not source or source.get('type') != 'group':
+        return False
+    bound_account = line_accounts.get(source.get('groupId'))
+    if bound_account is not None:
+        # Other accounts in the group would forward every message once more
+        return bound_account == account_name
+    message = event_data.get('message')
+    return bool(message) and message.get('type') == 'text' and message.get('text') in commands